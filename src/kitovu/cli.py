@@ -18,13 +18,50 @@ Why does this file exist, and why not put this in __main__?
 import pathlib
 import typing
 import sys
+import json
+import signal
 import logging
+import threading
+import contextlib
 import webbrowser
 
 import click
 
 from kitovu import utils
-from kitovu.sync import syncing, settings, filecache
+# kitovu.sync.syncing is imported in the commands needing it, so commands
+# like "kitovu fileinfo" or "kitovu --help" start quickly.
+from kitovu.sync import settings, filecache, planning, progress
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def _cancel_on_signals(cancel: threading.Event) -> typing.Iterator[None]:
+    """Set the given event on SIGINT (Ctrl-C) or SIGTERM, instead of exiting.
+
+    This lets a sync stop after the running downloads and write the file
+    cache. A second signal is handled as usual again, so e.g. a second
+    SIGTERM exits right away (without writing the file cache).
+    """
+    signals = [signal.SIGINT, signal.SIGTERM]
+    old_handlers = {signum: signal.getsignal(signum) for signum in signals}
+
+    def restore() -> None:
+        for signum, old_handler in old_handlers.items():
+            signal.signal(signum, old_handler)
+
+    def handler(_signum: int, _frame: typing.Any) -> None:
+        print("Cancelling after the running downloads...", file=sys.stderr)
+        restore()
+        cancel.set()
+
+    for signum in signals:
+        signal.signal(signum, handler)
+    try:
+        yield
+    finally:
+        restore()
 
 
 @click.group(context_settings={'help_option_names': ['-h', '--help']})
@@ -42,11 +79,14 @@ def cli(loglevel: str) -> None:
 
 
 @cli.command()
-def gui() -> None:
+@click.option('--in-process', is_flag=True,
+              help="Sync in the GUI process, keeping the connections open between syncs, "
+              "instead of starting a new process for every sync")
+def gui(in_process: bool = False) -> None:
     """Start the kitovu GUI."""
     try:
         from kitovu.gui import app as guiapp
-        sys.exit(guiapp.run())
+        sys.exit(guiapp.run(in_process=in_process))
     except ModuleNotFoundError as ex:
         if ex.name == 'PyQt5':
             print('To run the GUI, you need to install the extra GUI dependencies', file=sys.stderr)
@@ -58,18 +98,105 @@ def gui() -> None:
 
 @cli.command()
 @click.option('--config', type=pathlib.Path, help="The configuration file to use")
-def sync(config: typing.Optional[pathlib.Path] = None) -> None:
+@click.option('--dry-run', is_flag=True, help="Only show which files would be downloaded")
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text',
+              help="The output format of the plan shown with --dry-run")
+@click.option('--plan-file', type=click.File('r'),
+              help="Download the files of a plan saved with --dry-run --format json, "
+              "without listing the remote files again")
+@click.option('--order', type=click.Choice(planning.ORDERS), default='listing',
+              help="The order to download files in (after the subject priority)")
+@click.option('--time-budget', type=click.FloatRange(min=0), metavar='SECONDS',
+              help="Don't start new downloads after the given time")
+@click.option('--jobs', type=click.IntRange(min=1), default=4,
+              help="The maximum number of parallel downloads per connection")
+@click.option('--retries', type=click.IntRange(min=0), default=100,
+              help="How many failed operations to retry in total (e.g. after timeouts)")
+@click.option('--progress', 'progress_format', type=click.Choice(progress.FORMATS), default='log',
+              help="With jsonl, print the progress as JSON lines to stdout (log messages go to stderr)")
+@click.option('--stats', 'show_stats', is_flag=True,
+              help="Show how long plugin calls and the phases of the sync took (on stderr)")
+@click.option('--stats-file', type=click.File('w'),
+              help="Write how long plugin calls and the phases of the sync took as JSON to a file")
+@click.option('--metrics-file', type=pathlib.Path,
+              help="Write metrics of the sync in the OpenMetrics text format to the given file "
+              "(e.g. for the textfile collector of the Prometheus node_exporter)")
+def sync(config: typing.Optional[pathlib.Path] = None,
+         dry_run: bool = False,
+         output_format: str = 'text',
+         plan_file: typing.Optional[typing.IO[str]] = None,
+         order: str = 'listing',
+         time_budget: typing.Optional[float] = None,
+         jobs: int = 4,
+         retries: int = 100,
+         progress_format: str = 'log',
+         show_stats: bool = False,
+         stats_file: typing.Optional[typing.IO[str]] = None,
+         metrics_file: typing.Optional[pathlib.Path] = None) -> None:
     """Synchronize new files."""
+    from kitovu.sync import syncing, instrumentation, metrics
+    if dry_run and plan_file is not None:
+        raise click.UsageError("--dry-run can't be used together with --plan-file")
+    if dry_run and metrics_file is not None:
+        raise click.UsageError("--dry-run can't be used together with --metrics-file")
+
+    metrics_reporter = None if metrics_file is None else metrics.MetricsReporter()
+    success = False
     try:
-        syncing.start_all(config)
+        plan = None
+        if plan_file is not None:
+            try:
+                plan = planning.Plan.from_json(json.load(plan_file))
+            except ValueError as ex:
+                raise utils.UsageError(f"Failed to read {plan_file.name}: {ex}")
+        reporter = (progress.JsonLinesReporter() if progress_format == 'jsonl'
+                    else progress.Reporter())
+        if metrics_reporter is not None:
+            reporter = progress.MultiReporter([reporter, metrics_reporter])
+        stats = (instrumentation.Stats() if show_stats or stats_file is not None
+                 else None)
+        options = syncing.SyncOptions(dry_run=dry_run, plan=plan, order=order,
+                                      time_budget=time_budget, jobs=jobs, retries=retries,
+                                      reporter=reporter, stats=stats)
+        with _cancel_on_signals(options.cancel):
+            result = syncing.start_all(config, options)
+        success = not options.cancel.is_set()
     except utils.UsageError as ex:
         raise click.ClickException(str(ex))
+    finally:
+        # Also written if the sync failed, so that can be alerted on.
+        if metrics_file is not None and metrics_reporter is not None:
+            pending = sys.exc_info()[1]
+            try:
+                metrics.write(metrics_file, metrics_reporter, success=success,
+                              cache_stats=filecache.manifest_stats())
+            except OSError as ex:
+                if pending is None:
+                    raise click.ClickException(f"Could not write {metrics_file}: {ex}")
+                # Don't replace the error the sync failed with.
+                logger.error("Could not write %s: %s", metrics_file, ex)
+
+    if stats is not None:
+        if show_stats:
+            print(stats.format_text(), file=sys.stderr)
+        if stats_file is not None:
+            json.dump(stats.to_json(), stats_file, indent=2)
+
+    if options.cancel.is_set():
+        raise click.ClickException("The sync was cancelled")
+
+    if dry_run:
+        if output_format == 'json':
+            print(json.dumps(result.to_json(), indent=2))
+        else:
+            print(result.format_text())
 
 
 @cli.command()
 @click.option('--config', type=pathlib.Path, help="The configuration file to validate")
 def validate(config: typing.Optional[pathlib.Path] = None) -> None:
     """Validate the configuration file."""
+    from kitovu.sync import syncing
     try:
         syncing.validate_config(config)
     except utils.UsageError as ex:
@@ -83,6 +210,113 @@ def fileinfo() -> None:
     print("The file cache is located at: {}".format(filecache.get_path()))
 
 
+@cli.group()
+def cache() -> None:
+    """Manage the file cache."""
+
+
+@cache.command()
+@click.option('--config', type=pathlib.Path, help="The configuration file to use")
+def gc(config: typing.Optional[pathlib.Path] = None) -> None:
+    """Remove stale entries from the file cache.
+
+    Entries of files which don't exist locally anymore and of subjects which
+    aren't configured anymore are removed.
+    """
+    from kitovu.sync import syncing
+    try:
+        result = syncing.collect_garbage(config)
+    except utils.UsageError as ex:
+        raise click.ClickException(str(ex))
+    print(f"Removed {result.entries} entries ({result.shards} subjects), "
+          f"reclaimed {result.reclaimed_bytes} bytes.")
+
+
+@cache.command()
+def stats() -> None:
+    """Show statistics about the file cache."""
+    cache_stats = filecache.stats()
+    rows = [('Connection', 'Subject', 'Remote directory', 'Plugin', 'Entries', 'Size')]
+    rows += [(s.connection, s.subject, s.remote_dir, s.plugin, str(s.entries), str(s.size))
+             for s in cache_stats.subjects]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+    print()
+    for plugin, entries in sorted(cache_stats.entries_per_plugin().items()):
+        print(f"{plugin}: {entries} entries")
+    total = sum(s.entries for s in cache_stats.subjects)
+    print(f"Total: {total} entries in {len(cache_stats.subjects)} subjects, "
+          f"{cache_stats.size} bytes, loaded in {cache_stats.load_time * 1000:.1f} ms")
+
+
+@cache.command()
+@click.option('--config', type=pathlib.Path, help="The configuration file to use")
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help="Number of files to check in parallel. Default: based on the CPU count")
+def verify(config: typing.Optional[pathlib.Path] = None, jobs: typing.Optional[int] = None) -> None:
+    """Check the cached local files for changes.
+
+    Exits with status 1 if files are missing or were changed locally.
+    """
+    from kitovu.sync import syncing
+    try:
+        count, results = syncing.verify_cache(config, jobs=jobs)
+    except utils.UsageError as ex:
+        raise click.ClickException(str(ex))
+
+    drift: typing.List[typing.Tuple[pathlib.Path, syncing.Drift]] = []
+    checked = 0
+    with click.progressbar(results, length=count, label='Verifying', file=sys.stderr) as bar:
+        for path, file_drift in bar:
+            checked += 1
+            if file_drift is not None:
+                drift.append((path, file_drift))
+
+    for path, file_drift in sorted(drift, key=lambda item: item[0]):
+        print(f"{file_drift.name.lower()}: {path}")
+    print(f"Checked {checked} files, {len(drift)} differ from the file cache.")
+    if drift:
+        sys.exit(1)
+
+
+@cache.command(name='export')
+@click.option('--config', type=pathlib.Path, help="The configuration file to use")
+@click.argument('output', type=click.File('w'))
+def export_cache(output: typing.IO[str], config: typing.Optional[pathlib.Path] = None) -> None:
+    """Export the file cache to a single JSON file ("-" for stdout)."""
+    from kitovu.sync import syncing
+    try:
+        cache = syncing.open_cache(config)
+    except utils.UsageError as ex:
+        raise click.ClickException(str(ex))
+    json.dump(cache.export_data(), output)
+
+
+@cache.command(name='import')
+@click.option('--config', type=pathlib.Path, help="The configuration file to use")
+@click.argument('input_file', metavar='INPUT', type=click.File('r'))
+def import_cache(input_file: typing.IO[str], config: typing.Optional[pathlib.Path] = None) -> None:
+    """Import a file cache exported with "kitovu cache export".
+
+    Subjects in the imported file replace the ones in the file cache.
+    """
+    from kitovu.sync import syncing
+    try:
+        cache = syncing.open_cache(config)
+    except utils.UsageError as ex:
+        raise click.ClickException(str(ex))
+    try:
+        count = cache.import_data(json.load(input_file))
+    except ValueError as ex:
+        raise click.ClickException(f"Failed to read {input_file.name}: {ex}")
+    except utils.UsageError as ex:
+        raise click.ClickException(str(ex))
+    cache.write()
+    print(f"Imported {count} subjects.")
+
+
 @cli.command()
 def docs() -> None:
     """Open the documentation in the browser."""
@@ -5,14 +5,14 @@ from PyQt5.QtWidgets import QApplication
 from kitovu.gui import mainwindow
 
 
-def run() -> int:
+def run(in_process: bool = False) -> int:
     app = QApplication(sys.argv)
     app.setStyleSheet("""
         QPushButton {
             padding: 20px;
         }
     """)
-    main = mainwindow.MainWindow()
+    main = mainwindow.MainWindow(in_process=in_process)
     main.show()
     status: int = app.exec_()
     return status
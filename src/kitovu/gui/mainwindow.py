@@ -1,4 +1,7 @@
+import typing
+
 from PyQt5.QtWidgets import QMainWindow, QStackedWidget, QWidget
+from PyQt5.QtGui import QCloseEvent
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 
 from kitovu.gui import startscreen, confscreen, syncscreen
@@ -8,10 +11,10 @@ class CentralWidget(QStackedWidget):
 
     status_message = pyqtSignal(str)
 
-    def __init__(self, parent: QWidget = None) -> None:
+    def __init__(self, parent: QWidget = None, in_process: bool = False) -> None:
         super().__init__(parent)
 
-        self._sync_screen = syncscreen.SyncScreen()
+        self._sync_screen = syncscreen.SyncScreen(in_process=in_process)
         self.addWidget(self._sync_screen)
 
         self._conf_screen = confscreen.ConfScreen()
@@ -42,12 +45,20 @@ class CentralWidget(QStackedWidget):
         self._conf_screen.load_file()
         self.setCurrentWidget(self._conf_screen)
 
+    def shutdown(self) -> None:
+        self._sync_screen.shutdown()
+
 
 class MainWindow(QMainWindow):
 
-    def __init__(self, parent: QWidget = None) -> None:
+    def __init__(self, parent: QWidget = None, in_process: bool = False) -> None:
         super().__init__(parent)
-        central = CentralWidget()
+        # centralWidget() is only typed as QWidget.
+        self._central = CentralWidget(in_process=in_process)
         self.statusBar().showMessage("Bereit.")
-        self.setCentralWidget(central)
-        central.status_message.connect(self.statusBar().showMessage)
+        self.setCentralWidget(self._central)
+        self._central.status_message.connect(self.statusBar().showMessage)
+
+    def closeEvent(self, event: typing.Optional[QCloseEvent]) -> None:
+        self._central.shutdown()
+        super().closeEvent(event)
@@ -1,17 +1,106 @@
 import sys
+import json
+import time
+import typing
 
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTextEdit, QProgressBar, QPushButton
-from PyQt5.QtCore import pyqtSlot, pyqtSignal, QProcess
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QPlainTextEdit, QProgressBar, QPushButton
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QProcess, QTimer
+
+from kitovu.sync import planning
+from kitovu.gui import syncworker
+
+
+class SyncProgress:
+
+    """The progress of a sync run, from the events of "kitovu sync --progress=jsonl".
+
+    Files which are done, skipped or failed count with their full (planned)
+    size, so the progress reaches 100% at the end. If no sizes are known, the
+    progress is based on the number of files instead.
+    """
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._sizes: typing.Dict[str, int] = {}
+        self._progress: typing.Dict[str, int] = {}
+        self._finished: typing.Set[str] = set()
+        self.transferred = 0
+        self._start: typing.Optional[float] = None
+
+    def handle(self, event: typing.Dict[str, typing.Any]) -> None:
+        kind = event.get('event')
+        # None e.g. for errors of a whole connection.
+        path: typing.Optional[str] = event.get('local-path')
+        if kind == 'planned' and path is not None:
+            self._sizes[path] = event['size'] or 0
+            self._progress[path] = 0
+        elif kind == 'transfer' and path is not None:
+            if self._start is None:
+                self._start = self._clock()
+            self._progress[path] = self._progress.get(path, 0) + event['bytes']
+            self.transferred += event['bytes']
+        elif kind in ['done', 'skipped', 'error'] and path is not None:
+            self._finished.add(path)
+            self._progress[path] = self._sizes.get(path, 0)
+
+    @property
+    def total(self) -> int:
+        return sum(self._sizes.values())
+
+    @property
+    def fraction(self) -> float:
+        """How much of the run is done, between 0 and 1."""
+        if not self._sizes:
+            return 0.0
+        total = self.total
+        if not total:
+            return len(self._finished) / len(self._sizes)
+        done = sum(min(size, self._sizes.get(path, 0)) for path, size in self._progress.items())
+        return done / total
+
+    @property
+    def throughput(self) -> float:
+        """The average download speed so far, in bytes per second."""
+        if self._start is None:
+            return 0.0
+        elapsed = self._clock() - self._start
+        return self.transferred / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def remaining_seconds(self) -> typing.Optional[float]:
+        """The estimated time left, or None if unknown."""
+        throughput = self.throughput
+        if not throughput or not self.total:
+            return None
+        return self.total * (1 - self.fraction) / throughput
+
+    def format_text(self) -> str:
+        parts = [f'{self.fraction * 100:.0f}%']
+        if self.total:
+            done = int(self.total * self.fraction)
+            parts.append(f'{planning.format_size(done)} / {planning.format_size(self.total)}')
+        if self.throughput:
+            parts.append(f'{planning.format_size(int(self.throughput))}/s')
+        remaining = self.remaining_seconds
+        if remaining is not None:
+            minutes, seconds = divmod(int(remaining), 60)
+            parts.append(f'noch {minutes}:{seconds:02d}')
+        return ', '.join(parts)
 
 
 class ProgressBar(QProgressBar):
 
+    # QProgressBar uses ints, which aren't big enough for bytes.
+    STEPS = 1000
+
     def show_empty(self) -> None:
+        self.setFormat('%p%')
         self.setMinimum(0)
         self.setMaximum(1)
         self.setValue(0)
 
     def show_full(self) -> None:
+        self.setFormat('%p%')
         self.setMinimum(0)
         self.setMaximum(1)
         self.setValue(1)
@@ -21,25 +110,56 @@ class ProgressBar(QProgressBar):
         self.setMaximum(0)
         self.setValue(0)
 
+    def show_progress(self, progress: SyncProgress) -> None:
+        self.setMinimum(0)
+        self.setMaximum(self.STEPS)
+        self.setValue(int(progress.fraction * self.STEPS))
+        self.setFormat(progress.format_text())
+
 
 class SyncScreen(QWidget):
 
-    PYTHON_ARGS = ['-m', 'kitovu', 'sync']
+    """Runs "kitovu sync" and shows its output and progress.
+
+    By default, every sync runs in a new process. With in_process=True, it
+    runs in a thread of the GUI process instead (see the syncworker module),
+    which keeps the connections open for the next sync.
+
+    Output of the sync can be a lot of lines (e.g. with debug logging), so
+    it's collected and shown in batches every FLUSH_INTERVAL milliseconds, and
+    only the last MAX_LINES lines are kept.
+    """
+
+    PYTHON_ARGS = ['-m', 'kitovu', 'sync', '--progress=jsonl']
+    FLUSH_INTERVAL = 100
+    MAX_LINES = 10000
     status_message = pyqtSignal(str)
     close_requested = pyqtSignal()
     finished = pyqtSignal(int, QProcess.ExitStatus)
 
-    def __init__(self, parent: QWidget = None) -> None:
+    def __init__(self, parent: QWidget = None, in_process: bool = False) -> None:
         super().__init__(parent)
 
         self._vbox = QVBoxLayout(self)
 
-        self._output = QTextEdit()
+        self._output = QPlainTextEdit()
         self._output.setReadOnly(True)
+        self._output.setMaximumBlockCount(self.MAX_LINES)
         self._vbox.addWidget(self._output)
 
+        # Data after the last complete line.
+        self._buffer = b''
+        # Lines which aren't shown yet.
+        self._pending_lines: typing.List[str] = []
+        self._progress_changed = False
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(self.FLUSH_INTERVAL)
+        self._flush_timer.timeout.connect(self.flush_output)
+
         self._progress = ProgressBar()
         self._progress.show_empty()
+        self._sync_progress = SyncProgress()
         self._vbox.addWidget(self._progress)
 
         self._cancel_button = QPushButton("Zurück")
@@ -52,6 +172,15 @@ class SyncScreen(QWidget):
         self._process.started.connect(self.on_process_started)
         self._process.finished.connect(self.on_process_finished)
 
+        self._running = False
+        self._worker_thread: typing.Optional[syncworker.WorkerThread] = None
+        if in_process:
+            self._worker_thread = syncworker.WorkerThread(self)
+            worker = self._worker_thread.worker
+            worker.reported.connect(self.on_worker_event)
+            worker.message.connect(self.on_worker_message)
+            worker.finished.connect(self.on_worker_finished)
+
         self.status_message.connect(self.on_status_message)
 
     @pyqtSlot()
@@ -60,20 +189,78 @@ class SyncScreen(QWidget):
         self._progress.show_pulse()
         self.status_message.emit("Synchronisation läuft...")
 
+    def _schedule_flush(self) -> None:
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @pyqtSlot(dict)
+    def on_worker_event(self, event: typing.Dict[str, typing.Any]) -> None:
+        self._sync_progress.handle(event)
+        self._progress_changed = True
+        self._schedule_flush()
+
+    @pyqtSlot(str)
+    def on_worker_message(self, message: str) -> None:
+        self._pending_lines.append(message)
+        self._schedule_flush()
+
+    @pyqtSlot(bool, str)
+    def on_worker_finished(self, success: bool, error: str) -> None:
+        self.flush_output()
+        self._running = False
+        self._cancel_button.setText("Zurück")
+        self._progress.show_full()
+        if success:
+            self.status_message.emit("Synchronisation erfolgreich beendet.")
+            self.finished.emit(0, QProcess.NormalExit)
+        else:
+            self.status_message.emit(f"Fehler: {error}")
+            self.finished.emit(1, QProcess.NormalExit)
+
     @pyqtSlot()
     def on_process_ready_read(self) -> None:
-        if self._process.canReadLine():
-            data: bytes = bytes(self._process.readLine())
-            self._output.append(data.decode('utf-8'))
+        self._buffer += bytes(self._process.readAll())
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            self._handle_line(line)
+        self._schedule_flush()
+
+    def _handle_line(self, data: bytes) -> None:
+        """Queue a line of output for showing it, or update the progress for events."""
+        text = data.decode('utf-8', errors='replace').rstrip('\r')
+        if text.startswith('{'):
+            try:
+                event = json.loads(text)
+            except ValueError:
+                event = None
+            if isinstance(event, dict) and 'event' in event:
+                self._sync_progress.handle(event)
+                self._progress_changed = True
+                return
+        self._pending_lines.append(text)
+
+    @pyqtSlot()
+    def flush_output(self) -> None:
+        """Show the queued output lines and progress."""
+        self._flush_timer.stop()
+        if self._pending_lines:
+            self._output.appendPlainText('\n'.join(self._pending_lines))
+            self._pending_lines = []
+        if self._progress_changed:
+            self._progress.show_progress(self._sync_progress)
+            self._progress_changed = False
 
     @pyqtSlot(int, QProcess.ExitStatus)
     def on_process_finished(self, exit_code: int, exit_status: QProcess.ExitStatus) -> None:
+        self.on_process_ready_read()
+        if self._buffer:
+            self._handle_line(self._buffer)
+            self._buffer = b''
+        self.flush_output()
+
         self._cancel_button.setText("Zurück")
         self._progress.show_full()
 
-        data: bytes = bytes(self._process.readAll())
-        self._output.append(data.decode('utf-8'))
-
         if exit_status == QProcess.CrashExit:
             self.status_message.emit("Fehler: Kitovu-Prozess ist abgestürzt.")
         elif exit_code != 0:
@@ -86,11 +273,16 @@ class SyncScreen(QWidget):
 
     @pyqtSlot(str)
     def on_status_message(self, message: str) -> None:
-        self._output.append(message)
+        self.flush_output()
+        self._output.appendPlainText(message)
 
     @pyqtSlot()
     def on_cancel_clicked(self) -> None:
-        if self._process.state() != QProcess.NotRunning:
+        if self._worker_thread is not None:
+            if self._running:
+                self.status_message.emit("Synchronisation wird abgebrochen...")
+                self._worker_thread.cancel()
+        elif self._process.state() != QProcess.NotRunning:
             if sys.platform.startswith('win'):  # pragma: no cover
                 self._process.kill()
             else:
@@ -99,6 +291,24 @@ class SyncScreen(QWidget):
         self.close_requested.emit()
 
     def start_sync(self) -> None:
+        if self._running:
+            # Still finishing the cancelled sync, just show its output again.
+            return
         self._output.setPlainText("")
+        self._buffer = b''
+        self._pending_lines = []
+        self._progress_changed = False
         self._progress.show_empty()
-        self._process.start(sys.executable, self.PYTHON_ARGS)
+        self._sync_progress = SyncProgress()
+        if self._worker_thread is None:
+            self._process.start(sys.executable, self.PYTHON_ARGS)
+            return
+
+        self._running = True
+        self._worker_thread.start_sync()
+        self.on_process_started()
+
+    def shutdown(self) -> None:
+        """Stop the sync worker (if any), closing its connections."""
+        if self._worker_thread is not None:
+            self._worker_thread.stop()
@@ -0,0 +1,152 @@
+"""Running the sync engine in a thread of the GUI process.
+
+This avoids starting a new Python process for every sync, and keeps the
+plugin connections open between syncs, so syncing again is much faster.
+"""
+
+import typing
+import logging
+import threading
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+
+from kitovu import utils
+from kitovu.sync import progress
+
+if typing.TYPE_CHECKING:
+    from kitovu.sync import syncing
+
+
+class SignalReporter(progress.EventReporter):
+
+    """Reports the progress of a sync run as Qt signal."""
+
+    def __init__(self, signal: typing.Any) -> None:
+        super().__init__()
+        self._signal = signal
+
+    def send(self, data: typing.Dict[str, typing.Any]) -> None:
+        self._signal.emit(data)
+
+
+class SignalHandler(logging.Handler):
+
+    """Sends log messages as Qt signal."""
+
+    def __init__(self, signal: typing.Any) -> None:
+        super().__init__()
+        self._signal = signal
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._signal.emit(self.format(record))
+
+
+class SyncWorker(QObject):
+
+    """Runs syncs in a background thread.
+
+    Signals:
+        reported: A progress event (see kitovu.sync.progress) as dict.
+        message: A log message of the sync.
+        finished: The sync is done. Arguments: whether it was successful
+                  (i.e. it neither failed nor was cancelled), and the error message
+                  otherwise.
+    """
+
+    reported = pyqtSignal(dict)
+    message = pyqtSignal(str)
+    finished = pyqtSignal(bool, str)
+
+    def __init__(self, parent: QObject = None) -> None:
+        super().__init__(parent)
+        # Only used from the worker thread.
+        self._session: typing.Optional['syncing.Session'] = None
+        self._cancel = threading.Event()
+
+    @pyqtSlot()
+    def run(self) -> None:
+        """Run a sync with the default configuration."""
+        # Imported here, so the GUI starts quickly.
+        from kitovu.sync import syncing  # pylint: disable=redefined-outer-name
+
+        if self._session is None:
+            self._session = syncing.Session()
+
+        handler = SignalHandler(self.message)
+        handler.setLevel(logging.INFO)
+        logger = logging.getLogger('kitovu')
+        logger.addHandler(handler)
+        old_level = logger.level
+        if logger.getEffectiveLevel() > logging.INFO:
+            logger.setLevel(logging.INFO)
+
+        try:
+            options = syncing.SyncOptions(reporter=SignalReporter(self.reported),
+                                          session=self._session, cancel=self._cancel)
+            syncing.start_all(None, options)
+        except utils.UsageError as ex:
+            self.finished.emit(False, str(ex))
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.exception('Unexpected error while syncing')
+            self.finished.emit(False, f'{type(ex).__name__}: {ex}')
+        else:
+            if options.cancel.is_set():
+                # Like "kitovu sync" when cancelled, this isn't a success.
+                self.finished.emit(False, 'Synchronisation abgebrochen.')
+            else:
+                self.finished.emit(True, '')
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+
+    def cancel(self) -> None:
+        """Stop the running sync after the running downloads.
+
+        This can be called from any thread.
+        """
+        self._cancel.set()
+
+    def reset_cancel(self) -> None:
+        """Allow the next sync to run after a cancelled one."""
+        self._cancel.clear()
+
+    @pyqtSlot()
+    def close(self) -> None:
+        """Disconnect all plugins kept open."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class WorkerThread(QObject):
+
+    """Owns a SyncWorker and the thread it runs in."""
+
+    _run_requested = pyqtSignal()
+    _close_requested = pyqtSignal()
+
+    def __init__(self, parent: QObject = None) -> None:
+        super().__init__(parent)
+        self.worker = SyncWorker()
+        self._thread = QThread()
+        self.worker.moveToThread(self._thread)
+        self._run_requested.connect(self.worker.run)
+        self._close_requested.connect(self.worker.close)
+        self._thread.start()
+
+    def start_sync(self) -> None:
+        self.worker.reset_cancel()
+        self._run_requested.emit()
+
+    def cancel(self) -> None:
+        self.worker.cancel()
+
+    def stop(self) -> None:
+        """Cancel a running sync, disconnect the plugins and stop the thread."""
+        if not self._thread.isRunning():
+            return
+        self.worker.cancel()
+        self._close_requested.emit()
+        self._thread.quit()
+        self._thread.wait()
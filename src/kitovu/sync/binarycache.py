@@ -0,0 +1,161 @@
+"""A compact binary on-disk format for file cache shards.
+
+A file consists of a header, an offset table and the records, all little-endian:
+
+Header:
+    4 bytes  magic (b'KVFC')
+    uint16   format version
+    uint16   length of the plugin name
+    uint32   number of records
+    ...      plugin name (UTF-8)
+
+Offset table:
+    uint32   absolute file offset of each record, in record order
+
+Records (sorted by key):
+    uint16   key length
+    ...      key (UTF-8 path relative to the subject directory)
+    uint16   digest length
+    ...      digest (UTF-8)
+    uint16   length of the content hash information (version 2 only)
+    ...      content hash information (UTF-8, see hashing.HashInfo, may be empty)
+
+As records are sorted and UTF-8 preserves the code point order, a single
+entry can be looked up with a binary search over the memory-mapped file,
+without reading the whole table.
+"""
+
+import mmap
+import struct
+import pathlib
+import typing
+
+from kitovu import utils
+
+
+MAGIC = b'KVFC'
+VERSION = 2
+# Version 1 files don't have the content hash field, but can still be read.
+_READABLE_VERSIONS = [1, 2]
+
+_HEADER = struct.Struct('<4sHHI')
+_OFFSET = struct.Struct('<I')
+_LENGTH = struct.Struct('<H')
+
+
+class FormatError(utils.Error):
+    """Thrown when a binary cache file is invalid."""
+
+
+def write(path: pathlib.Path,
+          plugin_name: str,
+          entries: typing.Iterable[typing.Tuple[str, str, str]]) -> None:
+    """Write the given (key, digest, hashes) entries, which need to be sorted by key."""
+    records = []
+    offset = 0
+    offsets = []
+    for key, digest, hashes in entries:
+        key_bytes = key.encode('utf-8')
+        digest_bytes = digest.encode('utf-8')
+        hashes_bytes = hashes.encode('utf-8')
+        record = b''.join([_LENGTH.pack(len(key_bytes)), key_bytes,
+                           _LENGTH.pack(len(digest_bytes)), digest_bytes,
+                           _LENGTH.pack(len(hashes_bytes)), hashes_bytes])
+        records.append(record)
+        offsets.append(offset)
+        offset += len(record)
+
+    plugin_bytes = plugin_name.encode('utf-8')
+    data_start = _HEADER.size + len(plugin_bytes) + _OFFSET.size * len(offsets)
+
+    with path.open('wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(plugin_bytes), len(records)))
+        f.write(plugin_bytes)
+        f.write(struct.pack(f'<{len(offsets)}I', *(data_start + o for o in offsets)))
+        f.writelines(records)
+
+
+class Table:
+
+    """A read-only, memory-mapped binary cache file."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        with path.open('rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise FormatError(f'{path} is empty')
+
+        try:
+            magic, version, plugin_len, count = _HEADER.unpack_from(self._mmap, 0)
+        except struct.error:
+            self.close()
+            raise FormatError(f'{path} is truncated')
+
+        self._version: int = version
+        self._count: int = count
+        if magic != MAGIC or self._version not in _READABLE_VERSIONS:
+            self.close()
+            raise FormatError(f'{path} has an unknown format or version')
+
+        self.plugin_name: str = self._mmap[_HEADER.size:_HEADER.size + plugin_len].decode('utf-8')
+        self._offsets_start: int = _HEADER.size + plugin_len
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def _offset(self, index: int) -> int:
+        offset: int = _OFFSET.unpack_from(self._mmap, self._offsets_start + index * _OFFSET.size)[0]
+        return offset
+
+    def _read_field(self, offset: int) -> typing.Tuple[bytes, int]:
+        """Read a length-prefixed field, return it and the offset after it."""
+        length: int = _LENGTH.unpack_from(self._mmap, offset)[0]
+        start = offset + _LENGTH.size
+        return self._mmap[start:start + length], start + length
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[str, str]]:
+        """Look up the digest and content hashes for a single key via binary search."""
+        key_bytes = key.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            record_key, offset = self._read_field(self._offset(middle))
+            if record_key < key_bytes:
+                low = middle + 1
+            elif record_key > key_bytes:
+                high = middle
+            else:
+                digest, offset = self._read_field(offset)
+                hashes = b''
+                if self._version >= 2:
+                    hashes, _offset = self._read_field(offset)
+                return digest.decode('utf-8'), hashes.decode('utf-8')
+        return None
+
+    def items(self) -> typing.Iterator[typing.Tuple[str, str, str]]:
+        """Iterate over all (key, digest, hashes) entries in a single sequential pass."""
+        data = self._mmap
+        unpack_length = _LENGTH.unpack_from
+        length_size = _LENGTH.size
+        offset = self._offsets_start + self._count * _OFFSET.size
+        has_hashes = self._version >= 2
+        for _ in range(self._count):
+            key_len = unpack_length(data, offset)[0]
+            offset += length_size
+            key = data[offset:offset + key_len].decode('utf-8')
+            offset += key_len
+            digest_len = unpack_length(data, offset)[0]
+            offset += length_size
+            digest = data[offset:offset + digest_len].decode('utf-8')
+            offset += digest_len
+            hashes = ''
+            if has_hashes:
+                hashes_len = unpack_length(data, offset)[0]
+                offset += length_size
+                hashes = data[offset:offset + hashes_len].decode('utf-8')
+                offset += hashes_len
+            yield key, digest, hashes
@@ -0,0 +1,198 @@
+"""Adapting the number of parallel downloads per connection.
+
+Depending on the network (campus LAN or VPN), a fixed number of parallel
+downloads is either too low to use the available bandwidth, or so high that
+the server starts failing requests. Instead, the number of parallel
+downloads of a connection is adapted with an AIMD (additive increase,
+multiplicative decrease) scheme, like TCP congestion control:
+
+- It starts with a single download.
+- Whenever every slot finished a download, the throughput of that window is
+  compared to the previous one. If it improved, another slot is added.
+- If a download fails (timeouts, server errors, overload), the number of
+  slots is halved.
+
+Plugins which can't be used from several threads at the same time get
+another plugin instance (and thus server connection) per slot.
+"""
+
+import time
+import typing
+import logging
+import threading
+
+from kitovu import utils
+from kitovu.sync.syncplugin import AbstractSyncPlugin
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class AimdController:
+
+    """Decides how many downloads of a connection run in parallel.
+
+    Attributes:
+        limit: The current number of parallel downloads allowed.
+        maximum: The maximum number of parallel downloads.
+        peak: The highest limit reached so far.
+        in_flight: The number of downloads currently running.
+
+    Downloads are started and finished from the same thread, but backoff()
+    can be called from any thread.
+    """
+
+    # How much better the throughput of a window needs to be to add a slot.
+    IMPROVEMENT = 1.1
+
+    def __init__(self, maximum: int,
+                 clock: typing.Callable[[], float] = time.monotonic) -> None:
+        assert maximum >= 1, maximum
+        self.maximum = maximum
+        self.limit = 1
+        self.peak = 1
+        self.in_flight = 0
+        self.files = 0
+        self.errors = 0
+        self.total_bytes = 0
+        self._clock = clock
+        self._first_start: typing.Optional[float] = None
+        self._last_finish: typing.Optional[float] = None
+        self._window_start: typing.Optional[float] = None
+        self._window_bytes = 0
+        self._window_files = 0
+        self._last_throughput: typing.Optional[float] = None
+        self._lock = threading.Lock()
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.limit
+
+    def started(self) -> None:
+        with self._lock:
+            now = self._clock()
+            if self._first_start is None:
+                self._first_start = now
+            if self._window_start is None:
+                self._window_start = now
+            self.in_flight += 1
+
+    def finished(self, size: int) -> None:
+        """Record a successful download of the given size."""
+        with self._lock:
+            self.in_flight -= 1
+            self.files += 1
+            self.total_bytes += size
+            self._window_bytes += size
+            self._window_files += 1
+
+            now = self._clock()
+            self._last_finish = now
+            if self._window_files < self.limit:
+                return
+
+            assert self._window_start is not None
+            throughput = self._window_bytes / max(now - self._window_start, 1e-6)
+            if (self._last_throughput is None or
+                    throughput > self._last_throughput * self.IMPROVEMENT):
+                self._set_limit(self.limit + 1)
+            self._last_throughput = throughput
+            self._reset_window()
+
+    def failed(self) -> None:
+        """Record a failed download, backing off."""
+        with self._lock:
+            self.in_flight -= 1
+            self.errors += 1
+            self._last_finish = self._clock()
+            self._backoff()
+
+    def backoff(self) -> None:
+        """Back off because of an error, e.g. when a download is retried."""
+        with self._lock:
+            self._backoff()
+
+    def _backoff(self) -> None:
+        self._set_limit(self.limit // 2)
+        # The old throughput was measured with more slots, so start over.
+        self._last_throughput = None
+        self._reset_window()
+
+    def cap(self, maximum: int) -> None:
+        """Lower the maximum, e.g. if no more server connections are possible."""
+        with self._lock:
+            self.maximum = max(1, maximum)
+            self._set_limit(self.limit)
+
+    def _set_limit(self, limit: int) -> None:
+        limit = max(1, min(limit, self.maximum))
+        if limit != self.limit:
+            logger.debug('Changing parallel downloads from %d to %d', self.limit, limit)
+        self.limit = limit
+        self.peak = max(self.peak, limit)
+
+    def _reset_window(self) -> None:
+        self._window_start = None if self.in_flight == 0 else self._clock()
+        self._window_bytes = 0
+        self._window_files = 0
+
+    @property
+    def elapsed(self) -> float:
+        if self._first_start is None or self._last_finish is None:
+            return 0.0
+        return self._last_finish - self._first_start
+
+    @property
+    def throughput(self) -> float:
+        """The average throughput over all downloads, in bytes per second."""
+        elapsed = self.elapsed
+        return self.total_bytes / elapsed if elapsed > 0 else 0.0
+
+
+class PluginPool:
+
+    """Plugin instances of a connection, one per running download.
+
+    Plugins with THREAD_SAFE set are shared between all downloads instead.
+    """
+
+    def __init__(self, plugin: AbstractSyncPlugin,
+                 factory: typing.Callable[[], AbstractSyncPlugin]) -> None:
+        self._factory = factory
+        self._plugins = [plugin]
+        self._idle = [plugin]
+
+    def __len__(self) -> int:
+        return len(self._plugins)
+
+    @property
+    def plugin(self) -> AbstractSyncPlugin:
+        """The first plugin instance, which is connected when the pool is created."""
+        return self._plugins[0]
+
+    def acquire(self) -> typing.Optional[AbstractSyncPlugin]:
+        """Get a plugin instance for a download.
+
+        Returns None if no new instance could be connected.
+        """
+        if self._plugins[0].THREAD_SAFE:
+            return self._plugins[0]
+        if self._idle:
+            return self._idle.pop()
+
+        try:
+            plugin = self._factory()
+        except utils.PluginOperationError as ex:
+            logger.warning('Could not open another connection (%s), continuing with %d',
+                           ex, len(self._plugins))
+            return None
+
+        self._plugins.append(plugin)
+        return plugin
+
+    def release(self, plugin: AbstractSyncPlugin) -> None:
+        if not plugin.THREAD_SAFE:
+            self._idle.append(plugin)
+
+    def disconnect(self) -> None:
+        for plugin in self._plugins:
+            plugin.disconnect()
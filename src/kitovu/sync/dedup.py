@@ -0,0 +1,89 @@
+"""Creating local copies of files which were downloaded once already.
+
+The same remote directory is often used by several subjects. Identical
+remote files (same connection, path and digest) are only downloaded once
+per run, and the other copies are created locally, depending on the
+"deduplicate" setting:
+
+copy: Use a reflink (a copy-on-write clone, on file systems supporting it,
+      such as Btrfs or XFS on Linux), or copy the file otherwise.
+hardlink: Use a hardlink if possible. Note that this means changes to one of
+          the copies (e.g. notes added locally) change the others as well.
+off: Download every copy separately.
+"""
+
+import os
+import shutil
+import pathlib
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+METHODS = ['copy', 'hardlink', 'off']
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+def _reflink(source: pathlib.Path, target: pathlib.Path) -> bool:
+    """Try to create a copy-on-write clone of the given file.
+
+    Returns False if the file system (or OS) doesn't support it.
+    """
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        return False
+
+    try:
+        with source.open('rb') as src, target.open('wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except OSError as ex:
+        logger.debug('Could not reflink %s to %s: %s', source, target, ex)
+        return False
+    return True
+
+
+def materialize(source: pathlib.Path, target: pathlib.Path, method: str) -> str:
+    """Create target as a copy of source, with the same mtime.
+
+    Returns how the copy was created: 'hardlink', 'reflink' or 'copy'.
+    """
+    assert method in METHODS and method != 'off', method
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    if method == 'hardlink':
+        # Not target.exists(), as os.link fails for a dangling symlink as well.
+        if os.path.lexists(str(target)):
+            target.unlink()
+        try:
+            os.link(str(source), str(target))
+        except OSError as ex:
+            # e.g. on another file system
+            logger.debug('Could not hardlink %s to %s: %s', source, target, ex)
+        else:
+            return 'hardlink'
+
+    # Like downloads, copies are written to a temporary file first, so an
+    # interrupted copy doesn't leave a half-written file behind.
+    temp_path = target.with_name(f'.{target.name}.kitovu-part')
+    try:
+        if _reflink(source, temp_path):
+            used = 'reflink'
+        else:
+            shutil.copyfile(str(source), str(temp_path))
+            used = 'copy'
+        # The digests of the built-in plugins depend on the mtime.
+        shutil.copystat(str(source), str(temp_path))
+        os.replace(str(temp_path), str(target))
+    except BaseException:
+        try:
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    return used
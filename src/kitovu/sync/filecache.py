@@ -43,18 +43,38 @@ Local file changed
 7. remote file has contents B (remote changed, remote and cached digest differ)
    local file has contents  A' (local changed, local and cached digest differ)
 -> BOTH_CHANGED (conflict!)
+
+Content hashes
+--------------
+
+With the "content-hash" setting, whether the local file changed is decided by
+comparing a hash of its content to the hash at synctime instead (see
+kitovu.sync.hashing). Files whose mtime got touched but whose content is the
+same count as unchanged, and changes keeping the size and mtime are noticed.
 """
 
+import os
+import sys
 import enum
+import time
 import json
+import hashlib
 import pathlib
 import typing
 import logging
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
 
 import appdirs
 import attr
 
-from kitovu.sync import syncplugin
+from kitovu import utils
+from kitovu.sync import syncplugin, binarycache, localindex, hashing
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -71,33 +91,125 @@ class FileState(enum.Enum):
 
 
 def get_path() -> pathlib.Path:
-    return pathlib.Path(appdirs.user_data_dir('kitovu')) / 'filecache.json'
+    return pathlib.Path(appdirs.user_data_dir('kitovu')) / 'filecache'
 
 
-@attr.s
+@attr.s(slots=True)
 class File:
 
+    """A single cache entry.
+
+    This uses __slots__, as there's one instance per synchronized file.
+    """
+
     cached_digest: typing.Optional[str] = attr.ib()  # local digest at synctime
-    plugin_name: str = attr.ib()
+    hashes: typing.Optional[hashing.HashInfo] = attr.ib(default=None)
 
-    def to_dict(self) -> typing.Dict[str, str]:
-        assert self.cached_digest is not None
-        return {"plugin": self.plugin_name,
-                "digest": self.cached_digest}
 
+# (key, digest, serialized hashing.HashInfo or '')
+Entry = typing.Tuple[str, str, str]
 
-class FileCache:
 
-    def __init__(self, filename: pathlib.Path) -> None:
-        self._filename: pathlib.Path = filename
-        self._data: typing.Dict[pathlib.Path, File] = {}
+def _parse_hashes(data: str) -> typing.Optional[hashing.HashInfo]:
+    return hashing.HashInfo.parse(data) if data else None
+
+
+def _compress_keys(keys: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[int, str]]:
+    """Prefix-compress the given (sorted) keys.
+
+    Every key is represented as the length of the prefix it shares with the
+    previous key, and the remaining suffix.
+    """
+    previous = ''
+    for key in keys:
+        prefix_len = len(os.path.commonprefix([previous, key]))
+        yield prefix_len, key[prefix_len:]
+        previous = key
+
+
+def _decompress_keys(
+        compressed: typing.Iterable[typing.Tuple[int, str]]) -> typing.Iterator[str]:
+    """Reverse the compression done by _compress_keys."""
+    previous = ''
+    for prefix_len, suffix in compressed:
+        key = previous[:prefix_len] + suffix
+        yield key
+        previous = key
+
+
+def _compress_entries(entries: typing.List[Entry]) -> typing.List[typing.List[typing.Any]]:
+    """Turn sorted entries into a list of [prefix, suffix, digest(, hashes)]."""
+    compressed = _compress_keys(key for key, _digest, _hashes in entries)
+    result: typing.List[typing.List[typing.Any]] = []
+    for (prefix_len, suffix), (_key, digest, hashes) in zip(compressed, entries):
+        if hashes:
+            result.append([prefix_len, suffix, digest, hashes])
+        else:
+            result.append([prefix_len, suffix, digest])
+    return result
+
+
+class SubjectCache:
+
+    """The cached files of a single subject source of a connection.
+
+    All paths are stored relative to the subject's local directory, so moving
+    the root directory doesn't invalidate the cache.
+    """
+
+    def __init__(self,
+                 root: pathlib.Path,
+                 plugin_name: str,
+                 hash_algorithm: typing.Optional[str] = None) -> None:
+        self.root: pathlib.Path = root
+        self.plugin_name: str = plugin_name
+        # The content hash algorithm, or None to only use the plugin's digests.
+        self.hash_algorithm: typing.Optional[str] = hash_algorithm
+        self._data: typing.Dict[str, File] = {}
+        # A memory-mapped binary shard, with entries which aren't in _data yet.
+        self._table: typing.Optional[binarycache.Table] = None
+        # Whether entries changed since the shard was loaded, i.e. it needs to
+        # be written again.
+        self.changed: bool = False
+
+    def __len__(self) -> int:
+        self.materialize()
+        return len(self._data)
+
+    def set_table(self, table: binarycache.Table) -> None:
+        """Use the given binary table for lookups, without loading all entries."""
+        assert self._table is None
+        self._table = table
+
+    def materialize(self) -> None:
+        """Load all entries from the binary table (if any) into memory."""
+        if self._table is None:
+            return
+        for key, digest, hashes in self._table.items():
+            if key not in self._data:
+                self._data[key] = File(cached_digest=digest, hashes=_parse_hashes(hashes))
+        self._table.close()
+        self._table = None
+
+    def _lookup(self, key: str) -> typing.Optional[File]:
+        file = self._data.get(key)
+        if file is None and self._table is not None:
+            entry = self._table.get(key)
+            if entry is not None:
+                digest, hashes = entry
+                file = File(cached_digest=digest, hashes=_parse_hashes(hashes))
+                self._data[key] = file
+        return file
+
+    def _key(self, path: pathlib.Path) -> str:
+        return path.relative_to(self.root).as_posix()
 
     def _compare_digests(self,
                          remote_digest: str,
                          local_digest: str,
                          cached_digest: typing.Optional[str]) -> FileState:
-        logger.debug(f'Comparing digests: remote {remote_digest}, local {local_digest}, '
-                     f'cached {cached_digest}')
+        logger.debug('Comparing digests: remote %s, local %s, cached %s',
+                     remote_digest, local_digest, cached_digest)
         local_changed: bool = local_digest != cached_digest
         remote_changed: bool = remote_digest != cached_digest
         if not remote_changed and not local_changed:  # case 5 above
@@ -112,75 +224,761 @@ class FileCache:
             raise AssertionError(f"Failed to compare digests! remote: {remote_digest}, "
                                  f"local: {local_digest}, cached {cached_digest}")
 
-    def write(self) -> None:
-        """"Writes the data-dict to JSON."""
-        logger.debug(f"Writing to {self._filename}")
-
-        json_data: typing.Dict[str, typing.Dict[str, str]] = {}
+    def entries(self) -> typing.List[Entry]:
+        """Get all (key, digest, hashes) entries, sorted by key.
 
-        for key, value in self._data.items():
-            json_data[str(key)] = value.to_dict()
+        Entries without a digest (files which failed to download) are skipped.
+        """
+        self.materialize()
+        return sorted((key, file.cached_digest,
+                       '' if file.hashes is None else file.hashes.serialize())
+                      for key, file in self._data.items()
+                      if file.cached_digest is not None)
 
-        self._filename.parent.mkdir(exist_ok=True, parents=True)
-        with self._filename.open("w") as f:
-            json.dump(json_data, f)
+    def items(self) -> typing.List[typing.Tuple[str, File]]:
+        """Get all (key, File) pairs, in no particular order."""
+        self.materialize()
+        return list(self._data.items())
 
-    def load(self) -> None:
-        """This is called first when the synchronisation process is started."""
-        logger.debug(f"Loading from {self._filename}")
+    def compact(self, index: localindex.LocalIndex) -> int:
+        """Drop entries whose local file doesn't exist anymore.
 
-        try:
-            with self._filename.open("r") as f:
-                json_data = json.load(f)
-        except FileNotFoundError:
+        Returns the number of removed entries.
+        """
+        assert index.root == self.root, (index.root, self.root)
+        stale = [key for key in self._data if index.get(key) is None]
+        if self._table is not None:
+            # The entries of a memory-mapped shard are only loaded if some of
+            # them are stale, so an unchanged shard isn't loaded completely.
+            stale_in_table = [key for key, _digest, _hashes in self._table.items()
+                              if key not in self._data and index.get(key) is None]
+            if stale_in_table:
+                self.materialize()
+                stale += stale_in_table
+        for key in stale:
+            del self._data[key]
+        if stale:
+            logger.debug('Removed %d stale entries for %s', len(stale), self.root)
+            self.changed = True
+        return len(stale)
+
+    def update_from_json(self, files: typing.List[typing.List[typing.Any]]) -> None:
+        """Add the entries from a list created by _compress_entries."""
+        keys = _decompress_keys((entry[0], entry[1]) for entry in files)
+        for key, entry in zip(keys, files):
+            hashes = _parse_hashes(entry[3]) if len(entry) > 3 else None
+            self._data[key] = File(cached_digest=entry[2], hashes=hashes)
+
+    def migrate_legacy(self, legacy: typing.Dict[str, typing.Dict[str, str]]) -> None:
+        """Move entries belonging to this subject out of a version 1 cache."""
+        if not legacy:
             return
 
-        for key, value in json_data.items():
-            digest: str = value["digest"]
-            plugin_name: str = value["plugin"]
-            self._data[pathlib.Path(key)] = File(cached_digest=digest, plugin_name=plugin_name)
+        root = str(self.root) + os.sep
+        for path in [path for path in legacy if path.startswith(root)]:
+            if legacy[path]['plugin'] != self.plugin_name:
+                continue
+            key = pathlib.PurePath(path[len(root):]).as_posix()
+            self._data[key] = File(cached_digest=legacy.pop(path)['digest'])
+            self.changed = True
 
     def modify(self,
                path: pathlib.Path,
                plugin: syncplugin.AbstractSyncPlugin,
-               local_digest_at_synctime: str) -> None:
-        logger.debug(f"Modifying cached digest for {path} by {plugin}: {local_digest_at_synctime}")
-        assert plugin.NAME is not None
-        file = File(cached_digest=local_digest_at_synctime, plugin_name=plugin.NAME)
-        self._data[path] = file
+               local_digest_at_synctime: str,
+               content_hash: typing.Optional[str] = None,
+               stat: typing.Optional[os.stat_result] = None) -> None:
+        """Update the cached digest of a file which was just synchronized.
+
+        If content hashes are used, the hash of the written content and the
+        stat information of the file should be given as well.
+        """
+        logger.debug('Modifying cached digest for %s by %s: %s',
+                     path, plugin, local_digest_at_synctime)
+        assert plugin.NAME == self.plugin_name, plugin.NAME
+        hashes = None
+        if content_hash is not None:
+            assert stat is not None, path
+            hashes = hashing.HashInfo(synced=content_hash, current=content_hash,
+                                      signature=hashing.signature(stat))
+        self._data[self._key(path)] = File(cached_digest=local_digest_at_synctime,
+                                           hashes=hashes)
+        self.changed = True
+
+    def _hash_is_current(self, file: File, signature: hashing.Signature) -> bool:
+        assert self.hash_algorithm is not None
+        return (file.hashes is not None and file.hashes.signature == signature and
+                file.hashes.current.startswith(self.hash_algorithm + '-'))
+
+    def _set_current_hash(self, file: File, content_hash: str, signature: hashing.Signature) -> None:
+        self.changed = True
+        if file.hashes is None:
+            # No hash from synctime known yet, see _local_digest_from_hash.
+            file.hashes = hashing.HashInfo(synced='', current=content_hash, signature=signature)
+        else:
+            file.hashes.current = content_hash
+            file.hashes.signature = signature
+
+    def update_hashes(self, index: localindex.LocalIndex, jobs: typing.Optional[int] = None) -> int:
+        """Hash all cached local files whose stat signature changed, in parallel.
+
+        This is done for a whole subject up front, so discover_changes() finds
+        the hashes cached. Returns the number of files hashed.
+        """
+        assert self.hash_algorithm is not None
+        assert index.root == self.root, (index.root, self.root)
+
+        outdated: typing.Dict[pathlib.Path, typing.Tuple[File, hashing.Signature]] = {}
+        for key in index:
+            file = self._lookup(key)
+            if file is None or file.cached_digest is None:
+                continue
+            stat = index.get(key)
+            if stat is None:
+                # The file is missing, so there is nothing to hash.
+                continue
+            signature = hashing.signature(stat)
+            if not self._hash_is_current(file, signature):
+                outdated[self.root / key] = (file, signature)
+
+        if not outdated:
+            return 0
+
+        logger.debug('Hashing %d files in %s', len(outdated), self.root)
+        results = hashing.hash_files(outdated, self.hash_algorithm, jobs=jobs)
+        for path, content_hash in results.items():
+            file, signature = outdated[path]
+            self._set_current_hash(file, content_hash, signature)
+        return len(results)
+
+    def _local_digest_from_hash(self,
+                                file: File,
+                                local_full_path: pathlib.Path,
+                                stat: os.stat_result,
+                                local_digest: str) -> str:
+        """Get the local digest to compare, based on the content hash of the file.
+
+        This is the cached digest if the content didn't change since synctime
+        (even if the plugin's digest did), and the content hash otherwise.
+        """
+        assert self.hash_algorithm is not None
+        signature = hashing.signature(stat)
+        if not self._hash_is_current(file, signature):
+            self._set_current_hash(file, hashing.hash_file(local_full_path, self.hash_algorithm),
+                                   signature)
+
+        assert file.hashes is not None
+        if not file.hashes.synced.startswith(self.hash_algorithm + '-'):
+            # No (usable) hash from synctime, e.g. because content hashes were
+            # just enabled. Fall back to the plugin's digest, and use the
+            # current hash from now on if the file is unchanged.
+            if local_digest == file.cached_digest:
+                file.hashes.synced = file.hashes.current
+                self.changed = True
+            return local_digest
+
+        if file.hashes.current == file.hashes.synced and file.cached_digest is not None:
+            return file.cached_digest
+        return file.hashes.current
 
     def discover_changes(self,
                          local_full_path: pathlib.Path,
                          remote_full_path: pathlib.PurePath,
-                         plugin: syncplugin.AbstractSyncPlugin) -> FileState:
+                         plugin: syncplugin.AbstractSyncPlugin,
+                         index: typing.Optional[localindex.LocalIndex] = None,
+                         remote_digest: typing.Optional[str] = None) -> FileState:
         """Check if the file that is currently downloaded (path-argument) has changed.
 
         Change is discovered between local file cache and local file.
+
+        If an index of the local directory is given, it's used instead of
+        accessing the local file. If the remote digest is given, the plugin
+        isn't asked for it again.
         """
-        logger.debug(f"Discovering changes for local: {local_full_path} / "
-                     f"remote: {remote_full_path} by plugin {plugin.NAME}")
-        if not local_full_path.exists():
-            logger.debug(f"Local path does not exist!")
-            return FileState.NEW
+        logger.debug('Discovering changes for local: %s / remote: %s by plugin %s',
+                     local_full_path, remote_full_path, plugin.NAME)
+        key = self._key(local_full_path)
 
-        if local_full_path not in self._data:
-            assert plugin.NAME is not None
-            self._data[local_full_path] = File(cached_digest=None, plugin_name=plugin.NAME)
+        stat: typing.Optional[os.stat_result] = None
+        if index is None:
+            exists = local_full_path.exists()
+        else:
+            assert index.root == self.root, (index.root, self.root)
+            stat = index.get(key)
+            exists = stat is not None
 
-        file: File = self._data[local_full_path]
+        if not exists:
+            logger.debug('Local path does not exist!')
+            return FileState.NEW
 
-        if plugin.NAME != file.plugin_name:
-            raise AssertionError(f"The cached plugin name '{file.plugin_name}' of the file "
+        if plugin.NAME != self.plugin_name:
+            raise AssertionError(f"The cached plugin name '{self.plugin_name}' of the file "
                                  f"{local_full_path} doesn't match the plugin name "
                                  f"'{plugin.NAME}'.")
 
-        remote_digest: str = plugin.create_remote_digest(remote_full_path)
-        local_digest: str = plugin.create_local_digest(local_full_path)
+        file = self._lookup(key)
+        if file is None:
+            file = File(cached_digest=None)
+            self._data[key] = file
+
+        if remote_digest is None:
+            remote_digest = plugin.create_remote_digest(remote_full_path)
+        if stat is None:
+            local_digest: str = plugin.create_local_digest(local_full_path)
+        else:
+            local_digest = plugin.create_local_digest_from_stat(local_full_path, stat)
 
         # If both the remote and local files are updated but the cache didn't realize it.
         # remote = B, local = B, cache A => update the cache to B
         # eg. Downloaded the file not via kitovu
         if remote_digest == local_digest and file.cached_digest != remote_digest:
             file.cached_digest = remote_digest
+            self.changed = True
+
+        if self.hash_algorithm is not None:
+            if stat is None:
+                stat = local_full_path.stat()
+            local_digest = self._local_digest_from_hash(file, local_full_path, stat, local_digest)
 
         return self._compare_digests(remote_digest, local_digest, file.cached_digest)
+
+
+def _read_json(path: pathlib.Path) -> typing.Any:
+    with path.open('r') as f:
+        return json.load(f)
+
+
+def _write_atomic(path: pathlib.Path, writer: typing.Callable[[pathlib.Path], None]) -> None:
+    """Write a file atomically, so a crash never leaves a half-written file.
+
+    The temporary file has a unique name, so concurrent writers don't use the
+    same one.
+    """
+    fd, temp_name = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.', suffix='.tmp')
+    os.close(fd)
+    temp_path = pathlib.Path(temp_name)
+    try:
+        writer(temp_path)
+        os.replace(str(temp_path), str(path))
+    except BaseException:
+        try:
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@contextlib.contextmanager
+def _locked(path: pathlib.Path) -> typing.Iterator[None]:
+    """Hold an exclusive lock on the given file, waiting for other processes.
+
+    Without fcntl (i.e. on Windows), nothing is locked.
+    """
+    with path.open('ab') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _write_json(path: pathlib.Path, data: typing.Any) -> None:
+    def writer(temp_path: pathlib.Path) -> None:
+        with temp_path.open('w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    _write_atomic(path, writer)
+
+
+SubjectKey = typing.Tuple[str, str, str]
+
+
+def subject_key(connection: str, name: str, remote_dir: pathlib.PurePath) -> SubjectKey:
+    return (connection, name, remote_dir.as_posix())
+
+
+@attr.s
+class GcResult:
+
+    """What a garbage collection removed from the file cache."""
+
+    entries: int = attr.ib(default=0)
+    shards: int = attr.ib(default=0)
+    reclaimed_bytes: int = attr.ib(default=0)
+
+
+@attr.s
+class ShardInfo:
+
+    """Manifest entry of a subject cache stored in its own file."""
+
+    connection: str = attr.ib()
+    subject: str = attr.ib()
+    remote_dir: str = attr.ib()
+    plugin: str = attr.ib()
+    filename: str = attr.ib()
+    entries: int = attr.ib()
+
+    @property
+    def key(self) -> SubjectKey:
+        return (self.connection, self.subject, self.remote_dir)
+
+    def to_dict(self) -> utils.JsonType:
+        return {
+            'connection': self.connection,
+            'subject': self.subject,
+            'remote-dir': self.remote_dir,
+            'plugin': self.plugin,
+            'file': self.filename,
+            'entries': self.entries,
+        }
+
+    @classmethod
+    def from_dict(cls, data: utils.JsonType) -> 'ShardInfo':
+        return cls(connection=data['connection'], subject=data['subject'],
+                   remote_dir=data['remote-dir'], plugin=data['plugin'],
+                   filename=data['file'], entries=data['entries'])
+
+
+class FileCache:
+
+    """All cached files, sharded by connection and subject.
+
+    The cache is a directory with a manifest.json, listing all shards::
+
+        {
+          "version": 3,
+          "shards": [
+            {
+              "connection": "skripte",
+              "subject": "EPJ",
+              "remote-dir": "Informatik/Fachbereich/EPJ",
+              "plugin": "smb",
+              "file": "3f7a1c0d5e2b9a84.json",
+              "entries": 2
+            }
+          ]
+        }
+
+    Every shard contains the files of one subject source::
+
+        {
+          "version": 3,
+          "plugin": "smb",
+          "files": [[0, "Dokumente/Anleitung.pdf", "1024-1520000000"],
+                    [10, "Vorlage.docx", "2048-1520000000"]]
+        }
+
+    The paths in "files" are relative to the local directory of the subject,
+    and prefix-compressed (see _compress_keys). With content hashes enabled,
+    entries have a serialized hashing.HashInfo as fourth element.
+
+    Only the manifest is read by load(); shards are read when the subject is
+    first accessed, and only changed shards are written again.
+
+    With the "binary" format, shards are instead written in the format
+    described in kitovu.sync.binarycache. Those are memory-mapped when loaded,
+    so single entries can be looked up without reading the whole shard.
+    Either format can be read, independently of the one used for writing.
+
+    Caches written by older kitovu versions (a single filecache.json next to
+    the directory) are migrated on the first load. Entries of the oldest
+    format (a flat mapping of absolute paths to digests) are kept in
+    legacy.json until a subject they belong to is accessed.
+    """
+
+    VERSION = 3
+    FORMATS = ['json', 'binary']
+
+    def __init__(self,
+                 directory: pathlib.Path,
+                 fmt: str = 'json',
+                 hash_algorithm: typing.Optional[str] = None) -> None:
+        assert fmt in self.FORMATS, fmt
+        assert hash_algorithm is None or hash_algorithm in hashing.ALGORITHMS, hash_algorithm
+        self._format: str = fmt
+        self._hash_algorithm: typing.Optional[str] = hash_algorithm
+        self._directory: pathlib.Path = directory
+        self._manifest_filename: pathlib.Path = directory / 'manifest.json'
+        self._legacy_filename: pathlib.Path = directory / 'legacy.json'
+        self._old_filename: pathlib.Path = directory.with_suffix('.json')
+        self._lock_filename: pathlib.Path = directory.with_suffix('.lock')
+
+        self._shards: typing.Dict[SubjectKey, ShardInfo] = {}
+        self._subjects: typing.Dict[SubjectKey, SubjectCache] = {}
+
+        # Loaded lazily, None if not loaded yet.
+        self._legacy: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None
+        self._legacy_changed: bool = False
+        self._migrated_old: bool = False
+        # Shards of subjects removed by remove_unconfigured()
+        self._removed: typing.Set[SubjectKey] = set()
+
+    def subject(self,
+                connection: str,
+                name: str,
+                remote_dir: pathlib.PurePath,
+                local_dir: pathlib.Path,
+                plugin_name: str) -> SubjectCache:
+        """Get the cache for the given subject source, loading it if needed.
+
+        Subjects are identified by the connection name, subject name and remote
+        directory, so a changed local directory (e.g. a moved root-dir) keeps
+        the cached data.
+        """
+        key = subject_key(connection, name, remote_dir)
+        subject_cache = self._subjects.get(key)
+
+        if subject_cache is not None:
+            subject_cache.root = local_dir
+        elif key in self._shards:
+            subject_cache = self._load_shard(self._shards[key], local_dir)
+        else:
+            subject_cache = SubjectCache(local_dir, sys.intern(plugin_name))
+            self._migrate_legacy(subject_cache)
+
+        subject_cache.hash_algorithm = self._hash_algorithm
+        self._subjects[key] = subject_cache
+        self._removed.discard(key)
+        return subject_cache
+
+    def _load_shard(self, info: ShardInfo, local_dir: pathlib.Path) -> SubjectCache:
+        path = self._directory / info.filename
+        logger.debug('Loading shard %s', path)
+        subject_cache = SubjectCache(local_dir, sys.intern(info.plugin))
+        try:
+            if path.suffix == '.bin':
+                subject_cache.set_table(binarycache.Table(path))
+            else:
+                subject_cache.update_from_json(_read_json(path)['files'])
+        except FileNotFoundError:
+            logger.warning('File cache shard %s is missing', path)
+        except binarycache.FormatError as ex:
+            logger.warning('Ignoring invalid file cache shard: %s', ex)
+        return subject_cache
+
+    def _load_legacy(self) -> None:
+        if self._legacy is None:
+            try:
+                self._legacy = _read_json(self._legacy_filename)
+            except FileNotFoundError:
+                self._legacy = {}
+
+    def _migrate_legacy(self, subject_cache: SubjectCache) -> None:
+        self._load_legacy()
+        assert self._legacy is not None
+        count = len(self._legacy)
+        subject_cache.migrate_legacy(self._legacy)
+        if len(self._legacy) != count:
+            self._legacy_changed = True
+
+    def _shard_filename(self, key: SubjectKey) -> str:
+        extension = '.bin' if self._format == 'binary' else '.json'
+        return hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()[:16] + extension
+
+    def _write_shard(self,
+                     path: pathlib.Path,
+                     plugin_name: str,
+                     entries: typing.List[Entry]) -> None:
+        if self._format == 'binary':
+            _write_atomic(path, lambda temp_path: binarycache.write(
+                temp_path, plugin_name, entries))
+        else:
+            _write_json(path, {
+                'version': self.VERSION,
+                'plugin': plugin_name,
+                'files': _compress_entries(entries),
+            })
+
+    def write(self) -> None:
+        """Write all changed shards and update the manifest.
+
+        Other kitovu processes writing the cache at the same time wait for
+        this to finish, so no process loses the shards written by another.
+        """
+        logger.debug('Writing to %s', self._directory)
+        self._directory.mkdir(exist_ok=True, parents=True)
+        with _locked(self._lock_filename):
+            self._write_locked()
+
+    def _write_locked(self) -> None:
+        # Re-read the manifest, in case another kitovu process updated other shards.
+        self._read_manifest()
+
+        for key in self._removed:
+            info = self._shards.pop(key, None)
+            if info is not None:
+                path = self._directory / info.filename
+                if path.exists():
+                    path.unlink()
+        self._removed.clear()
+
+        for key, subject_cache in self._subjects.items():
+            filename = self._shard_filename(key)
+            path = self._directory / filename
+
+            old_info = self._shards.get(key)
+            if (not subject_cache.changed and old_info is not None and
+                    old_info.filename == filename):
+                # Unchanged, and already in the format to write.
+                continue
+
+            entries = subject_cache.entries()  # also closes a memory-mapped shard
+            subject_cache.changed = False
+
+            self._shards.pop(key, None)
+            if old_info is not None and old_info.filename != filename:
+                # Written with another format before
+                old_path = self._directory / old_info.filename
+                if old_path.exists():
+                    old_path.unlink()
+
+            if not entries:
+                if path.exists():
+                    path.unlink()
+                continue
+
+            self._write_shard(path, subject_cache.plugin_name, entries)
+            connection, name, remote_dir = key
+            self._shards[key] = ShardInfo(connection=connection, subject=name,
+                                          remote_dir=remote_dir,
+                                          plugin=subject_cache.plugin_name,
+                                          filename=filename, entries=len(entries))
+
+        _write_json(self._manifest_filename, {
+            'version': self.VERSION,
+            'shards': [info.to_dict() for _key, info in sorted(self._shards.items())],
+        })
+
+        if self._legacy_changed:
+            assert self._legacy is not None
+            if self._legacy:
+                _write_json(self._legacy_filename, self._legacy)
+            elif self._legacy_filename.exists():
+                self._legacy_filename.unlink()
+            self._legacy_changed = False
+
+        if self._migrated_old:
+            try:
+                self._old_filename.unlink()
+            except FileNotFoundError:
+                # Already migrated by another FileCache instance or process
+                pass
+            self._migrated_old = False
+
+    def remove_unconfigured(self,
+                            configured: typing.Set[SubjectKey],
+                            legacy: bool = False) -> GcResult:
+        """Remove all subjects which aren't in the given set.
+
+        If legacy is True, entries of the oldest cache format which weren't
+        migrated yet are removed as well. That's only correct after all
+        configured subjects were accessed via subject().
+
+        The files are only removed by the next write().
+        """
+        result = GcResult()
+        for key, info in self._shards.items():
+            if key not in configured and key not in self._subjects:
+                self._removed.add(key)
+                result.shards += 1
+                result.entries += info.entries
+
+        for key in [key for key in self._subjects if key not in configured]:
+            subject_cache = self._subjects.pop(key)
+            if key in self._shards:
+                self._removed.add(key)
+                result.shards += 1
+            result.entries += len(subject_cache)
+
+        if legacy:
+            self._load_legacy()
+            assert self._legacy is not None
+            if self._legacy:
+                result.entries += len(self._legacy)
+                self._legacy.clear()
+                self._legacy_changed = True
+
+        return result
+
+    def disk_usage(self) -> int:
+        """Get the size of all files in the cache directory, in bytes."""
+        try:
+            return sum(entry.stat().st_size for entry in os.scandir(str(self._directory))
+                       if entry.is_file())
+        except FileNotFoundError:
+            return 0
+
+    def _read_manifest(self) -> bool:
+        """Read the manifest, return False if there is none."""
+        try:
+            manifest = _read_json(self._manifest_filename)
+        except FileNotFoundError:
+            return False
+
+        for entry in manifest['shards']:
+            info = ShardInfo.from_dict(entry)
+            self._shards[info.key] = info
+        return True
+
+    def load(self) -> None:
+        """This is called first when the synchronisation process is started.
+
+        Only the manifest is read here, shards are read by subject().
+        """
+        logger.debug('Loading from %s', self._manifest_filename)
+        if not self._read_manifest():
+            self._load_old()
+
+    def _load_old(self) -> None:
+        """Load a cache written as a single JSON file by an older kitovu version."""
+        try:
+            json_data = _read_json(self._old_filename)
+        except FileNotFoundError:
+            return
+
+        logger.info('Migrating file cache %s to %s', self._old_filename, self._directory)
+        self._migrated_old = True
+        self._legacy_changed = True
+
+        if 'version' not in json_data:
+            self._legacy = json_data
+            return
+
+        self._legacy = json_data.get('legacy', {})
+        self._add_subjects_from_json(json_data['subjects'])
+
+    def _add_subjects_from_json(self, subjects: typing.List[utils.JsonType]) -> None:
+        for entry in subjects:
+            subject_cache = SubjectCache(pathlib.Path(), sys.intern(entry['plugin']),
+                                         self._hash_algorithm)
+            subject_cache.update_from_json(entry['files'])
+            subject_cache.changed = True
+            key = (entry['connection'], entry['subject'], entry['remote-dir'])
+            old_subject_cache = self._subjects.get(key)
+            if old_subject_cache is not None:
+                subject_cache.root = old_subject_cache.root
+            self._subjects[key] = subject_cache
+            self._removed.discard(key)
+
+    def subjects(self) -> typing.Iterator[typing.Tuple[SubjectKey, SubjectCache]]:
+        """Iterate over all subjects in the cache, sorted by key.
+
+        Shards which weren't accessed via subject() yet are loaded, with an
+        empty root path.
+        """
+        for key in sorted(set(self._shards) | set(self._subjects)):
+            subject_cache = self._subjects.get(key)
+            if subject_cache is None:
+                subject_cache = self._load_shard(self._shards[key], pathlib.Path())
+            yield key, subject_cache
+
+    def shard_infos(self) -> typing.List[ShardInfo]:
+        """Get the manifest entries of all shards, sorted by key."""
+        return [info for _key, info in sorted(self._shards.items())]
+
+    def shard_size(self, key: SubjectKey) -> int:
+        """Get the size of the given subject's shard on disk, in bytes."""
+        info = self._shards.get(key)
+        if info is None:
+            return 0
+        try:
+            return (self._directory / info.filename).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def export_data(self) -> utils.JsonType:
+        """Get all subjects as a single JSON document, e.g. to move them to another machine."""
+        subjects = []
+        for (connection, name, remote_dir), subject_cache in self.subjects():
+            subjects.append({
+                'connection': connection,
+                'subject': name,
+                'remote-dir': remote_dir,
+                'plugin': subject_cache.plugin_name,
+                'files': _compress_entries(subject_cache.entries()),
+            })
+        return {'version': self.VERSION, 'subjects': subjects}
+
+    def import_data(self, data: utils.JsonType) -> int:
+        """Import subjects from a document created by export_data().
+
+        Subjects in the document replace the ones in the cache, others are
+        kept. Returns the number of imported subjects.
+        """
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            raise utils.UsageError('Unknown file cache export format')
+        try:
+            self._add_subjects_from_json(data['subjects'])
+        except (KeyError, TypeError, IndexError) as ex:
+            raise utils.UsageError(f'Invalid file cache export: {ex!r}')
+        return len(data['subjects'])
+
+
+@attr.s
+class SubjectStats:
+
+    """Statistics about the cached files of a single subject source."""
+
+    connection: str = attr.ib()
+    subject: str = attr.ib()
+    remote_dir: str = attr.ib()
+    plugin: str = attr.ib()
+    entries: int = attr.ib()
+    size: int = attr.ib()
+
+
+@attr.s
+class CacheStats:
+
+    """Statistics about the whole file cache."""
+
+    subjects: typing.List[SubjectStats] = attr.ib()
+    size: int = attr.ib()
+    load_time: float = attr.ib()  # seconds to read the manifest and all shards
+
+    def entries_per_plugin(self) -> typing.Dict[str, int]:
+        result: typing.Dict[str, int] = {}
+        for subject in self.subjects:
+            result[subject.plugin] = result.get(subject.plugin, 0) + subject.entries
+        return result
+
+
+def stats(directory: typing.Optional[pathlib.Path] = None) -> CacheStats:
+    """Load the complete file cache and gather statistics about it."""
+    cache = FileCache(get_path() if directory is None else directory)
+
+    start = time.perf_counter()
+    cache.load()
+    subjects = [(key, subject_cache, len(subject_cache))
+                for key, subject_cache in cache.subjects()]
+    load_time = time.perf_counter() - start
+
+    subject_stats = [SubjectStats(connection=connection, subject=name, remote_dir=remote_dir,
+                                  plugin=subject_cache.plugin_name, entries=entries,
+                                  size=cache.shard_size((connection, name, remote_dir)))
+                     for (connection, name, remote_dir), subject_cache, entries in subjects]
+    return CacheStats(subjects=subject_stats, size=cache.disk_usage(), load_time=load_time)
+
+
+def manifest_stats(directory: typing.Optional[pathlib.Path] = None) -> CacheStats:
+    """Gather statistics about the file cache, only reading its manifest.
+
+    Unlike stats(), no shards are loaded, so this is cheap enough to do after
+    every sync. The entries are counted when a shard is written, so
+    subjects of a cache in an older format (which wasn't written since) are
+    missing.
+    """
+    cache = FileCache(get_path() if directory is None else directory)
+
+    start = time.perf_counter()
+    cache.load()
+    load_time = time.perf_counter() - start
+
+    subject_stats = [SubjectStats(connection=info.connection, subject=info.subject,
+                                  remote_dir=info.remote_dir, plugin=info.plugin,
+                                  entries=info.entries, size=cache.shard_size(info.key))
+                     for info in cache.shard_infos()]
+    return CacheStats(subjects=subject_stats, size=cache.disk_usage(), load_time=load_time)
@@ -0,0 +1,137 @@
+"""Content hashes of local files.
+
+The digests of the built-in plugins are based on the file size and mtime,
+which misses changes keeping both and reports changes when only the mtime
+got touched. With the "content-hash" setting, kitovu additionally hashes
+local files to find out whether they really changed since they were
+synchronized.
+
+To avoid hashing a file on every run, hashes are stored in the file cache
+together with the stat signature (inode, size, mtime in ns) they belong to,
+and files are only hashed again when the signature changes.
+"""
+
+import os
+import mmap
+import typing
+import hashlib
+import pathlib
+import logging
+import concurrent.futures
+
+import attr
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+ALGORITHMS = ['sha256', 'blake2b']
+
+_CHUNK_SIZE = 1024 * 1024
+# Bigger files are memory-mapped rather than read in chunks.
+_MMAP_THRESHOLD = 64 * 1024 * 1024
+_MMAP_CHUNK_SIZE = 16 * 1024 * 1024
+
+Signature = typing.Tuple[int, int, int]
+
+
+def signature(stat: os.stat_result) -> Signature:
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+@attr.s(slots=True)
+class HashInfo:
+
+    """Content hashes stored for a cached file.
+
+    synced: The hash of the file at synchronization time.
+    current: The hash of the local file with the given stat signature.
+
+    Hashes are prefixed with the algorithm, so changing the configured
+    algorithm doesn't lead to wrong comparisons.
+    """
+
+    synced: str = attr.ib()
+    current: str = attr.ib()
+    signature: Signature = attr.ib()
+
+    def serialize(self) -> str:
+        inode, size, mtime_ns = self.signature
+        return f'{inode}:{size}:{mtime_ns}:{self.synced}:{self.current}'
+
+    @classmethod
+    def parse(cls, data: str) -> 'HashInfo':
+        inode, size, mtime_ns, synced, current = data.split(':')
+        return cls(synced=synced, current=current,
+                   signature=(int(inode), int(size), int(mtime_ns)))
+
+
+def _new_hash(algorithm: str) -> typing.Any:
+    assert algorithm in ALGORITHMS, algorithm
+    return hashlib.new(algorithm)
+
+
+def _format(algorithm: str, hasher: typing.Any) -> str:
+    return f'{algorithm}-{hasher.hexdigest()}'
+
+
+def hash_file(path: pathlib.Path, algorithm: str) -> str:
+    """Hash the content of the given file.
+
+    hashlib releases the GIL while hashing big chunks, so this can run in
+    several threads in parallel.
+    """
+    hasher = _new_hash(algorithm)
+    with path.open('rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size and size >= _MMAP_THRESHOLD:  # empty files can't be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, _MMAP_CHUNK_SIZE):
+                        hasher.update(view[offset:offset + _MMAP_CHUNK_SIZE])
+                finally:
+                    view.release()
+        else:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+    return _format(algorithm, hasher)
+
+
+def hash_files(paths: typing.Iterable[pathlib.Path],
+               algorithm: str,
+               jobs: typing.Optional[int] = None) -> typing.Dict[pathlib.Path, str]:
+    """Hash the given files in a thread pool.
+
+    Files which can't be read are left out of the result.
+    """
+    results: typing.Dict[pathlib.Path, str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(hash_file, path, algorithm): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except OSError as ex:
+                logger.warning('Could not hash %s: %s', path, ex)
+    return results
+
+
+class HashingWriter:
+
+    """A file-like object, hashing data while writing it to another file."""
+
+    def __init__(self, fileobj: typing.IO[bytes], algorithm: str) -> None:
+        self._fileobj = fileobj
+        self._algorithm = algorithm
+        self._hasher = _new_hash(algorithm)
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._fileobj, name)
+
+    def write(self, data: bytes) -> int:
+        self._hasher.update(data)
+        return self._fileobj.write(data)
+
+    def content_hash(self) -> str:
+        return _format(self._algorithm, self._hasher)
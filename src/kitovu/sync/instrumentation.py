@@ -0,0 +1,266 @@
+"""Timing and counting what a sync run spends its time on.
+
+With "kitovu sync --stats", every plugin hook call, the loading and writing
+of the file cache and the phases of a run are timed, and a summary table is
+shown afterwards. Plugins are wrapped in an InstrumentedPlugin, so this works
+for any plugin (including third-party ones) without changes to it.
+
+Operations are named "<plugin>.<hook>" (e.g. "smb.retrieve_file") for plugin
+hooks, and "filecache.load", "filecache.write", "localindex.scan",
+"sync.plan" and "sync.download" for the phases of a run. Durations are
+collected in a histogram with fixed buckets (in seconds), so many calls don't
+need more memory.
+"""
+
+import os
+import time
+import math
+import typing
+import pathlib
+import threading
+import contextlib
+
+import attr
+
+from kitovu import utils
+from kitovu.sync import planning
+from kitovu.sync.syncplugin import AbstractSyncPlugin
+
+
+# Upper bounds of the histogram buckets, in seconds. Durations above the last
+# one fall into an additional, unbounded bucket.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@attr.s
+class Operation:
+
+    """Counters of one kind of operation.
+
+    bucket_counts has one entry per bucket in BUCKETS, plus one for longer
+    durations. Failed calls (which raised an exception) are counted in calls
+    and errors.
+    """
+
+    calls: int = attr.ib(default=0)
+    errors: int = attr.ib(default=0)
+    seconds: float = attr.ib(default=0.0)
+    max_seconds: float = attr.ib(default=0.0)
+    transferred: int = attr.ib(default=0)
+    bucket_counts: typing.List[int] = attr.ib(default=attr.Factory(lambda: [0] * (len(BUCKETS) + 1)))
+
+    def record(self, seconds: float, failed: bool) -> None:
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+        else:
+            self.bucket_counts[-1] += 1
+
+    def quantile(self, fraction: float) -> float:
+        """Estimate a quantile of the durations, as the bound of its bucket.
+
+        For the unbounded bucket, the maximum duration is used instead.
+        """
+        if not self.calls:
+            return 0.0
+        rank = max(math.ceil(fraction * self.calls), 1)
+        seen = 0
+        for bound, count in zip(BUCKETS, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+    def to_json(self) -> utils.JsonType:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 6),
+            'max-seconds': round(self.max_seconds, 6),
+            'bytes': self.transferred,
+            'buckets': list(BUCKETS),
+            'bucket-counts': list(self.bucket_counts),
+        }
+
+
+class Stats:
+
+    """The operations of a sync run, by name.
+
+    This is thread-safe, as downloads run in parallel.
+    """
+
+    def __init__(self, clock: typing.Callable[[], float] = time.perf_counter) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._operations: typing.Dict[str, Operation] = {}
+
+    def __getitem__(self, name: str) -> Operation:
+        return self._operations[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._operations
+
+    def _operation(self, name: str) -> Operation:
+        if name not in self._operations:
+            self._operations[name] = Operation()
+        return self._operations[name]
+
+    def record(self, name: str, seconds: float, failed: bool = False) -> None:
+        with self._lock:
+            self._operation(name).record(seconds, failed)
+
+    def add_bytes(self, name: str, size: int) -> None:
+        with self._lock:
+            self._operation(name).transferred += size
+
+    @contextlib.contextmanager
+    def time(self, name: str) -> typing.Iterator[None]:
+        """Time the code in the with-block as the given operation."""
+        start = self._clock()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(name, self._clock() - start, failed)
+
+    def operations(self) -> typing.List[typing.Tuple[str, Operation]]:
+        with self._lock:
+            return [(name, attr.evolve(operation, bucket_counts=list(operation.bucket_counts)))
+                    for name, operation in sorted(self._operations.items())]
+
+    def to_json(self) -> utils.JsonType:
+        return {
+            'version': 1,
+            'operations': {name: operation.to_json() for name, operation in self.operations()},
+        }
+
+    def format_text(self) -> str:
+        """Format the operations as table, with durations in milliseconds."""
+        rows = [('Operation', 'Calls', 'Errors', 'Total ms', 'Mean ms', 'p95 ms', 'Max ms', 'Bytes')]
+        for name, operation in self.operations():
+            mean = operation.seconds / operation.calls if operation.calls else 0.0
+            rows.append((
+                name,
+                str(operation.calls),
+                str(operation.errors),
+                f'{operation.seconds * 1000:.1f}',
+                f'{mean * 1000:.1f}',
+                f'{operation.quantile(0.95) * 1000:.1f}',
+                f'{operation.max_seconds * 1000:.1f}',
+                planning.format_size(operation.transferred) if operation.transferred else '',
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = []
+        for row in rows:
+            cells = [row[0].ljust(widths[0])]
+            cells += [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            lines.append('  '.join(cells).rstrip())
+        return '\n'.join(lines)
+
+
+def timed(stats: typing.Optional[Stats], name: str) -> typing.ContextManager[None]:
+    """Time the operation if stats are collected, or do nothing otherwise."""
+    if stats is None:
+        return _untimed()
+    return stats.time(name)
+
+
+@contextlib.contextmanager
+def _untimed() -> typing.Iterator[None]:
+    yield
+
+
+class _CountingWriter:
+
+    """A file-like object, counting the bytes written to another file."""
+
+    def __init__(self, fileobj: typing.IO[bytes]) -> None:
+        self._fileobj = fileobj
+        self.written = 0
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._fileobj, name)
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        return self._fileobj.write(data)
+
+
+class InstrumentedPlugin(AbstractSyncPlugin):
+
+    """Wraps a plugin, timing all calls to its hooks.
+
+    Attributes other than hooks are taken from the wrapped plugin.
+    """
+
+    def __init__(self, plugin: AbstractSyncPlugin, stats: Stats,
+                 prefix: typing.Optional[str] = None) -> None:
+        self.plugin = plugin
+        self.NAME = plugin.NAME  # pylint: disable=invalid-name
+        self.THREAD_SAFE = plugin.THREAD_SAFE  # pylint: disable=invalid-name
+        self._stats = stats
+        self._prefix = prefix or plugin.NAME or type(plugin).__name__
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.plugin, name)
+
+    def _time(self, hook: str) -> typing.ContextManager[None]:
+        return self._stats.time(f'{self._prefix}.{hook}')
+
+    def configure(self, info: typing.Dict[str, typing.Any]) -> None:
+        with self._time('configure'):
+            self.plugin.configure(info)
+
+    def connect(self) -> None:
+        with self._time('connect'):
+            self.plugin.connect()
+
+    def disconnect(self) -> None:
+        with self._time('disconnect'):
+            self.plugin.disconnect()
+
+    def create_local_digest(self, path: pathlib.Path) -> str:
+        with self._time('create_local_digest'):
+            return self.plugin.create_local_digest(path)
+
+    def create_local_digest_from_stat(self, path: pathlib.Path, stat: os.stat_result) -> str:
+        with self._time('create_local_digest'):
+            return self.plugin.create_local_digest_from_stat(path, stat)
+
+    def create_remote_digest(self, path: pathlib.PurePath) -> str:
+        with self._time('create_remote_digest'):
+            return self.plugin.create_remote_digest(path)
+
+    def remote_size(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        with self._time('remote_size'):
+            return self.plugin.remote_size(path)
+
+    def remote_mtime(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        with self._time('remote_mtime'):
+            return self.plugin.remote_mtime(path)
+
+    def list_path(self, path: pathlib.PurePath) -> typing.Iterable[pathlib.PurePath]:
+        # Plugins might return a generator, which does the actual work.
+        with self._time('list_path'):
+            return list(self.plugin.list_path(path))
+
+    def retrieve_file(self,
+                      path: pathlib.PurePath,
+                      fileobj: typing.IO[bytes]) -> typing.Optional[int]:
+        writer = _CountingWriter(fileobj)
+        try:
+            with self._time('retrieve_file'):
+                return self.plugin.retrieve_file(path, typing.cast(typing.IO[bytes], writer))
+        finally:
+            self._stats.add_bytes(f'{self._prefix}.retrieve_file', writer.written)
+
+    def connection_schema(self) -> utils.JsonType:
+        return self.plugin.connection_schema()
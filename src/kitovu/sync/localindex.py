@@ -0,0 +1,87 @@
+"""An in-memory index of the files in a local directory.
+
+Instead of checking the existence of (and stat-ing) each file on its own while
+syncing, the local directory of a subject is scanned once with os.scandir up
+front. This saves several system calls per file, which matters on slow (e.g.
+network) file systems.
+"""
+
+import os
+import pathlib
+import typing
+import logging
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class LocalIndex:
+
+    """Stat information of all files below a local directory.
+
+    Files are identified by their path relative to the root directory, using
+    forward slashes (like the keys in a filecache.SubjectCache).
+    """
+
+    def __init__(self, root: pathlib.Path) -> None:
+        self.root: pathlib.Path = root
+        self._stats: typing.Dict[str, os.stat_result] = {}
+        # Directories we didn't scan (symlinks or unreadable), as key prefixes.
+        # Files below them are stat-ed on their own when looked up.
+        self._unscanned: typing.List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self._stats)
+
+    def scan(self) -> None:
+        """Scan the root directory recursively."""
+        logger.debug('Scanning %s', self.root)
+        self._stats.clear()
+        self._unscanned.clear()
+
+        stack: typing.List[typing.Tuple[str, str]] = [(str(self.root), '')]
+        while stack:
+            directory, prefix = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError:
+                continue
+            except OSError as ex:
+                logger.debug('Could not scan %s: %s', directory, ex)
+                self._unscanned.append(prefix)
+                continue
+
+            with entries:
+                for entry in entries:
+                    key = prefix + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, key + '/'))
+                        elif entry.is_symlink() and entry.is_dir():
+                            # Not following those avoids symlink loops.
+                            self._unscanned.append(key + '/')
+                        else:
+                            self._stats[key] = entry.stat()
+                    except FileNotFoundError:  # removed while scanning, or a dangling symlink
+                        continue
+
+        logger.debug('Found %d files in %s', len(self._stats), self.root)
+
+    def get(self, key: str) -> typing.Optional[os.stat_result]:
+        """Get the stat information for the given file, or None if it doesn't exist."""
+        stat = self._stats.get(key)
+        if stat is None and any(key.startswith(prefix) for prefix in self._unscanned):
+            try:
+                stat = (self.root / key).stat()
+            except OSError:
+                return None
+        return stat
+
+    def refresh(self, key: str) -> os.stat_result:
+        """Update the stat information for a file kitovu just wrote."""
+        stat = (self.root / key).stat()
+        self._stats[key] = stat
+        return stat
@@ -0,0 +1,293 @@
+"""Metrics of a sync run in the OpenMetrics text format.
+
+With "kitovu sync --metrics-file PATH", the metrics of the run are written to
+the given file, e.g. for the textfile collector of the Prometheus
+node_exporter when running kitovu from cron. They are collected from the same
+progress events as the "--progress jsonl" output (see the progress module).
+
+All values describe the last run (rather than growing over several runs), so
+they are exposed as gauges. The file is replaced atomically, so a scrape never
+sees a half-written file. Success timestamps are kept from the previous file
+if the run (or a connection) failed, so alerts can be based on how long ago
+the last successful sync was.
+"""
+
+import os
+import re
+import time
+import typing
+import pathlib
+import threading
+import collections
+
+import attr
+
+from kitovu.sync import filecache, planning, progress
+
+
+PREFIX = 'kitovu'
+
+_SAMPLE_RE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{.*\})? (?P<value>\S+)$')
+
+Labels = typing.List[typing.Tuple[str, str]]
+Sample = typing.Tuple[Labels, float]
+
+
+@attr.s
+class SubjectMetrics:
+
+    listed_files: int = attr.ib(default=0)
+    listing_seconds: float = attr.ib(default=0.0)
+    planned_files: int = attr.ib(default=0)
+    downloaded_files: int = attr.ib(default=0)
+    downloaded_bytes: int = attr.ib(default=0)
+    skipped_files: int = attr.ib(default=0)
+    failed_files: int = attr.ib(default=0)
+
+
+@attr.s
+class ConnectionMetrics:
+
+    errors: int = attr.ib(default=0)
+    downloaded_files: int = attr.ib(default=0)
+    downloaded_bytes: int = attr.ib(default=0)
+    failed_files: int = attr.ib(default=0)
+    download_seconds: float = attr.ib(default=0.0)
+
+
+class MetricsReporter(progress.Reporter):
+
+    """Collects metrics per connection and subject from the progress events."""
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._listing_start: typing.Dict[typing.Tuple[str, str], float] = {}
+        self.subjects: typing.Dict[typing.Tuple[str, str], SubjectMetrics] = \
+            collections.OrderedDict()
+        self.connections: typing.Dict[str, ConnectionMetrics] = collections.OrderedDict()
+        self.seconds: typing.Optional[float] = None
+
+    def _subject(self, connection: str, subject: str) -> SubjectMetrics:
+        self._connection(connection)
+        key = (connection, subject)
+        if key not in self.subjects:
+            self.subjects[key] = SubjectMetrics()
+        return self.subjects[key]
+
+    def _connection(self, connection: str) -> ConnectionMetrics:
+        if connection not in self.connections:
+            self.connections[connection] = ConnectionMetrics()
+        return self.connections[connection]
+
+    def listing(self, connection: str, subject: str) -> None:
+        with self._lock:
+            self._subject(connection, subject)
+            self._listing_start[(connection, subject)] = self._clock()
+
+    def listed(self, connection: str, subject: str, files: int) -> None:
+        with self._lock:
+            metrics = self._subject(connection, subject)
+            metrics.listed_files = files
+            start = self._listing_start.pop((connection, subject), None)
+            if start is not None:
+                metrics.listing_seconds = self._clock() - start
+
+    def planned(self, planned: planning.PlannedFile) -> None:
+        with self._lock:
+            self._subject(planned.connection, planned.subject).planned_files += 1
+
+    def done(self, planned: planning.PlannedFile, size: int) -> None:
+        with self._lock:
+            metrics = self._subject(planned.connection, planned.subject)
+            metrics.downloaded_files += 1
+            metrics.downloaded_bytes += size
+
+    def skipped(self, planned: planning.PlannedFile) -> None:
+        with self._lock:
+            self._subject(planned.connection, planned.subject).skipped_files += 1
+
+    def error(self, connection: str, message: str,
+              planned: typing.Optional[planning.PlannedFile] = None) -> None:
+        with self._lock:
+            self._connection(connection).errors += 1
+            if planned is not None:
+                self._subject(planned.connection, planned.subject).failed_files += 1
+
+    def summary(self, connection: str, files: int, size: int, failed: int,
+                seconds: float) -> None:
+        with self._lock:
+            metrics = self._connection(connection)
+            metrics.downloaded_files = files
+            metrics.downloaded_bytes = size
+            metrics.failed_files = failed
+            metrics.download_seconds = seconds
+
+    def finished(self) -> None:
+        with self._lock:
+            self.seconds = self._clock() - self._start
+
+    @property
+    def errors(self) -> int:
+        return sum(metrics.errors for metrics in self.connections.values())
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(round(value, 6))
+
+
+def read_samples(path: pathlib.Path) -> typing.Dict[typing.Tuple[str, str], float]:
+    """Read the samples of a metrics file written before, by name and labels.
+
+    Returns an empty dict if the file doesn't exist or can't be read.
+    """
+    samples: typing.Dict[typing.Tuple[str, str], float] = {}
+    try:
+        lines = path.read_text(encoding='utf-8').splitlines()
+    except (OSError, UnicodeDecodeError):
+        return samples
+
+    for line in lines:
+        match = _SAMPLE_RE.match(line)
+        if match is None:
+            continue
+        try:
+            value = float(match.group('value'))
+        except ValueError:
+            continue
+        samples[(match.group('name'), match.group('labels') or '')] = value
+    return samples
+
+
+class _Families:
+
+    """Metric families in the order they were added."""
+
+    def __init__(self) -> None:
+        self._families: typing.Dict[str, typing.Tuple[str, typing.List[Sample]]] = \
+            collections.OrderedDict()
+
+    def add(self, name: str, help_text: str, labels: Labels, value: float) -> None:
+        full_name = f'{PREFIX}_{name}'
+        if full_name not in self._families:
+            self._families[full_name] = (help_text, [])
+        self._families[full_name][1].append((labels, value))
+
+    def format_text(self) -> str:
+        lines = []
+        for name, (help_text, samples) in self._families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def format_metrics(reporter: MetricsReporter,
+                   success: bool,
+                   now: float,
+                   cache_stats: typing.Optional[filecache.CacheStats] = None,
+                   previous: typing.Optional[typing.Dict[typing.Tuple[str, str], float]] = None
+                   ) -> str:
+    """Format the collected metrics as OpenMetrics text.
+
+    success is whether the run as a whole succeeded (i.e. it wasn't aborted
+    or cancelled). now is the current time (seconds since the epoch), and
+    previous the samples of the previous metrics file, see read_samples.
+    """
+    if previous is None:
+        previous = {}
+    families = _Families()
+
+    def last_success(name: str, labels: Labels, succeeded: bool) -> None:
+        if succeeded:
+            value: typing.Optional[float] = now
+        else:
+            value = previous.get((f'{PREFIX}_{name}', _format_labels(labels)))
+        if value is not None:
+            families.add(name, 'Time of the last sync without errors, in seconds since the epoch',
+                         labels, value)
+
+    run_succeeded = success and reporter.errors == 0
+    families.add('sync_success', 'Whether the last sync finished without any errors', [],
+                 int(run_succeeded))
+    families.add('sync_timestamp_seconds', 'Time the last sync ended, in seconds since the epoch',
+                 [], now)
+    if reporter.seconds is not None:
+        families.add('sync_duration_seconds', 'Duration of the last sync', [], reporter.seconds)
+    last_success('sync_last_success_timestamp_seconds', [], run_succeeded)
+
+    for connection, metrics in reporter.connections.items():
+        labels = [('connection', connection)]
+        families.add('connection_errors', 'Errors of the connection in the last sync',
+                     labels, metrics.errors)
+        families.add('connection_downloaded_files', 'Files downloaded in the last sync',
+                     labels, metrics.downloaded_files)
+        families.add('connection_downloaded_bytes', 'Bytes downloaded in the last sync',
+                     labels, metrics.downloaded_bytes)
+        families.add('connection_failed_files', 'Files which failed to download in the last sync',
+                     labels, metrics.failed_files)
+        families.add('connection_download_duration_seconds',
+                     'Time spent downloading files of the connection in the last sync',
+                     labels, metrics.download_seconds)
+        last_success('connection_last_success_timestamp_seconds', labels,
+                     success and metrics.errors == 0)
+
+    for (connection, subject), subject_metrics in reporter.subjects.items():
+        labels = [('connection', connection), ('subject', subject)]
+        for name, help_text, value in [
+                ('listed_files', 'Remote files of the subject (without ignored ones)',
+                 subject_metrics.listed_files),
+                ('listing_duration_seconds', 'Time spent listing and comparing the files',
+                 subject_metrics.listing_seconds),
+                ('planned_files', 'Files planned to be downloaded in the last sync',
+                 subject_metrics.planned_files),
+                ('downloaded_files', 'Files downloaded in the last sync',
+                 subject_metrics.downloaded_files),
+                ('downloaded_bytes', 'Bytes downloaded in the last sync',
+                 subject_metrics.downloaded_bytes),
+                ('skipped_files', 'Planned files which were skipped in the last sync',
+                 subject_metrics.skipped_files),
+                ('failed_files', 'Files which failed to download in the last sync',
+                 subject_metrics.failed_files),
+        ]:
+            families.add(f'subject_{name}', help_text, labels, value)
+
+    if cache_stats is not None:
+        families.add('filecache_size_bytes', 'Size of the file cache on disk', [],
+                     cache_stats.size)
+        entries: typing.Dict[typing.Tuple[str, str], int] = collections.OrderedDict()
+        for subject_stats in cache_stats.subjects:
+            key = (subject_stats.connection, subject_stats.subject)
+            entries[key] = entries.get(key, 0) + subject_stats.entries
+        for (connection, subject), count in entries.items():
+            families.add('subject_cache_entries', 'Files of the subject in the file cache',
+                         [('connection', connection), ('subject', subject)], count)
+
+    return families.format_text()
+
+
+def write(path: pathlib.Path,
+          reporter: MetricsReporter,
+          success: bool,
+          cache_stats: typing.Optional[filecache.CacheStats] = None) -> None:
+    """Atomically write the collected metrics to the given file."""
+    text = format_metrics(reporter, success=success, now=time.time(), cache_stats=cache_stats,
+                          previous=read_samples(path))
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.write_text(text, encoding='utf-8')
+    os.replace(str(temp_path), str(path))
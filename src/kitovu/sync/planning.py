@@ -0,0 +1,154 @@
+"""Synchronization plans.
+
+A sync run first lists all remote files and compares them to the local files
+and the file cache, which results in a plan of the files to download. The plan
+is then executed, or only shown (with "kitovu sync --dry-run").
+
+Plans can be saved as JSON and executed later, without listing the remote
+files again.
+"""
+
+import pathlib
+import typing
+
+import attr
+
+from kitovu import utils
+from kitovu.sync import filecache
+
+
+ORDERS = ['listing', 'smallest', 'newest']
+
+
+def format_size(size: typing.Optional[int]) -> str:
+    """Format a size in bytes for humans."""
+    if size is None:
+        return '?'
+    value = float(size)
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if value < 1024 or unit == 'GiB':
+            break
+        value /= 1024
+    if unit == 'B':
+        return f'{size} B'
+    return f'{value:.1f} {unit}'
+
+
+@attr.s
+class PlannedFile:
+
+    """A file which is going to be downloaded."""
+
+    connection: str = attr.ib()
+    subject: str = attr.ib()
+    remote_dir: pathlib.PurePath = attr.ib()
+    local_dir: pathlib.Path = attr.ib()
+    remote_path: pathlib.PurePath = attr.ib()
+    local_path: pathlib.Path = attr.ib()
+    state: filecache.FileState = attr.ib()
+    remote_digest: str = attr.ib()
+    size: typing.Optional[int] = attr.ib(default=None)  # None if the plugin doesn't know
+    mtime: typing.Optional[int] = attr.ib(default=None)  # remote mtime, if known
+    priority: int = attr.ib(default=0)  # of the subject
+
+    @property
+    def subject_key(self) -> filecache.SubjectKey:
+        return filecache.subject_key(self.connection, self.subject, self.remote_dir)
+
+    def to_dict(self) -> utils.JsonType:
+        return {
+            'connection': self.connection,
+            'subject': self.subject,
+            'remote-dir': self.remote_dir.as_posix(),
+            'local-dir': str(self.local_dir),
+            'remote-path': self.remote_path.as_posix(),
+            'local-path': str(self.local_path),
+            'state': self.state.name,
+            'remote-digest': self.remote_digest,
+            'size': self.size,
+            'mtime': self.mtime,
+            'priority': self.priority,
+        }
+
+    @classmethod
+    def from_dict(cls, data: utils.JsonType) -> 'PlannedFile':
+        return cls(connection=data['connection'],
+                   subject=data['subject'],
+                   remote_dir=pathlib.PurePath(data['remote-dir']),
+                   local_dir=pathlib.Path(data['local-dir']),
+                   remote_path=pathlib.PurePath(data['remote-path']),
+                   local_path=pathlib.Path(data['local-path']),
+                   state=filecache.FileState[data['state']],
+                   remote_digest=data['remote-digest'],
+                   size=data['size'],
+                   mtime=data.get('mtime'),
+                   priority=data.get('priority', 0))
+
+
+def _order_key(order: str, planned: PlannedFile) -> typing.Tuple[typing.Any, ...]:
+    if order == 'smallest':
+        return (planned.size is None, planned.size)
+    elif order == 'newest':
+        return (planned.mtime is None, -planned.mtime if planned.mtime is not None else 0)
+    elif order == 'listing':
+        return ()
+    else:
+        raise AssertionError(f"Unknown order {order}")
+
+
+def schedule(files: typing.List[PlannedFile], order: str = 'listing') -> typing.List[PlannedFile]:
+    """Sort planned files by the priority of their subject (highest first), then by order.
+
+    order can be:
+      listing: The order in which the plugins listed the files.
+      smallest: Small files first.
+      newest: Recently changed files first.
+
+    Files with an unknown size/mtime come last, and the sort is stable, so
+    files which compare equal stay in listing order.
+    """
+    return sorted(files, key=lambda planned: (-planned.priority,) + _order_key(order, planned))
+
+
+@attr.s
+class Plan:
+
+    """All files a sync run is going to download."""
+
+    VERSION = 1
+
+    files: typing.List[PlannedFile] = attr.ib(default=attr.Factory(list))
+
+    @property
+    def total_bytes(self) -> int:
+        """The sum of all known file sizes."""
+        return sum(planned.size for planned in self.files if planned.size is not None)
+
+    def for_connection(self, connection: str) -> typing.List[PlannedFile]:
+        return [planned for planned in self.files if planned.connection == connection]
+
+    def to_json(self) -> utils.JsonType:
+        return {
+            'version': self.VERSION,
+            'total-bytes': self.total_bytes,
+            'files': [planned.to_dict() for planned in self.files],
+        }
+
+    @classmethod
+    def from_json(cls, data: utils.JsonType) -> 'Plan':
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION:
+            raise utils.UsageError('Unknown plan format')
+        try:
+            return cls(files=[PlannedFile.from_dict(entry) for entry in data['files']])
+        except (KeyError, TypeError) as ex:
+            raise utils.UsageError(f'Invalid plan: {ex!r}')
+
+    def format_text(self) -> str:
+        lines = [f'{planned.state.name:<15} {format_size(planned.size):>10}  {planned.local_path}'
+                 for planned in self.files]
+        unknown = sum(1 for planned in self.files if planned.size is None)
+        total = f'Total: {len(self.files)} files, {format_size(self.total_bytes)}'
+        if unknown:
+            total += f' ({unknown} of unknown size)'
+        lines.append(total)
+        return '\n'.join(lines)
@@ -4,6 +4,7 @@ import os
 import typing
 import pathlib
 import logging
+import threading
 
 import attr
 import requests
@@ -14,6 +15,9 @@ from kitovu.sync import syncplugin
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+# Size of the chunks downloaded files are written in.
+CHUNK_SIZE = 64 * 1024
+
 
 @attr.s
 class _MoodleFile:
@@ -26,6 +30,10 @@ class _MoodleFile:
 class MoodlePlugin(syncplugin.AbstractSyncPlugin):
 
     NAME = 'moodle'
+    # Every request is independent, there's no session to share. Listing
+    # courses and files on demand (which fills the shared dicts below) is
+    # guarded by a lock.
+    THREAD_SAFE = True
 
     def __init__(self) -> None:
         self._url: str = ''
@@ -33,6 +41,7 @@ class MoodlePlugin(syncplugin.AbstractSyncPlugin):
         self._token: str = ''
         self._courses: typing.Dict[str, int] = {}
         self._files: typing.Dict[pathlib.PurePath, _MoodleFile] = {}
+        self._list_lock = threading.Lock()
 
     def _request(self, func: str, **kwargs: str) -> typing.Any:
         url = self._url + 'webservice/rest/server.php'
@@ -42,18 +51,37 @@ class MoodlePlugin(syncplugin.AbstractSyncPlugin):
             'wsfunction': func,
         }
         req_data.update(**kwargs)
-        logger.debug(f'Getting {url} with data {req_data}')
+        logger.debug('Getting %s with data %s', url, req_data)
+
+        req: requests.Response = self._get(url, req_data)
+        data: utils.JsonType = req.json()
+        logger.debug('Got data: %s', data)
+        self._check_json_answer(data)
+        return data
+
+    def _get(self, url: str, params: typing.Dict[str, str],
+             stream: bool = False) -> requests.Response:
+        """Do a GET request, raising utils.TransientError if it might work later.
+
+        With stream=True, the body is only read when iterating over it.
+        """
+        try:
+            req: requests.Response = requests.get(url, params, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as ex:
+            raise utils.TransientError(f"Connection error: {ex}.")
+        except requests.exceptions.RequestException as ex:
+            raise utils.TransientError(f"Request failed: {ex}.")
 
-        req: requests.Response = requests.get(url, req_data)
         try:
             req.raise_for_status()
         except requests.exceptions.HTTPError as ex:
+            # Too many requests or server errors
+            if req.status_code == 429 or req.status_code >= 500:
+                raise utils.TransientError(f"HTTP error: {ex}.")
             raise utils.PluginOperationError(f"HTTP error: {ex}.")
 
-        data: utils.JsonType = req.json()
-        logger.debug(f'Got data: {data}')
-        self._check_json_answer(data)
-        return data
+        return req
 
     def _check_json_answer(self, data: utils.JsonType) -> None:
         if not isinstance(data, dict):
@@ -94,22 +122,56 @@ class MoodlePlugin(syncplugin.AbstractSyncPlugin):
         return f'{size}-{changed_at}'
 
     def create_local_digest(self, path: pathlib.Path) -> str:
-        stats: os.stat_result = path.stat()
+        return self.create_local_digest_from_stat(path, path.stat())
+
+    def create_local_digest_from_stat(self, path: pathlib.Path, stat: os.stat_result) -> str:
         # Unfortunately, Moodle returns a size of 0 for HTML files in its API.
-        size: int = 0 if path.suffix == '.html' else stats.st_size
-        mtime = int(stats.st_mtime)
+        size: int = 0 if path.suffix == '.html' else stat.st_size
+        mtime = int(stat.st_mtime)
         return self._create_digest(size, mtime)
 
+    def _get_file(self, path: pathlib.PurePath) -> _MoodleFile:
+        if path not in self._files:
+            # The course wasn't listed yet, e.g. when executing a saved plan.
+            # Downloads run in parallel, so only one of them lists it.
+            with self._list_lock:
+                if path not in self._files:
+                    self._list_course_of(path)
+
+        try:
+            return self._files[path]
+        except KeyError:
+            raise utils.PluginOperationError(f"The remote file '{path}' was not found.")
+
+    def _list_course_of(self, path: pathlib.PurePath) -> None:
+        if not self._courses:
+            self._list_courses()
+        for course in list(self._courses):
+            if str(path).startswith(course + '/'):
+                logger.debug('Listing %s to find %s', course, path)
+                for _filename in self._list_files_in_course(pathlib.PurePath(course)):
+                    pass
+                break
+
     def create_remote_digest(self, path: pathlib.PurePath) -> str:
-        moodle_file: _MoodleFile = self._files[path]
+        moodle_file: _MoodleFile = self._get_file(path)
         return self._create_digest(moodle_file.size, moodle_file.changed_at)
 
+    def remote_size(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        if path.suffix == '.html':
+            # Moodle returns a size of 0 for HTML files.
+            return None
+        return self._get_file(path).size
+
+    def remote_mtime(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        return self._get_file(path).changed_at
+
     def _list_courses(self) -> typing.Iterable[str]:
         courses: typing.List[utils.JsonType] = self._request('core_enrol_get_users_courses',
                                                              userid=str(self._user_id))
         for course in courses:
             self._courses[course['fullname']] = int(course['id'])
-        logger.debug(f'Got courses: {self._courses}')
+        logger.debug('Got courses: %s', self._courses)
         return list(self._courses)
 
     def _list_files_in_course(self,
@@ -142,7 +204,7 @@ class MoodlePlugin(syncplugin.AbstractSyncPlugin):
                     self._files[full_path] = _MoodleFile(elem['fileurl'],
                                                          elem['filesize'],
                                                          elem['timemodified'])
-                    logger.debug(f'New file at {full_path}: {self._files[full_path]}')
+                    logger.debug('New file at %s: %s', full_path, self._files[full_path])
                     yield full_path
 
     def list_path(self, path: pathlib.PurePath) -> typing.Iterable[pathlib.PurePath]:
@@ -157,23 +219,25 @@ class MoodlePlugin(syncplugin.AbstractSyncPlugin):
     def retrieve_file(self,
                       path: pathlib.PurePath,
                       fileobj: typing.IO[bytes]) -> typing.Optional[int]:
-        assert self._files, "list_path was never called, no files available."
-        moodle_file: _MoodleFile = self._files[path]
-        logger.debug(f'Getting {moodle_file.url}')
+        moodle_file: _MoodleFile = self._get_file(path)
+        logger.debug('Getting %s', moodle_file.url)
 
-        req: requests.Response = requests.get(moodle_file.url, {'token': self._token})
-        try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError as ex:
-            raise utils.PluginOperationError(f"HTTP error: {ex}.")
-
-        # Errors from Moodle are delivered as json.
-        if 'json' in req.headers['content-type']:
-            data: utils.JsonType = req.json()
-            self._check_json_answer(data)
+        req: requests.Response = self._get(moodle_file.url, {'token': self._token}, stream=True)
 
-        for chunk in req:
-            fileobj.write(chunk)
+        try:
+            # Errors from Moodle are delivered as json.
+            if 'json' in req.headers['content-type']:
+                data: utils.JsonType = req.json()
+                self._check_json_answer(data)
+
+            # Written while downloading, so the rate limit and progress apply to the transfer.
+            for chunk in req.iter_content(CHUNK_SIZE):
+                fileobj.write(chunk)
+        except requests.exceptions.RequestException as ex:
+            # e.g. ChunkedEncodingError if the connection dropped
+            raise utils.TransientError(f"Connection error while downloading: {ex}.")
+        finally:
+            req.close()
 
         return moodle_file.changed_at
 
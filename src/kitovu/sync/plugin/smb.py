@@ -1,5 +1,6 @@
 """A plugin to sync data via SMB/CIFS (Windows fileshares)."""
 
+import os
 import enum
 import socket
 import typing
@@ -8,7 +9,7 @@ import logging
 
 import attr
 from smb.SMBConnection import SMBConnection
-from smb.base import SharedFile
+from smb.base import SharedFile, NotConnectedError, SMBTimeout
 from smb.smb_structs import OperationFailure, ProtocolError
 
 from kitovu import utils
@@ -17,6 +18,9 @@ from kitovu.sync import syncplugin
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+# Errors which mean the SMB session is gone.
+_CONNECTION_ERRORS = (NotConnectedError, SMBTimeout, ConnectionError, socket.timeout)
+
 
 class _SignOptions(enum.IntEnum):
 
@@ -94,7 +98,7 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
             # PySMB has too verbose logging, we don't want to see that.
             logging.getLogger('SMB.SMBConnection').propagate = False
 
-        logger.debug(f'Configured: {self._info}')
+        logger.debug('Configured: %s', self._info)
 
     def connect(self) -> None:
         self._connection = SMBConnection(username=self._info.username,
@@ -113,7 +117,8 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
                 f'Could not find server {self._info.hostname}. '
                 'Maybe you need to open a VPN connection or the server is not available.')
 
-        logger.debug(f'Connecting to {server_ip} ({self._info.hostname}) port {self._info.port}')
+        logger.debug('Connecting to %s (%s) port %s',
+                     server_ip, self._info.hostname, self._info.port)
 
         try:
             success = self._connection.connect(server_ip, self._info.port)
@@ -130,6 +135,10 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
     def disconnect(self) -> None:
         self._connection.close()
 
+    def _connection_lost(self, error: Exception) -> utils.ConnectionLostError:
+        return utils.ConnectionLostError(
+            f'Lost connection to {self._info.hostname}: {str(error) or type(error).__name__}')
+
     def _create_digest(self, size: int, mtime: float) -> str:
         """Create a digest from a size and mtime.
 
@@ -144,12 +153,16 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
         return f'{size}-{mtime}'
 
     def create_local_digest(self, path: pathlib.Path) -> str:
-        info = path.lstat()
-        return self._create_digest(size=info.st_size, mtime=info.st_mtime)
+        return self.create_local_digest_from_stat(path, path.lstat())
+
+    def create_local_digest_from_stat(self, path: pathlib.Path, stat: os.stat_result) -> str:
+        return self._create_digest(size=stat.st_size, mtime=stat.st_mtime)
 
     def create_remote_digest(self, path: pathlib.PurePath) -> str:
         try:
             attributes = self._connection.getAttributes(self._info.share, str(path))
+        except _CONNECTION_ERRORS as ex:
+            raise self._connection_lost(ex)
         except OperationFailure:
             raise utils.PluginOperationError(
                 f'Could not find remote file {path} in share "{self._info.share}"')
@@ -158,9 +171,18 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
         return self._create_digest(size=attributes.file_size,
                                    mtime=attributes.last_write_time)
 
+    def remote_size(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        size: int = self._attributes[path].file_size
+        return size
+
+    def remote_mtime(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        return int(self._attributes[path].last_write_time)
+
     def list_path(self, path: pathlib.PurePath) -> typing.Iterable[pathlib.PurePath]:
         try:
             entries = self._connection.listPath(self._info.share, str(path))
+        except _CONNECTION_ERRORS as ex:
+            raise self._connection_lost(ex)
         except OperationFailure:
             raise utils.PluginOperationError(f'Folder "{path}" not found')
 
@@ -174,13 +196,18 @@ class SmbPlugin(syncplugin.AbstractSyncPlugin):
     def retrieve_file(self,
                       path: pathlib.PurePath,
                       fileobj: typing.IO[bytes]) -> typing.Optional[int]:
-        logger.debug(f'Retrieving file {path}')
+        logger.debug('Retrieving file %s', path)
         try:
             self._connection.retrieveFile(self._info.share, str(path), fileobj)
+        except _CONNECTION_ERRORS as ex:
+            raise self._connection_lost(ex)
         except OperationFailure:
             raise utils.PluginOperationError(
                 f'Could not download {path} from share "{self._info.share}"')
 
+        if path not in self._attributes:
+            # Another plugin instance created the remote digest.
+            self.create_remote_digest(path)
         mtime: int = self._attributes[path].last_write_time
         return mtime
 
@@ -0,0 +1,265 @@
+"""Machine-readable progress of a sync run.
+
+With "kitovu sync --progress=jsonl", the sync engine writes one JSON object
+per line to stdout for every event, which is what the GUI (or monitoring
+scripts) use instead of parsing log messages. Every event has an "event"
+key with its type and a "time" key (seconds since the epoch):
+
+listing: The files of a subject are listed.
+    connection, subject
+listed: The files of a subject were listed and compared to the local ones.
+        files is the number of remote files (without ignored ones).
+    connection, subject, files
+planned: A file is going to be downloaded. All planned events come before
+         the first download starts, so they can be used to get the total.
+    connection, subject, remote-path, local-path, size (null if unknown)
+transfer: Bytes of a file were downloaded. To keep the output small, these
+          are sent at most every INTERVAL seconds, summing up the bytes
+          since the previous transfer event of the same file.
+    connection, local-path, bytes
+done: A file was downloaded, or created as a copy of an identical file.
+    connection, local-path, size
+skipped: A planned file wasn't downloaded, because it didn't change
+         anymore or the time budget was exhausted.
+    connection, local-path
+error: An operation failed. local-path is null for errors of a whole
+       subject or connection.
+    connection, local-path, message
+summary: All downloads of a connection are done.
+    connection, files, bytes, failed, seconds
+finished: The sync run is done.
+    files, bytes, failed
+"""
+
+import sys
+import json
+import time
+import typing
+import threading
+import collections
+
+from kitovu.sync import planning
+
+
+# How often (in seconds) transfer events are sent at most.
+INTERVAL = 0.1
+
+FORMATS = ['log', 'jsonl']
+
+
+class Reporter:
+
+    """Reports the progress of a sync run.
+
+    This base class ignores all events, which is what is used unless
+    progress output was requested.
+    """
+
+    # If False, no transfer events are generated, to avoid the overhead.
+    enabled = False
+
+    def listing(self, connection: str, subject: str) -> None:
+        pass
+
+    def listed(self, connection: str, subject: str, files: int) -> None:
+        pass
+
+    def planned(self, planned: planning.PlannedFile) -> None:
+        pass
+
+    def transferred(self, planned: planning.PlannedFile, size: int) -> None:
+        pass
+
+    def done(self, planned: planning.PlannedFile, size: int) -> None:
+        pass
+
+    def skipped(self, planned: planning.PlannedFile) -> None:
+        pass
+
+    def error(self, connection: str, message: str,
+              planned: typing.Optional[planning.PlannedFile] = None) -> None:
+        pass
+
+    def summary(self, connection: str, files: int, size: int, failed: int,
+                seconds: float) -> None:
+        pass
+
+    def finished(self) -> None:
+        pass
+
+
+class EventReporter(Reporter):
+
+    """Turns progress into the events described in the module docstring.
+
+    Subclasses need to implement send(), which gets every event as a dict.
+    Events can be reported from several threads at the same time, but send()
+    is only called by one thread at a time.
+    """
+
+    enabled = True
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Bytes not reported yet, by local path.
+        self._pending: typing.Dict[str, int] = collections.OrderedDict()
+        self._last_transfer = 0.0
+        self._files = 0
+        self._bytes = 0
+        self._failed = 0
+
+    def send(self, data: typing.Dict[str, typing.Any]) -> None:
+        raise NotImplementedError
+
+    def _emit(self, event: str, **fields: typing.Any) -> None:
+        data = {'event': event, 'time': time.time()}
+        data.update(fields)
+        self.send(data)
+
+    def _flush_transfers(self, connection: str, local_path: str) -> None:
+        size = self._pending.pop(local_path, 0)
+        if size:
+            self._emit('transfer', connection=connection, **{'local-path': local_path, 'bytes': size})
+
+    def listing(self, connection: str, subject: str) -> None:
+        with self._lock:
+            self._emit('listing', connection=connection, subject=subject)
+
+    def listed(self, connection: str, subject: str, files: int) -> None:
+        with self._lock:
+            self._emit('listed', connection=connection, subject=subject, files=files)
+
+    def planned(self, planned: planning.PlannedFile) -> None:
+        with self._lock:
+            self._emit('planned', connection=planned.connection, subject=planned.subject,
+                       size=planned.size, **{
+                           'remote-path': planned.remote_path.as_posix(),
+                           'local-path': str(planned.local_path),
+                       })
+
+    def transferred(self, planned: planning.PlannedFile, size: int) -> None:
+        local_path = str(planned.local_path)
+        with self._lock:
+            self._pending[local_path] = self._pending.get(local_path, 0) + size
+            now = self._clock()
+            if now - self._last_transfer < INTERVAL:
+                return
+            self._last_transfer = now
+            self._flush_transfers(planned.connection, local_path)
+
+    def done(self, planned: planning.PlannedFile, size: int) -> None:
+        local_path = str(planned.local_path)
+        with self._lock:
+            self._flush_transfers(planned.connection, local_path)
+            self._files += 1
+            self._bytes += size
+            self._emit('done', connection=planned.connection, size=size,
+                       **{'local-path': local_path})
+
+    def skipped(self, planned: planning.PlannedFile) -> None:
+        local_path = str(planned.local_path)
+        with self._lock:
+            self._pending.pop(local_path, None)
+            self._emit('skipped', connection=planned.connection, **{'local-path': local_path})
+
+    def error(self, connection: str, message: str,
+              planned: typing.Optional[planning.PlannedFile] = None) -> None:
+        local_path = None if planned is None else str(planned.local_path)
+        with self._lock:
+            if local_path is not None:
+                self._pending.pop(local_path, None)
+                self._failed += 1
+            self._emit('error', connection=connection, message=message,
+                       **{'local-path': local_path})
+
+    def summary(self, connection: str, files: int, size: int, failed: int,
+                seconds: float) -> None:
+        with self._lock:
+            self._emit('summary', connection=connection, files=files, bytes=size,
+                       failed=failed, seconds=round(seconds, 3))
+
+    def finished(self) -> None:
+        with self._lock:
+            self._emit('finished', files=self._files, bytes=self._bytes, failed=self._failed)
+
+
+class JsonLinesReporter(EventReporter):
+
+    """Writes every event as a line of JSON."""
+
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None,
+                 clock: typing.Callable[[], float] = time.monotonic) -> None:
+        super().__init__(clock)
+        self._stream = sys.stdout if stream is None else stream
+
+    def send(self, data: typing.Dict[str, typing.Any]) -> None:
+        self._stream.write(json.dumps(data) + '\n')
+        self._stream.flush()
+
+
+class MultiReporter(Reporter):
+
+    """Passes all events on to several reporters."""
+
+    def __init__(self, reporters: typing.Iterable[Reporter]) -> None:
+        self._reporters = list(reporters)
+        self.enabled = any(reporter.enabled for reporter in self._reporters)
+
+    def listing(self, connection: str, subject: str) -> None:
+        for reporter in self._reporters:
+            reporter.listing(connection, subject)
+
+    def listed(self, connection: str, subject: str, files: int) -> None:
+        for reporter in self._reporters:
+            reporter.listed(connection, subject, files)
+
+    def planned(self, planned: planning.PlannedFile) -> None:
+        for reporter in self._reporters:
+            reporter.planned(planned)
+
+    def transferred(self, planned: planning.PlannedFile, size: int) -> None:
+        for reporter in self._reporters:
+            if reporter.enabled:
+                reporter.transferred(planned, size)
+
+    def done(self, planned: planning.PlannedFile, size: int) -> None:
+        for reporter in self._reporters:
+            reporter.done(planned, size)
+
+    def skipped(self, planned: planning.PlannedFile) -> None:
+        for reporter in self._reporters:
+            reporter.skipped(planned)
+
+    def error(self, connection: str, message: str,
+              planned: typing.Optional[planning.PlannedFile] = None) -> None:
+        for reporter in self._reporters:
+            reporter.error(connection, message, planned)
+
+    def summary(self, connection: str, files: int, size: int, failed: int,
+                seconds: float) -> None:
+        for reporter in self._reporters:
+            reporter.summary(connection, files, size, failed, seconds)
+
+    def finished(self) -> None:
+        for reporter in self._reporters:
+            reporter.finished()
+
+
+class ProgressWriter:
+
+    """A file-like object, reporting data written to another file as transferred."""
+
+    def __init__(self, fileobj: typing.IO[bytes], reporter: Reporter,
+                 planned: planning.PlannedFile) -> None:
+        self._fileobj = fileobj
+        self._reporter = reporter
+        self._planned = planned
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._fileobj, name)
+
+    def write(self, data: bytes) -> int:
+        written = self._fileobj.write(data)
+        self._reporter.transferred(self._planned, len(data))
+        return written
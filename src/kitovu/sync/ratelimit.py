@@ -0,0 +1,141 @@
+"""Limiting the bandwidth and request rate used for servers.
+
+Limits can be configured globally and per connection, via a "rate-limit"
+setting with "bytes-per-second" and/or "requests-per-second". Downloaded
+data counts against the byte limits, and every metadata call (listing a
+directory, getting a remote digest) or download counts as a request.
+
+Limits are implemented as token buckets which allow a burst of one second
+worth of tokens. They are thread-safe, so a limit is shared between all
+downloads running at the same time.
+"""
+
+import time
+import typing
+import threading
+
+import attr
+
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'bytes-per-second': {'type': 'number', 'exclusiveMinimum': 0},
+        'requests-per-second': {'type': 'number', 'exclusiveMinimum': 0},
+    },
+    'additionalProperties': False,
+}
+
+
+@attr.s
+class RateLimit:
+
+    """A configured rate limit, with None meaning unlimited."""
+
+    bytes_per_second: typing.Optional[float] = attr.ib(default=None)
+    requests_per_second: typing.Optional[float] = attr.ib(default=None)
+
+    @classmethod
+    def from_json(cls, data: typing.Optional[typing.Dict[str, float]]) -> typing.Optional['RateLimit']:
+        if data is None:
+            return None
+        return cls(bytes_per_second=data.get('bytes-per-second'),
+                   requests_per_second=data.get('requests-per-second'))
+
+
+class TokenBucket:
+
+    """A thread-safe token bucket, refilled with the given rate per second.
+
+    Consuming more tokens than available puts the bucket into debt and waits
+    until the debt is paid back, so amounts bigger than the burst size are
+    possible, and concurrent consumers are served in the order they came in.
+    """
+
+    def __init__(self, rate: float,
+                 burst: typing.Optional[float] = None,
+                 clock: typing.Callable[[], float] = time.monotonic,
+                 sleep: typing.Callable[[float], None] = time.sleep) -> None:
+        assert rate > 0, rate
+        self.rate = rate
+        self.burst = max(rate, 1) if burst is None else burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        """Take the given amount of tokens, waiting if needed.
+
+        Returns the time waited.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        # Sleeping without the lock, so others can take their share meanwhile.
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+
+class Limiter:
+
+    """All token buckets which apply to a connection.
+
+    Usually, that's the global buckets (shared by all connections) and the
+    buckets for the connection itself. Without any buckets, all methods
+    return immediately.
+    """
+
+    def __init__(self,
+                 byte_buckets: typing.Sequence[TokenBucket] = (),
+                 request_buckets: typing.Sequence[TokenBucket] = ()) -> None:
+        self.byte_buckets = list(byte_buckets)
+        self.request_buckets = list(request_buckets)
+
+    @classmethod
+    def from_limit(cls, limit: typing.Optional[RateLimit],
+                   parent: typing.Optional['Limiter'] = None) -> 'Limiter':
+        """Create a limiter for the given limit, also applying the parent's buckets."""
+        byte_buckets = [] if parent is None else list(parent.byte_buckets)
+        request_buckets = [] if parent is None else list(parent.request_buckets)
+        if limit is not None and limit.bytes_per_second is not None:
+            byte_buckets.append(TokenBucket(limit.bytes_per_second))
+        if limit is not None and limit.requests_per_second is not None:
+            request_buckets.append(TokenBucket(limit.requests_per_second))
+        return cls(byte_buckets, request_buckets)
+
+    @property
+    def limits_bytes(self) -> bool:
+        return bool(self.byte_buckets)
+
+    def request(self) -> None:
+        """Wait until another request can be made."""
+        for bucket in self.request_buckets:
+            bucket.consume(1)
+
+    def transfer(self, size: int) -> None:
+        """Wait until the given amount of bytes can be transferred."""
+        for bucket in self.byte_buckets:
+            bucket.consume(size)
+
+
+class ThrottledWriter:
+
+    """A file-like object, limiting the bandwidth of data written to another file."""
+
+    def __init__(self, fileobj: typing.IO[bytes], limiter: Limiter) -> None:
+        self._fileobj = fileobj
+        self._limiter = limiter
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._fileobj, name)
+
+    def write(self, data: bytes) -> int:
+        self._limiter.transfer(len(data))
+        return self._fileobj.write(data)
@@ -0,0 +1,83 @@
+"""Finding sync plugins by their name.
+
+The built-in plugins are imported only when a connection uses them, as their
+dependencies (pysmb, requests) take a while to import. Other plugins are
+found via the "kitovu.sync.plugin" setuptools entry point.
+
+Looking up a plugin class is cached for the lifetime of the process, so
+configurations with many connections only scan the installed distributions
+once. Since version 3.0, stevedore additionally caches the entry points it
+found on disk, so with it, this scan is cheap across runs as well.
+"""
+
+import typing
+import logging
+import importlib
+import threading
+
+from kitovu import utils
+from kitovu.sync.syncplugin import AbstractSyncPlugin
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+NAMESPACE = 'kitovu.sync.plugin'
+
+BUILTIN_PLUGINS = {
+    'smb': 'kitovu.sync.plugin.smb:SmbPlugin',
+    'moodle': 'kitovu.sync.plugin.moodle:MoodlePlugin',
+}
+
+PluginClass = typing.Callable[[], AbstractSyncPlugin]
+
+
+class PluginRegistry:
+
+    """A mapping of plugin names to plugin classes."""
+
+    def __init__(self) -> None:
+        # None for plugins which weren't found.
+        self._classes: typing.Dict[str, typing.Optional[PluginClass]] = {}
+        self._lock = threading.Lock()
+
+    def get_class(self, name: str) -> PluginClass:
+        """Get the class of the plugin with the given name.
+
+        Raises utils.NoPluginError if there is no such plugin.
+        """
+        with self._lock:
+            if name not in self._classes:
+                self._classes[name] = self._find(name)
+            plugin_class = self._classes[name]
+
+        if plugin_class is None:
+            raise utils.NoPluginError(f"The plugin {name} was not found")
+        return plugin_class
+
+    def create(self, name: str) -> AbstractSyncPlugin:
+        """Create a new (unconfigured) instance of the given plugin."""
+        return self.get_class(name)()
+
+    def clear(self) -> None:
+        """Forget all plugins looked up so far, e.g. after installing one."""
+        with self._lock:
+            self._classes.clear()
+
+    def _find(self, name: str) -> typing.Optional[PluginClass]:
+        if name in BUILTIN_PLUGINS:
+            module_name, class_name = BUILTIN_PLUGINS[name].split(':')
+            return typing.cast(PluginClass,
+                               getattr(importlib.import_module(module_name), class_name))
+
+        import stevedore.driver
+        import stevedore.exception
+        logger.debug('Looking for plugin %s in entry points', name)
+        try:
+            manager: 'stevedore.driver.DriverManager[PluginClass]' = stevedore.driver.DriverManager(
+                namespace=NAMESPACE, name=name, invoke_on_load=False)
+        except stevedore.exception.NoMatches:
+            return None
+        return typing.cast(PluginClass, manager.driver)
+
+
+registry = PluginRegistry()
@@ -0,0 +1,115 @@
+"""Retrying plugin operations which failed with transient errors.
+
+Plugins raise utils.TransientError for errors which might go away (timeouts,
+overloaded servers) and utils.ConnectionLostError if the connection to the
+server is gone. Such operations are retried with an exponential backoff,
+reconnecting the plugin first if needed.
+
+To avoid a run taking forever when a server is down, the total number of
+retries in a run is limited by a budget shared by all operations.
+"""
+
+import time
+import random
+import typing
+import logging
+import threading
+
+from kitovu import utils
+from kitovu.sync.syncplugin import AbstractSyncPlugin
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+T = typing.TypeVar('T')
+
+# How often a single operation is tried at most.
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+
+def backoff(attempt: int) -> float:
+    """Get the delay before the given retry (starting with 1).
+
+    This uses "full jitter", i.e. a random delay up to an exponentially
+    growing maximum, so parallel downloads don't retry at the same time.
+    """
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def reconnect(plugin: AbstractSyncPlugin) -> None:
+    """Re-establish the connection of the given plugin.
+
+    Raises utils.ConnectionLostError if connecting failed.
+    """
+    logger.info('Reconnecting %s plugin', plugin.NAME)
+    try:
+        plugin.disconnect()
+    except (utils.PluginOperationError, OSError) as ex:
+        logger.debug('Ignoring error while disconnecting: %s', ex)
+
+    try:
+        plugin.connect()
+    except utils.PluginOperationError as ex:
+        raise utils.ConnectionLostError(f'Could not reconnect: {ex}')
+
+
+class RetryBudget:
+
+    """The number of retries left for a sync run.
+
+    This is shared by all connections and parallel downloads.
+    """
+
+    def __init__(self, retries: int,
+                 sleep: typing.Callable[[float], None] = time.sleep) -> None:
+        self.remaining = retries
+        self.used = 0
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._exhausted = False
+
+    def _take(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                if not self._exhausted:
+                    logger.warning('No retries left for this run, not retrying failed operations')
+                    self._exhausted = True
+                return False
+            self.remaining -= 1
+            self.used += 1
+            return True
+
+    def call(self, func: typing.Callable[[], T],
+             plugin: AbstractSyncPlugin,
+             description: str,
+             on_retry: typing.Optional[typing.Callable[[], None]] = None) -> T:
+        """Call the given function, retrying it on transient errors.
+
+        The given plugin is reconnected if the connection was lost. If the
+        operation failed MAX_ATTEMPTS times or the budget is used up, the
+        last error is raised. on_retry is called (from the calling thread)
+        before every retry.
+        """
+        attempt = 0
+        needs_reconnect = False
+        while True:
+            try:
+                if needs_reconnect:
+                    reconnect(plugin)
+                    needs_reconnect = False
+                return func()
+            except utils.TransientError as ex:
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    raise
+                if not self._take():
+                    raise
+
+                needs_reconnect = needs_reconnect or isinstance(ex, utils.ConnectionLostError)
+                delay = backoff(attempt)
+                logger.warning('%s failed (%s), retrying in %.1fs', description, ex, delay)
+                if on_retry is not None:
+                    on_retry()
+                self._sleep(delay)
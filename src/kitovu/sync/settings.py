@@ -3,15 +3,18 @@
 import pathlib
 import typing
 import os.path
+import time
+import pickle
+import hashlib
 import logging
 import subprocess
-from distutils import spawn
 
 import appdirs
-import yaml
 import attr
 
+import kitovu
 from kitovu import utils
+from kitovu.sync import hashing, ratelimit, dedup
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -22,6 +25,11 @@ def get_config_file_path() -> pathlib.Path:
     return pathlib.Path(appdirs.user_config_dir('kitovu')) / 'kitovu.yaml'
 
 
+def get_cache_path() -> pathlib.Path:
+    """Get the directory for cached, already validated settings."""
+    return pathlib.Path(appdirs.user_cache_dir('kitovu')) / 'settings'
+
+
 class EditorSpawner:
 
     DEFAULT_EDITORS = [
@@ -50,6 +58,7 @@ class EditorSpawner:
         subprocess.call([editor_path, config])
 
     def _get_editor_path(self, editor: typing.Optional[str]) -> str:
+        from distutils import spawn  # slow to import
         if editor is not None:
             path = spawn.find_executable(editor)
             if path is None:
@@ -71,6 +80,7 @@ class ConnectionSettings:
     plugin_name: str = attr.ib()
     connection: SimpleDict = attr.ib()
     subjects: typing.List[SimpleDict] = attr.ib(default=attr.Factory(list))
+    rate_limit: typing.Optional[ratelimit.RateLimit] = attr.ib(default=None)
 
 
 @attr.s
@@ -79,6 +89,13 @@ class Settings:
 
     root_dir: pathlib.Path = attr.ib()
     connections: typing.Dict[str, ConnectionSettings] = attr.ib()
+    filecache_format: str = attr.ib(default='json')
+    content_hash: typing.Optional[str] = attr.ib(default=None)
+    rate_limit: typing.Optional[ratelimit.RateLimit] = attr.ib(default=None)
+    deduplicate: str = attr.ib(default='copy')
+
+    # How old (in seconds) the config file needs to be to be cached.
+    CACHE_MIN_AGE = 2
 
     SETTINGS_SCHEMA: utils.JsonType = {
         'type': 'object',
@@ -95,11 +112,17 @@ class Settings:
                     'properties': {
                         'name': {'type': 'string'},
                         'plugin': {'type': 'string'},
+                        'rate-limit': ratelimit.SCHEMA,
                     },
                     'required': ['name', 'plugin'],
                 },
             },
             'global-ignore': {'type': 'array', 'items': {'type': 'string'}},
+            'filecache-format': {'type': 'string', 'enum': ['json', 'binary']},
+            'content-hash': {'type': 'string', 'enum': hashing.ALGORITHMS},
+            'rate-limit': ratelimit.SCHEMA,
+            # YAML reads an unquoted "off" as False.
+            'deduplicate': {'enum': dedup.METHODS + [False]},
         },
         'required': [
             'root-dir',
@@ -116,19 +139,76 @@ class Settings:
         logger.debug(f"Loading from {path}")
 
         try:
+            fingerprint = cls._fingerprint(path)
+            cached = cls._load_cached(path, fingerprint)
+            if cached is not None:
+                return cached
             with path.open('r') as stream:
-                return cls.from_yaml_stream(stream)
+                settings = cls.from_yaml_stream(stream)
         except FileNotFoundError as error:
             raise utils.UsageError(f'Could not find the file {error.filename}')
         except OSError as error:
             raise utils.UsageError(f'Failed to open config file: {error}')
 
+        # With a coarse mtime resolution, the file could change again without
+        # changing its fingerprint, so recently changed files aren't cached.
+        if time.time() - fingerprint[1] / 1e9 > cls.CACHE_MIN_AGE:
+            cls._write_cached(path, fingerprint, settings)
+        return settings
+
+    @staticmethod
+    def _fingerprint(path: pathlib.Path) -> typing.Tuple[str, int, int, str]:
+        """Get a key which changes whenever the given file (or kitovu) is changed."""
+        stat = path.stat()
+        return (str(path.resolve()), stat.st_mtime_ns, stat.st_size, kitovu.__version__)
+
+    @staticmethod
+    def _cache_file(path: pathlib.Path) -> pathlib.Path:
+        name = hashlib.sha1(str(path.resolve()).encode('utf-8')).hexdigest()
+        return get_cache_path() / f'{name}.pickle'
+
+    @classmethod
+    def _load_cached(cls, path: pathlib.Path,
+                     fingerprint: typing.Tuple[str, int, int, str]) -> typing.Optional['Settings']:
+        """Get the settings cached for the given file, if they're still valid."""
+        try:
+            with cls._cache_file(path).open('rb') as f:
+                cached_fingerprint, settings = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError) as ex:
+            logger.debug('Ignoring invalid settings cache: %s', ex)
+            return None
+
+        if cached_fingerprint != fingerprint or not isinstance(settings, cls):
+            return None
+        logger.debug('Using cached settings')
+        return settings
+
+    @classmethod
+    def _write_cached(cls, path: pathlib.Path,
+                      fingerprint: typing.Tuple[str, int, int, str],
+                      settings: 'Settings') -> None:
+        cache_file = cls._cache_file(path)
+        tmp_file = cache_file.with_suffix('.tmp')
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_file.open('wb') as f:
+                pickle.dump((fingerprint, settings), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(str(tmp_file), str(cache_file))
+        except OSError as ex:
+            # Not being able to cache the settings only makes the next run slower.
+            logger.debug('Could not write settings cache: %s', ex)
+
     @classmethod
     def from_yaml_stream(cls, stream: typing.IO) -> 'Settings':
+        import yaml  # slow to import
         validator = utils.SchemaValidator()
+        # The C implementation is much faster, but not always available.
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
         try:
-            data = yaml.load(stream)
+            data = yaml.load(stream, Loader=loader)
         except (yaml.YAMLError, OSError, UnicodeDecodeError) as error:
             raise utils.UsageError(f"Failed to load configuration:\n{error}")
 
@@ -136,6 +216,12 @@ class Settings:
 
         root_dir = pathlib.Path(os.path.expanduser(data.pop('root-dir')))
         global_ignore = data.pop('global-ignore', [])
+        filecache_format = data.pop('filecache-format', 'json')
+        content_hash = data.pop('content-hash', None)
+        rate_limit = ratelimit.RateLimit.from_json(data.pop('rate-limit', None))
+        deduplicate = data.pop('deduplicate', 'copy')
+        if deduplicate is False:
+            deduplicate = 'off'
 
         connections = cls._get_connection_settings(
             validator=validator,
@@ -148,6 +234,10 @@ class Settings:
         return Settings(
             root_dir=root_dir,
             connections=connections,
+            filecache_format=filecache_format,
+            content_hash=content_hash,
+            rate_limit=rate_limit,
+            deduplicate=deduplicate,
         )
 
     @staticmethod
@@ -163,6 +253,7 @@ class Settings:
             name = raw_connection.pop('name')
             connections[name] = ConnectionSettings(
                 plugin_name=raw_connection.pop('plugin'),
+                rate_limit=ratelimit.RateLimit.from_json(raw_connection.pop('rate-limit', None)),
                 connection=raw_connection,
             )
 
@@ -172,6 +263,7 @@ class Settings:
                 'type': 'object',
                 'properties': {
                     'name': {'type': 'string'},
+                    'priority': {'type': 'integer'},
                     'sources': {
                         'type': 'array',
                         'items': {
@@ -208,8 +300,10 @@ class Settings:
 
         for subject in raw_subjects:
             name = subject.pop('name')
+            priority = subject.pop('priority', 0)
             for connection_usage in subject.pop('sources'):
                 connection_usage['name'] = name
+                connection_usage['priority'] = priority
                 connection_usage['local-dir'] = pathlib.Path(
                     connection_usage.get('local-dir', root_dir / name))
                 connection_usage['remote-dir'] = pathlib.PurePath(connection_usage['remote-dir'])
@@ -1,115 +1,805 @@
 """Logic related to actually syncing files."""
 
 import os
+import enum
+import time
 import pathlib
 import typing
 import logging
+import functools
+import threading
+import collections
+import concurrent.futures
 
-import stevedore
-import stevedore.driver
-import stevedore.exception
+import attr
 
 from kitovu import utils
-from kitovu.sync import filecache
+from kitovu.sync import (filecache, localindex, hashing, planning, ratelimit, concurrency,
+                         retry, dedup, registry, progress, instrumentation)
 from kitovu.sync.syncplugin import AbstractSyncPlugin
 from kitovu.sync.settings import Settings, ConnectionSettings
-from kitovu.sync.plugin import smb, moodle
 
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+# Appended to the (hidden) name of files while they are downloaded.
+PARTIAL_SUFFIX = '.kitovu-part'
+
 
 def _load_plugin(plugin_settings: ConnectionSettings,
-                 validator: typing.Optional[utils.SchemaValidator] = None) -> AbstractSyncPlugin:
+                 validator: typing.Optional[utils.SchemaValidator] = None,
+                 stats: typing.Optional[instrumentation.Stats] = None) -> AbstractSyncPlugin:
     if validator is None:
         validator = utils.SchemaValidator()
 
-    builtin_plugins = {
-        'smb': smb.SmbPlugin(),
-        'moodle': moodle.MoodlePlugin(),
-    }
-    plugin_name = plugin_settings.plugin_name
-    if plugin_name in builtin_plugins:
-        plugin = builtin_plugins[plugin_name]
-    else:
-        try:
-            manager = stevedore.driver.DriverManager(namespace='kitovu.sync.plugin',
-                                                     name=plugin_name, invoke_on_load=True)
-        except stevedore.exception.NoMatches:
-            raise utils.NoPluginError(f"The plugin {plugin_name} was not found")
-
-        plugin = manager.driver
-
+    plugin = registry.registry.create(plugin_settings.plugin_name)
     validator.validate(plugin_settings.connection, plugin.connection_schema())
 
+    if stats is not None:
+        plugin = instrumentation.InstrumentedPlugin(plugin, stats, prefix=plugin_settings.plugin_name)
     return plugin
 
 
-def start_all(config_file: typing.Optional[pathlib.Path]) -> None:
-    settings = Settings.from_yaml_file(config_file)
-    for connection_name, connection_settings in sorted(settings.connections.items()):
-        _start(connection_name, connection_settings)
+@attr.s
+class SyncOptions:
+
+    """Options for a sync run, usually given on the command line.
+
+    dry_run: Only plan, don't download anything or change the file cache.
+    plan: Download the files of this plan instead of listing remote files.
+    order: How to order files with the same subject priority, see planning.ORDERS.
+    time_budget: Don't start any new downloads after this many seconds.
+    jobs: The maximum number of parallel downloads per connection. The actual
+          number is adapted depending on the throughput and errors.
+    retries: How many operations failing with a transient error can be
+             retried in total, see the retry module.
+    reporter: Gets the progress of the run, see the progress module.
+    session: Keep the plugin connections open in this session after the run,
+             and reuse them for the next one.
+    cancel: When set (from another thread or a signal handler), no new
+            downloads are started, and the run ends after the running ones
+            are finished. The files downloaded so far are still written to
+            the file cache, so the next run continues where this one stopped.
+    stats: Collects how long plugin hooks and the phases of the run took, see
+           the instrumentation module. Plugins kept open in a session are
+           only instrumented if they were in the run which connected them.
+    """
+
+    dry_run: bool = attr.ib(default=False)
+    plan: typing.Optional[planning.Plan] = attr.ib(default=None)
+    order: str = attr.ib(default='listing')
+    time_budget: typing.Optional[float] = attr.ib(default=None)
+    jobs: int = attr.ib(default=4)
+    retries: int = attr.ib(default=100)
+    reporter: progress.Reporter = attr.ib(default=attr.Factory(progress.Reporter))
+    session: typing.Optional['Session'] = attr.ib(default=None)
+    cancel: threading.Event = attr.ib(default=attr.Factory(threading.Event))
+    stats: typing.Optional[instrumentation.Stats] = attr.ib(default=None)
+
+
+class Session:
 
+    """Connected plugins, kept open between sync runs.
 
-def _start(connection_name: str, connection_settings: ConnectionSettings) -> None:
-    logger.info(f'Syncing connection {connection_name}')
+    When syncing repeatedly from the same process (e.g. the GUI), this avoids
+    connecting (and authenticating) again for every run. If a kept connection
+    was closed by the server in the meantime, the plugin raises
+    ConnectionLostError, and it is reconnected like in any other case.
 
-    plugin = _load_plugin(connection_settings)
+    A session can't be used by several runs at the same time.
+    """
+
+    def __init__(self) -> None:
+        self._pools: typing.Dict[str, typing.Tuple[ConnectionSettings,
+                                                   concurrency.PluginPool]] = {}
+
+    def get(self, name: str,
+            connection_settings: ConnectionSettings) -> typing.Optional[concurrency.PluginPool]:
+        """Get the plugins of a connection, if its settings didn't change."""
+        if name not in self._pools:
+            return None
+        old_settings, pool = self._pools[name]
+        if (old_settings.plugin_name, old_settings.connection) == (
+                connection_settings.plugin_name, connection_settings.connection):
+            return pool
+
+        logger.debug('Settings of connection %s changed, reconnecting', name)
+        del self._pools[name]
+        pool.disconnect()
+        return None
+
+    def add(self, name: str, connection_settings: ConnectionSettings,
+            pool: concurrency.PluginPool) -> None:
+        self._pools[name] = (connection_settings, pool)
+
+    def close(self) -> None:
+        """Disconnect all plugins."""
+        for _settings, pool in self._pools.values():
+            pool.disconnect()
+        self._pools.clear()
+
+
+def start_all(config_file: typing.Optional[pathlib.Path],
+              options: typing.Optional[SyncOptions] = None) -> planning.Plan:
+    """Synchronize all connections.
+
+    All connections are listed first, then the planned files of all of them
+    are ordered by subject priority and the given order, and downloaded.
+
+    Returns the planned files. When executing a saved plan, files which don't
+    need to be downloaded anymore are skipped, but still part of the result.
+    """
+    if options is None:
+        options = SyncOptions()
+    deadline: typing.Optional[float] = None
+    if options.time_budget is not None:
+        deadline = time.monotonic() + options.time_budget
 
+    settings = Settings.from_yaml_file(config_file)
+    global_limiter = ratelimit.Limiter.from_limit(settings.rate_limit)
+    budget = retry.RetryBudget(options.retries)
+    reporter = options.reporter
+    # Shared by all connections, so an old cache is only migrated once.
+    cache = _open_cache(settings)
+    with instrumentation.timed(options.stats, 'filecache.load'):
+        cache.load()
+    connections: typing.Dict[str, _Connection] = {}
     try:
-        plugin.configure(connection_settings.connection)
-        plugin.connect()
-    except utils.PluginOperationError as ex:
-        logger.error(f'Error from {plugin.NAME} plugin: {ex}, skipping this plugin')
-        return
+        for connection_name, connection_settings in sorted(settings.connections.items()):
+            if options.cancel.is_set():
+                logger.info('Cancelled, skipping the remaining connections')
+                break
+
+            planned: typing.Optional[typing.List[planning.PlannedFile]] = None
+            if options.plan is not None:
+                planned = options.plan.for_connection(connection_name)
+                if not planned:
+                    continue
+
+            limiter = ratelimit.Limiter.from_limit(connection_settings.rate_limit,
+                                                   parent=global_limiter)
+            with instrumentation.timed(options.stats, 'sync.plan'):
+                connection = _prepare(connection_name, connection_settings, cache, planned,
+                                      limiter, jobs=options.jobs, budget=budget,
+                                      reporter=reporter, session=options.session,
+                                      cancel=options.cancel, stats=options.stats)
+            if connection is not None:
+                connections[connection_name] = connection
+
+        if options.plan is not None:
+            unknown = ({planned.connection for planned in options.plan.files} -
+                       set(settings.connections))
+            for connection_name in sorted(unknown):
+                logger.warning('Connection %s from the plan is not configured, skipping it',
+                               connection_name)
+
+        result = planning.Plan(files=planning.schedule(
+            [planned for connection in connections.values() for planned in connection.planned],
+            options.order))
+
+        if not options.dry_run:
+            for planned_file in result.files:
+                reporter.planned(planned_file)
+            with instrumentation.timed(options.stats, 'sync.download'):
+                _execute(result.files, connections, recheck=options.plan is not None,
+                         deadline=deadline, budget=budget, deduplicate=settings.deduplicate,
+                         reporter=reporter, cancel=options.cancel)
+            _log_summary(connections, reporter)
+            if budget.used:
+                logger.info('Retried %d failed operations', budget.used)
+            reporter.finished()
+    finally:
+        try:
+            # Also done on errors, so the files downloaded so far are in the cache.
+            if connections and not options.dry_run:
+                with instrumentation.timed(options.stats, 'filecache.write'):
+                    cache.write()
+        finally:
+            if options.session is None:
+                for connection in connections.values():
+                    connection.pool.disconnect()
+
+    if not options.dry_run:
+        # Stale entries of the synchronized subjects were removed by _prepare already.
+        gc_result = _collect_garbage(settings, compact=False)
+        if gc_result.shards:
+            logger.info('Removed %d unconfigured subjects (%d entries) from the file cache',
+                        gc_result.shards, gc_result.entries)
+
+    return result
+
+
+def _open_cache(settings: Settings) -> filecache.FileCache:
+    """Get the file cache, using the format and content hash of the settings."""
+    return filecache.FileCache(filecache.get_path(), fmt=settings.filecache_format,
+                               hash_algorithm=settings.content_hash)
+
+
+def open_cache(config_file: typing.Optional[pathlib.Path]) -> filecache.FileCache:
+    """Load the file cache for the given configuration file."""
+    cache = _open_cache(Settings.from_yaml_file(config_file))
+    cache.load()
+    return cache
+
+
+def collect_garbage(config_file: typing.Optional[pathlib.Path]) -> filecache.GcResult:
+    """Remove stale entries and unconfigured subjects from the file cache."""
+    settings = Settings.from_yaml_file(config_file)
+    return _collect_garbage(settings, compact=True)
 
-    filecache_path: pathlib.Path = filecache.get_path()
-    cache: filecache.FileCache = filecache.FileCache(filecache_path)
+
+def _collect_garbage(settings: Settings, compact: bool) -> filecache.GcResult:
+    """Remove unconfigured subjects from the file cache.
+
+    If compact is True, also remove entries whose local file doesn't exist
+    anymore from the configured subjects.
+    """
+    cache = _open_cache(settings)
     cache.load()
+    size_before = cache.disk_usage()
 
-    for subject in connection_settings.subjects:
+    removed_entries = 0
+    configured: typing.Set[filecache.SubjectKey] = set()
+    for connection_name, connection_settings in sorted(settings.connections.items()):
+        for subject in connection_settings.subjects:
+            remote_dir = pathlib.PurePath(subject['remote-dir'])
+            local_dir = pathlib.Path(subject['local-dir'])
+            configured.add(filecache.subject_key(connection_name, subject['name'], remote_dir))
+            if not compact:
+                continue
+            if not local_dir.is_dir():
+                # Maybe on a drive which isn't mounted, so keep the entries.
+                logger.warning('Local directory %s does not exist, not compacting its entries',
+                               local_dir)
+                continue
+
+            subject_cache = cache.subject(connection=connection_name, name=subject['name'],
+                                          remote_dir=remote_dir, local_dir=local_dir,
+                                          plugin_name=connection_settings.plugin_name)
+            index = localindex.LocalIndex(local_dir)
+            index.scan()
+            removed_entries += subject_cache.compact(index)
+
+    result = cache.remove_unconfigured(configured, legacy=compact)
+    result.entries += removed_entries
+    cache.write()
+    result.reclaimed_bytes = max(size_before - cache.disk_usage(), 0)
+    return result
+
+
+@attr.s
+class _SubjectRun:
+
+    """The state of a subject needed to download its files."""
+
+    cache: filecache.SubjectCache = attr.ib()
+    index: localindex.LocalIndex = attr.ib()
+
+
+@attr.s
+class _Connection:
+
+    """A connected plugin, with the files planned for it."""
+
+    plugin: AbstractSyncPlugin = attr.ib()
+    cache: filecache.FileCache = attr.ib()
+    runs: typing.Dict[filecache.SubjectKey, _SubjectRun] = attr.ib()
+    planned: typing.List[planning.PlannedFile] = attr.ib()
+    pool: concurrency.PluginPool = attr.ib()
+    controller: concurrency.AimdController = attr.ib()
+    limiter: ratelimit.Limiter = attr.ib(default=attr.Factory(ratelimit.Limiter))
+
+
+def _connect(connection_settings: ConnectionSettings,
+             plugin: typing.Optional[AbstractSyncPlugin] = None,
+             stats: typing.Optional[instrumentation.Stats] = None) -> AbstractSyncPlugin:
+    """Configure and connect the given plugin, or a newly loaded one."""
+    if plugin is None:
+        plugin = _load_plugin(connection_settings, stats=stats)
+    plugin.configure(connection_settings.connection)
+    plugin.connect()
+    return plugin
+
+
+def _prepare(connection_name: str,
+             connection_settings: ConnectionSettings,
+             cache: typing.Optional[filecache.FileCache] = None,
+             planned: typing.Optional[typing.List[planning.PlannedFile]] = None,
+             limiter: typing.Optional[ratelimit.Limiter] = None,
+             jobs: int = 1,
+             budget: typing.Optional[retry.RetryBudget] = None,
+             reporter: typing.Optional[progress.Reporter] = None,
+             session: typing.Optional[Session] = None,
+             cancel: typing.Optional[threading.Event] = None,
+             stats: typing.Optional[instrumentation.Stats] = None
+             ) -> typing.Optional[_Connection]:
+    """Connect to a connection and plan the files to download.
+
+    If planned is given, those files are used instead of listing the remote
+    files. Up to the given number of jobs, files of the connection are
+    downloaded in parallel. If a session is given, its plugins are used if
+    possible, and new ones are added to it. Subjects (and their files) aren't
+    checked anymore once cancel is set. New plugins are instrumented if stats
+    are given. A given cache needs to be loaded already.
+
+    Returns None if the connection failed.
+    """
+    logger.info('Syncing connection %s', connection_name)
+    if limiter is None:
+        limiter = ratelimit.Limiter()
+    if budget is None:
+        budget = retry.RetryBudget(0)
+    if reporter is None:
+        reporter = progress.Reporter()
+    if cancel is None:
+        cancel = threading.Event()
+
+    pool = None if session is None else session.get(connection_name, connection_settings)
+    if pool is None:
+        plugin = _load_plugin(connection_settings, stats=stats)
         try:
-            _sync_subject(subject, plugin, cache)
+            _connect(connection_settings, plugin)
         except utils.PluginOperationError as ex:
-            logger.error(f'Error from {plugin.NAME} plugin: {ex}, skipping this subject')
-            continue
+            logger.error('Error from %s plugin: %s, skipping this plugin', plugin.NAME, ex)
+            reporter.error(connection_name, str(ex))
+            return None
+        pool = concurrency.PluginPool(plugin, lambda: _connect(connection_settings, stats=stats))
+        if session is not None:
+            session.add(connection_name, connection_settings, pool)
+    else:
+        logger.debug('Reusing the connection to %s', connection_name)
+        plugin = pool.plugin
+
+    if cache is None:
+        cache = filecache.FileCache(filecache.get_path())
+        with instrumentation.timed(stats, 'filecache.load'):
+            cache.load()
+
+    runs: typing.Dict[filecache.SubjectKey, _SubjectRun] = {}
+    to_download: typing.List[planning.PlannedFile] = []
+    for subject in connection_settings.subjects:
+        assert plugin.NAME is not None
+        if cancel.is_set():
+            break
+        remote_dir = pathlib.PurePath(subject['remote-dir'])
+        local_dir = pathlib.Path(subject['local-dir'])
+        key = filecache.subject_key(connection_name, subject['name'], remote_dir)
+
+        subject_planned: typing.Optional[typing.List[planning.PlannedFile]] = None
+        if planned is not None:
+            subject_planned = _planned_for_subject(planned, key, local_dir)
+            if not subject_planned:
+                continue
+
+        # Shards of the file cache are only loaded here.
+        with instrumentation.timed(stats, 'filecache.load'):
+            subject_cache: filecache.SubjectCache = cache.subject(
+                connection=connection_name,
+                name=subject['name'],
+                remote_dir=remote_dir,
+                local_dir=local_dir,
+                plugin_name=plugin.NAME,
+            )
+        with instrumentation.timed(stats, 'localindex.scan'):
+            index = _scan_subject(subject_cache)
+
+        if subject_planned is None:
+            reporter.listing(connection_name, subject['name'])
+            try:
+                subject_planned = _plan_subject(connection_name, subject, plugin,
+                                                subject_cache, index, limiter, budget, reporter,
+                                                cancel)
+            except utils.PluginOperationError as ex:
+                logger.error('Error from %s plugin: %s, skipping this subject', plugin.NAME, ex)
+                reporter.error(connection_name, str(ex))
+                continue
+            subject_cache.compact(index)
+
+        runs[key] = _SubjectRun(cache=subject_cache, index=index)
+        to_download += subject_planned
+
+    return _Connection(plugin=plugin, cache=cache, runs=runs, planned=to_download,
+                       pool=pool, controller=concurrency.AimdController(jobs),
+                       limiter=limiter)
+
+
+def _execute(files: typing.List[planning.PlannedFile],
+             connections: typing.Dict[str, _Connection],
+             recheck: bool,
+             deadline: typing.Optional[float],
+             budget: typing.Optional[retry.RetryBudget] = None,
+             deduplicate: str = 'off',
+             reporter: typing.Optional[progress.Reporter] = None,
+             cancel: typing.Optional[threading.Event] = None) -> None:
+    """Download the given files, until the deadline (if any) passed or cancel is set.
+
+    Files of each connection are started in the given order, with as many
+    parallel downloads as the connection's controller allows. Downloads
+    failing with a transient error are retried, as long as the budget allows.
+
+    Unless deduplicate is 'off', identical remote files planned for several
+    subjects are only downloaded once, see the dedup module.
+    """
+    if budget is None:
+        budget = retry.RetryBudget(0)
+    if reporter is None:
+        reporter = progress.Reporter()
+    if cancel is None:
+        cancel = threading.Event()
+    queues: typing.Dict[str, typing.Deque[typing.List[planning.PlannedFile]]] = \
+        collections.OrderedDict()
+    for group in _group_duplicates(files, deduplicate):
+        queues.setdefault(group[0].connection, collections.deque()).append(group)
+
+    # Protects the file caches and local indexes, which are shared by all downloads.
+    lock = threading.Lock()
+    max_workers = sum(connections[name].controller.maximum for name in queues) or 1
+    # Future isn't subscriptable at runtime before Python 3.9.
+    running: typing.Dict['concurrent.futures.Future[int]',
+                         typing.Tuple[_Connection, AbstractSyncPlugin,
+                                      typing.List[planning.PlannedFile]]] = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            remaining = sum(len(group) for queue in queues.values() for group in queue)
+            reason = None
+            if remaining and cancel.is_set():
+                reason = 'Cancelled'
+            elif remaining and deadline is not None and time.monotonic() >= deadline:
+                reason = 'Time budget exhausted'
+            if reason is not None:
+                logger.info('%s, skipping %d remaining files', reason, remaining)
+                for queue in queues.values():
+                    for group in queue:
+                        for planned_file in group:
+                            reporter.skipped(planned_file)
+                queues.clear()
+
+            for connection_name, queue in queues.items():
+                connection = connections[connection_name]
+                while queue and connection.controller.has_capacity():
+                    plugin = connection.pool.acquire()
+                    if plugin is None:
+                        connection.controller.cap(len(connection.pool))
+                        break
+
+                    group = queue.popleft()
+                    connection.controller.started()
+                    future = executor.submit(_download, group, plugin, connection,
+                                             recheck=recheck, budget=budget, lock=lock,
+                                             deduplicate=deduplicate, reporter=reporter)
+                    running[future] = (connection, plugin, group)
+
+            if not running:
+                break
+
+            done, _pending = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                connection, plugin, group = running.pop(future)
+                connection.pool.release(plugin)
+                try:
+                    size = future.result()
+                except utils.PluginOperationError as ex:
+                    count = len(group)
+                    what = 'this file' if count == 1 else f'this file and {count - 1} copies'
+                    logger.error('Error from %s plugin: %s, skipping %s', plugin.NAME, ex, what)
+                    connection.controller.failed()
+                    continue
+                connection.controller.finished(size)
 
     logger.info('')
-    cache.write()
-    plugin.disconnect()
 
 
-def _sync_subject(subject: utils.JsonType,
+def _group_duplicates(files: typing.List[planning.PlannedFile],
+                      deduplicate: str) -> typing.List[typing.List[planning.PlannedFile]]:
+    """Group identical remote files, keeping the order of their first occurrence."""
+    if deduplicate == 'off':
+        return [[planned_file] for planned_file in files]
+
+    groups: typing.Dict[typing.Tuple[str, pathlib.PurePath, str],
+                        typing.List[planning.PlannedFile]] = collections.OrderedDict()
+    for planned_file in files:
+        key = (planned_file.connection, planned_file.remote_path, planned_file.remote_digest)
+        groups.setdefault(key, []).append(planned_file)
+    return list(groups.values())
+
+
+def _download(group: typing.List[planning.PlannedFile],
+              plugin: AbstractSyncPlugin,
+              connection: _Connection,
+              recheck: bool,
+              budget: retry.RetryBudget,
+              lock: threading.Lock,
+              deduplicate: str,
+              reporter: typing.Optional[progress.Reporter] = None) -> int:
+    """Download the first file of a group, and create the others as local copies.
+
+    Returns the number of bytes downloaded.
+    """
+    if reporter is None:
+        reporter = progress.Reporter()
+    pending = list(group)
+
+    def retrieve(planned_file: planning.PlannedFile) -> typing.Optional[_Retrieved]:
+        run = connection.runs[planned_file.subject_key]
+        retrieved = budget.call(
+            functools.partial(_retrieve, planned_file, plugin, run.cache, run.index,
+                              recheck=recheck, limiter=connection.limiter, lock=lock,
+                              reporter=reporter),
+            plugin, f'Downloading {planned_file.remote_path}',
+            on_retry=connection.controller.backoff)
+        pending.remove(planned_file)
+        if retrieved is None:
+            reporter.skipped(planned_file)
+        else:
+            reporter.done(planned_file, retrieved.size)
+        return retrieved
+
+    try:
+        first, *duplicates = group
+        retrieved = retrieve(first)
+        size = 0 if retrieved is None else retrieved.size
+
+        for planned_file in duplicates:
+            if retrieved is None:
+                # Skipped because it didn't change, but the copies might have.
+                other = retrieve(planned_file)
+                size += 0 if other is None else other.size
+                continue
+
+            run = connection.runs[planned_file.subject_key]
+            if recheck and not _still_needed(planned_file, plugin, run.cache, run.index,
+                                             connection.limiter, lock):
+                pending.remove(planned_file)
+                reporter.skipped(planned_file)
+                continue
+            if planned_file.remote_digest != first.remote_digest:
+                # Changed again since the first copy was downloaded
+                other = retrieve(planned_file)
+                size += 0 if other is None else other.size
+                continue
+
+            method = dedup.materialize(first.local_path, planned_file.local_path, deduplicate)
+            logger.info('Created %s as %s of %s', planned_file.local_path, method, first.local_path)
+            stat = _update_cache(planned_file, plugin, run.cache, run.index,
+                                 retrieved.content_hash, lock)
+            pending.remove(planned_file)
+            reporter.done(planned_file, stat.st_size)
+    except utils.PluginOperationError as ex:
+        for planned_file in pending:
+            reporter.error(planned_file.connection, str(ex), planned_file)
+        raise
+
+    return size
+
+
+def _log_summary(connections: typing.Dict[str, _Connection],
+                 reporter: typing.Optional[progress.Reporter] = None) -> None:
+    if reporter is None:
+        reporter = progress.Reporter()
+    for connection_name, connection in sorted(connections.items()):
+        controller = connection.controller
+        if not controller.files and not controller.errors:
+            continue
+        reporter.summary(connection_name, files=controller.files, size=controller.total_bytes,
+                         failed=controller.errors, seconds=controller.elapsed)
+        logger.info('%s: %d files (%s) in %.1fs, %s/s, %d failed, '
+                    'up to %d parallel downloads (%d at the end)',
+                    connection_name, controller.files,
+                    planning.format_size(controller.total_bytes), controller.elapsed,
+                    planning.format_size(int(controller.throughput)), controller.errors,
+                    controller.peak, controller.limit)
+
+
+def _planned_for_subject(planned: typing.List[planning.PlannedFile],
+                         key: filecache.SubjectKey,
+                         local_dir: pathlib.Path) -> typing.List[planning.PlannedFile]:
+    """Get the files of a saved plan which belong to the given subject."""
+    result = []
+    for planned_file in planned:
+        if planned_file.subject_key != key:
+            continue
+        if planned_file.local_dir != local_dir:
+            logger.warning('The local directory of %s changed since the plan was created, '
+                           'skipping it', planned_file.remote_path)
+            continue
+        result.append(planned_file)
+    return result
+
+
+class Drift(enum.Enum):
+    """How a cached local file differs from the cache."""
+
+    MISSING = 1
+    MODIFIED = 2
+
+
+VerifyResults = typing.Iterator[typing.Tuple[pathlib.Path, typing.Optional[Drift]]]
+
+
+def _verify_file(path: pathlib.Path,
+                 file: filecache.File,
+                 plugin: AbstractSyncPlugin,
+                 hash_algorithm: typing.Optional[str]) -> typing.Optional[Drift]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return Drift.MISSING
+
+    hashes = file.hashes
+    if (hash_algorithm is not None and hashes is not None and
+            hashes.synced.startswith(hash_algorithm + '-')):
+        if hashing.signature(stat) == hashes.signature:
+            content_hash = hashes.current
+        else:
+            content_hash = hashing.hash_file(path, hash_algorithm)
+        changed = content_hash != hashes.synced
+    else:
+        changed = plugin.create_local_digest_from_stat(path, stat) != file.cached_digest
+
+    return Drift.MODIFIED if changed else None
+
+
+def verify_cache(config_file: typing.Optional[pathlib.Path],
+                 jobs: typing.Optional[int] = None) -> typing.Tuple[int, VerifyResults]:
+    """Check all cached local files against the file cache, in parallel.
+
+    Files are checked with their plugin's local digest, or their content hash
+    if content hashes are enabled. The cache isn't modified.
+
+    Returns the number of files to check, and an iterator which checks them,
+    yielding (path, drift) for every file (with drift being None if the file
+    is unchanged).
+    """
+    settings = Settings.from_yaml_file(config_file)
+    cache = _open_cache(settings)
+    cache.load()
+
+    tasks = []
+    for connection_name, connection_settings in sorted(settings.connections.items()):
+        plugin = _load_plugin(connection_settings)
+        for subject in connection_settings.subjects:
+            subject_cache = cache.subject(
+                connection=connection_name, name=subject['name'],
+                remote_dir=pathlib.PurePath(subject['remote-dir']),
+                local_dir=pathlib.Path(subject['local-dir']),
+                plugin_name=connection_settings.plugin_name)
+            for key, file in subject_cache.items():
+                if file.cached_digest is not None:
+                    tasks.append((subject_cache.root / key, file, plugin))
+
+    def run() -> VerifyResults:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(_verify_file, path, file, plugin,
+                                       settings.content_hash): path
+                       for path, file, plugin in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    drift = future.result()
+                except OSError as ex:
+                    logger.warning('Could not verify %s: %s', path, ex)
+                    continue
+                yield path, drift
+
+    return len(tasks), run()
+
+
+def _scan_subject(cache: filecache.SubjectCache) -> localindex.LocalIndex:
+    index = localindex.LocalIndex(cache.root)
+    index.scan()
+    if cache.hash_algorithm is not None:
+        cache.update_hashes(index)
+    return index
+
+
+def _plan_subject(connection_name: str,
+                  subject: utils.JsonType,
                   plugin: AbstractSyncPlugin,
-                  cache: filecache.FileCache) -> None:
-    logger.info(f'Syncing subject {subject["name"]}')
+                  cache: filecache.SubjectCache,
+                  index: localindex.LocalIndex,
+                  limiter: typing.Optional[ratelimit.Limiter] = None,
+                  budget: typing.Optional[retry.RetryBudget] = None,
+                  reporter: typing.Optional[progress.Reporter] = None,
+                  cancel: typing.Optional[threading.Event] = None
+                  ) -> typing.List[planning.PlannedFile]:
+    """Check the remote files of a subject and return the ones to download.
+
+    Once cancel is set, no further files are checked, and only the ones
+    planned so far are returned.
+    """
+    logger.info('Syncing subject %s', subject['name'])
+    if limiter is None:
+        limiter = ratelimit.Limiter()
+    if budget is None:
+        budget = retry.RetryBudget(0)
+    if reporter is None:
+        reporter = progress.Reporter()
+    if cancel is None:
+        cancel = threading.Event()
 
     remote_dir = pathlib.PurePath(subject['remote-dir'])  # /Informatik/Fachbereich/EPJ/
     local_dir = pathlib.Path(subject['local-dir'])  # /home/leonie/HSR/EPJ/
 
     ignore: typing.List[str] = subject['ignore']
 
-    for remote_full_path in plugin.list_path(remote_dir):
+    planned: typing.List[planning.PlannedFile] = []
+    listed = 0
+
+    def list_path() -> typing.List[pathlib.PurePath]:
+        limiter.request()
+        return list(plugin.list_path(remote_dir))
+
+    for remote_full_path in budget.call(list_path, plugin, f'Listing {remote_dir}'):
+        if cancel.is_set():
+            logger.info('Cancelled while checking %s', remote_dir)
+            break
         if remote_full_path.name in ignore:
-            logger.debug(f'Ignoring file {remote_full_path}')
+            logger.debug('Ignoring file %s', remote_full_path)
             continue
+        listed += 1
         try:
-            _sync_path(remote_full_path, local_dir, remote_dir, plugin, cache)
+            state_of_file, remote_digest, local_full_path = budget.call(
+                functools.partial(_plan_path, remote_full_path, local_dir, remote_dir,
+                                  plugin, cache, index, limiter),
+                plugin, f'Checking {remote_full_path}')
         except utils.PluginOperationError as ex:
-            logger.error(f'Error from {plugin.NAME} plugin: {ex}, skipping this file')
+            logger.error('Error from %s plugin: %s, skipping this file', plugin.NAME, ex)
+            reporter.error(connection_name, f'{remote_full_path}: {ex}')
             continue
 
+        if state_of_file is not None:
+            planned.append(planning.PlannedFile(
+                connection=connection_name,
+                subject=subject['name'],
+                remote_dir=remote_dir,
+                local_dir=local_dir,
+                remote_path=remote_full_path,
+                local_path=local_full_path,
+                state=state_of_file,
+                remote_digest=remote_digest,
+                size=plugin.remote_size(remote_full_path),
+                mtime=plugin.remote_mtime(remote_full_path),
+                priority=subject['priority'],
+            ))
+
+    reporter.listed(connection_name, subject['name'], listed)
+    return planned
+
+
+def _remote_digest(remote_full_path: pathlib.PurePath,
+                   plugin: AbstractSyncPlugin,
+                   limiter: typing.Optional[ratelimit.Limiter] = None) -> str:
+    if limiter is not None:
+        limiter.request()
+    remote_digest = plugin.create_remote_digest(remote_full_path)
+    logger.debug('Remote digest: %s', remote_digest)
+    return remote_digest
 
-def _sync_path(remote_full_path: pathlib.PurePath,
+
+def _plan_path(remote_full_path: pathlib.PurePath,
                local_dir: pathlib.Path,
                remote_dir: pathlib.PurePath,
                plugin: AbstractSyncPlugin,
-               cache: filecache.FileCache) -> None:
+               cache: filecache.SubjectCache,
+               index: localindex.LocalIndex,
+               limiter: typing.Optional[ratelimit.Limiter] = None,
+               remote_digest: typing.Optional[str] = None
+               ) -> typing.Tuple[typing.Optional[filecache.FileState], str, pathlib.Path]:
+    """Check whether the given remote file needs to be downloaded.
+
+    If the remote digest is given (e.g. because it was requested without
+    holding a lock), the plugin isn't asked for it again.
+
+    Returns the state of the file (or None if it doesn't need to be
+    downloaded), its remote digest and the local path.
+    """
     # each plugin should now yield all files recursively with list_path
-    logger.debug(f'Checking: {remote_full_path}')
+    logger.debug('Checking: %s', remote_full_path)
 
-    remote_digest = plugin.create_remote_digest(remote_full_path)
-    logger.debug(f'Remote digest: {remote_digest}')
+    if remote_digest is None:
+        remote_digest = _remote_digest(remote_full_path, plugin, limiter)
 
     # local_dir: /home/leonie/HSR/EPJ/
     # remote_full_path: /Informatik/Fachbereich/EPJ/Dokumente/Anleitung.pdf
@@ -121,29 +811,149 @@ def _sync_path(remote_full_path: pathlib.PurePath,
     # When both files changed, we currently override the local file, but this can and should
     # later be handled as a user decision. https://jira.keltec.ch/jira/browse/EPJ-78
     state_of_file: filecache.FileState = cache.discover_changes(
-        local_full_path=local_full_path, remote_full_path=remote_full_path, plugin=plugin)
+        local_full_path=local_full_path, remote_full_path=remote_full_path, plugin=plugin,
+        index=index, remote_digest=remote_digest)
     if state_of_file in [filecache.FileState.NO_CHANGES,
                          filecache.FileState.LOCAL_CHANGED]:
         logger.debug("No remote changes.")
+        return None, remote_digest, local_full_path
     elif state_of_file in [filecache.FileState.REMOTE_CHANGED,
                            filecache.FileState.NEW,
                            filecache.FileState.BOTH_CHANGED]:
-        logger.info(f"Downloading {remote_full_path}")
-        local_full_path.parent.mkdir(parents=True, exist_ok=True)
+        return state_of_file, remote_digest, local_full_path
+    else:
+        raise AssertionError(f"Unhandled state {state_of_file} for {local_full_path}")
+
+
+@attr.s
+class _Retrieved:
+
+    """A downloaded file."""
+
+    size: int = attr.ib()
+    content_hash: typing.Optional[str] = attr.ib()
+
 
-        with local_full_path.open('wb') as fileobj:
-            mtime: typing.Optional[int] = plugin.retrieve_file(remote_full_path, fileobj)
+def _retrieve(planned: planning.PlannedFile,
+              plugin: AbstractSyncPlugin,
+              cache: filecache.SubjectCache,
+              index: localindex.LocalIndex,
+              recheck: bool = False,
+              limiter: typing.Optional[ratelimit.Limiter] = None,
+              lock: typing.Optional[threading.Lock] = None,
+              reporter: typing.Optional[progress.Reporter] = None) -> typing.Optional[_Retrieved]:
+    """Download a planned file and update the file cache.
+
+    With recheck=True (for files from a saved plan), the file is only
+    downloaded if it still needs to be. If a limiter is given, the download
+    counts as a request and its bandwidth is limited. The lock is held while
+    accessing the cache and index, for parallel downloads. The transferred
+    bytes are reported to the reporter, if given.
+
+    The file is downloaded to a temporary file next to it first, which then
+    replaces the file. That way, a failed (or killed) download never leaves a
+    half-written file, and a file which was there before stays unchanged.
+
+    Returns None if the file was skipped.
+    """
+    if limiter is None:
+        limiter = ratelimit.Limiter()
+    if lock is None:
+        lock = threading.Lock()
+    remote_full_path = planned.remote_path
+    local_full_path = planned.local_path
+
+    if recheck and not _still_needed(planned, plugin, cache, index, limiter, lock):
+        return None
+
+    logger.info('Downloading %s', remote_full_path)
+    local_full_path.parent.mkdir(parents=True, exist_ok=True)
+
+    content_hash: typing.Optional[str] = None
+    temp_path = local_full_path.with_name(f'.{local_full_path.name}{PARTIAL_SUFFIX}')
+    limiter.request()
+    try:
+        with temp_path.open('wb') as fileobj:
+            target: typing.IO[bytes] = fileobj
+            if limiter.limits_bytes:
+                target = typing.cast(typing.IO[bytes], ratelimit.ThrottledWriter(target, limiter))
+            if reporter is not None and reporter.enabled:
+                target = typing.cast(typing.IO[bytes],
+                                     progress.ProgressWriter(target, reporter, planned))
+
+            if cache.hash_algorithm is None:
+                mtime: typing.Optional[int] = plugin.retrieve_file(remote_full_path, target)
+            else:
+                # Hash the file while writing it, instead of reading it again.
+                writer = hashing.HashingWriter(target, cache.hash_algorithm)
+                mtime = plugin.retrieve_file(remote_full_path, typing.cast(typing.IO[bytes], writer))
+                content_hash = writer.content_hash()
 
         if mtime is not None:
-            os.utime(local_full_path, (local_full_path.stat().st_atime, mtime))
+            # We just wrote the file, so its atime is now anyways.
+            os.utime(str(temp_path), (time.time(), mtime))
+        os.replace(str(temp_path), str(local_full_path))
+    except BaseException:
+        try:
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
 
-        local_digest = plugin.create_local_digest(local_full_path)
-        logger.debug(f"Local digest: {local_digest}")
+    stat = _update_cache(planned, plugin, cache, index, content_hash, lock)
+    return _Retrieved(size=stat.st_size, content_hash=content_hash)
 
-        assert remote_digest == local_digest, local_full_path
-        cache.modify(local_full_path, plugin, local_digest)
-    else:
-        raise AssertionError(f"Unhandled state {state_of_file} for {local_full_path}")
+
+def _still_needed(planned: planning.PlannedFile,
+                  plugin: AbstractSyncPlugin,
+                  cache: filecache.SubjectCache,
+                  index: localindex.LocalIndex,
+                  limiter: typing.Optional[ratelimit.Limiter],
+                  lock: threading.Lock) -> bool:
+    """Check whether a file from a saved plan still needs to be downloaded.
+
+    This also updates the remote digest of the planned file. The lock is only
+    held while accessing the cache and index, not for the (rate-limited)
+    request of the remote digest, so parallel downloads can recheck their
+    files at the same time.
+    """
+    remote_digest = _remote_digest(planned.remote_path, plugin, limiter)
+    with lock:
+        state_of_file, remote_digest, _local_full_path = _plan_path(
+            planned.remote_path, planned.local_dir, planned.remote_dir, plugin, cache, index,
+            remote_digest=remote_digest)
+    if state_of_file is None:
+        logger.info('%s has no remote changes anymore, skipping it', planned.remote_path)
+        return False
+    planned.remote_digest = remote_digest
+    return True
+
+
+def _update_cache(planned: planning.PlannedFile,
+                  plugin: AbstractSyncPlugin,
+                  cache: filecache.SubjectCache,
+                  index: localindex.LocalIndex,
+                  content_hash: typing.Optional[str],
+                  lock: threading.Lock) -> os.stat_result:
+    """Record a downloaded (or copied) file in the cache.
+
+    If the file changed on the server since it was planned, the downloaded
+    file doesn't match the planned remote digest. It isn't recorded then, so
+    the next sync checks it again, and a PluginOperationError is raised.
+    """
+    local_full_path = planned.local_path
+    with lock:
+        stat: os.stat_result = index.refresh(local_full_path.relative_to(index.root).as_posix())
+        local_digest = plugin.create_local_digest_from_stat(local_full_path, stat)
+        logger.debug('Local digest: %s', local_digest)
+
+        if planned.remote_digest != local_digest:
+            logger.debug('Planned remote digest %s, but got %s for %s',
+                         planned.remote_digest, local_digest, local_full_path)
+            raise utils.PluginOperationError(
+                f'{planned.remote_path} changed on the server during the download')
+        cache.modify(local_full_path, plugin, local_digest, content_hash=content_hash, stat=stat)
+    return stat
 
 
 def validate_config(config_file: typing.Optional[pathlib.Path]) -> None:
@@ -1,5 +1,6 @@
 """Abstract base class for a synchronization plugin."""
 
+import os
 import abc
 import pathlib
 import typing
@@ -11,11 +12,17 @@ class AbstractSyncPlugin(metaclass=abc.ABCMeta):
 
     """The specification/"interface" a synchronization plugin implements.
 
-    Every abstract method in this class is a plugin hook.
+    Every abstract method in this class is a plugin hook. Other methods are
+    optional hooks with a default implementation.
     """
 
     NAME: typing.Optional[str] = None
 
+    # Whether one plugin instance can download several files at the same time
+    # from different threads. If not, kitovu creates another instance (and
+    # thus server connection) per parallel download.
+    THREAD_SAFE: bool = False
+
     @abc.abstractmethod
     def configure(self, info: typing.Dict[str, typing.Any]) -> None:
         """Read a configuration section intended for this plugin."""
@@ -39,11 +46,36 @@ class AbstractSyncPlugin(metaclass=abc.ABCMeta):
         """Create a digest for the given local file."""
         raise NotImplementedError
 
+    def create_local_digest_from_stat(self, path: pathlib.Path, stat: os.stat_result) -> str:
+        """Create a digest for the given local file, with already known stat information.
+
+        kitovu scans local directories up front, so plugins with a digest based
+        on the file size/mtime should override this to avoid another stat call.
+        """
+        return self.create_local_digest(path)
+
     @abc.abstractmethod
     def create_remote_digest(self, path: pathlib.PurePath) -> str:
         """Create a digest for the given remote file."""
         raise NotImplementedError
 
+    def remote_size(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        """Get the size of the given remote file in bytes, if known.
+
+        This is called after create_remote_digest for the same path, so plugins
+        can use information they got there. It's only used to show how much
+        data is going to be downloaded; None means the size isn't known.
+        """
+        return None
+
+    def remote_mtime(self, path: pathlib.PurePath) -> typing.Optional[int]:
+        """Get the last modified time of the given remote file, if known.
+
+        Like remote_size, this is called after create_remote_digest. It's used
+        to download recently changed files first, if requested.
+        """
+        return None
+
     @abc.abstractmethod
     def list_path(self, path: pathlib.PurePath) -> typing.Iterable[pathlib.PurePath]:
         """List all files recursively in the given remote path."""
@@ -1,12 +1,14 @@
 """Various utility classes/functions."""
 
+import json
 import typing
 import getpass
+import functools
 import logging
 import pathlib
 
-import keyring
-import jsonschema
+if typing.TYPE_CHECKING:
+    import jsonschema
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -22,6 +24,7 @@ def get_password(plugin: str, identifier: str, prompt: str) -> str:
     """
     service = f'kitovu-{plugin}'
     logger.debug(f'Getting password for {service}, identifier {identifier}')
+    import keyring  # slow to import, and not needed by most commands
     password: typing.Optional[str] = keyring.get_password(service, identifier)
     if password is None:
         password = getpass.getpass(f"Enter password for {plugin} ({prompt}): ")
@@ -47,16 +50,33 @@ def sanitize_filename(name: pathlib.PurePath) -> pathlib.PurePath:
 JsonType = typing.Dict[str, typing.Any]
 
 
+@functools.lru_cache(maxsize=128)
+def _compile_schema(schema_json: str) -> typing.Any:
+    import jsonschema  # slow to import
+    schema = json.loads(schema_json)
+    validator_type = jsonschema.validators.validator_for(schema)
+    return validator_type(schema)
+
+
+def compile_schema(schema: JsonType) -> typing.Any:
+    """Get a jsonschema validator instance for the given schema.
+
+    Validators are cached by the schema's content, as plugins usually return a
+    new (but equal) schema for every connection. The keys aren't sorted, as
+    their order determines the order of the reported errors.
+    """
+    return _compile_schema(json.dumps(schema))
+
+
 class SchemaValidator:
     """A validator for creating and merging errors in schema definitions."""
 
     def __init__(self, abort: bool = True) -> None:
-        self.errors: typing.List[jsonschema.exceptions.ValidationError] = []
+        self.errors: typing.List['jsonschema.exceptions.ValidationError'] = []
         self._abort: bool = abort
 
     def validate(self, data: typing.Any, schema: JsonType) -> None:
-        validator_type = jsonschema.validators.validator_for(schema)
-        self.errors.extend(validator_type(schema).iter_errors(data))
+        self.errors.extend(compile_schema(schema).iter_errors(data))
         if self._abort and not self.is_valid:
             self.raise_error()
 
@@ -98,3 +118,14 @@ class PluginOperationError(Error):
 
 class AuthenticationError(PluginOperationError):
     """Thrown when the authentication could not be completed."""
+
+
+class TransientError(PluginOperationError):
+    """Thrown when something in a plugin fails, but might work when retried.
+
+    Examples are timeouts or an overloaded server.
+    """
+
+
+class ConnectionLostError(TransientError):
+    """Thrown when the connection to the server was lost, and needs to be re-established."""
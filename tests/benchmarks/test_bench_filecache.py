@@ -0,0 +1,89 @@
+"""Memory usage and load/write speed of the FileCache."""
+
+import pathlib
+import time
+import tracemalloc
+
+import pytest
+
+from kitovu.sync import filecache
+
+
+ENTRY_COUNT = 1_000_000
+SUBJECT_COUNT = 50
+
+
+def _subject_kwargs(temppath, number):
+    return {
+        'connection': 'skripte',
+        'name': f'Subject{number}',
+        'remote_dir': pathlib.PurePath(f'Informatik/Fachbereich/Subject{number}'),
+        'local_dir': temppath / f'Subject{number}',
+        'plugin_name': 'smb',
+    }
+
+
+def _write_cache_file(temppath, path, count):
+    cache = filecache.FileCache(path)
+    subjects = [cache.subject(**_subject_kwargs(temppath, number))
+                for number in range(SUBJECT_COUNT)]
+    for i in range(count):
+        subject_cache = subjects[i % SUBJECT_COUNT]
+        key = f'Unterlagen/Woche{i % 14}/file{i}.pdf'
+        subject_cache._data[key] = filecache.File(cached_digest=f'{i}-1520000000')
+    cache.write()
+
+
+@pytest.mark.benchmark
+def test_memory_per_entry(temppath):
+    cache_dir = temppath / 'filecache'
+    _write_cache_file(temppath, cache_dir, ENTRY_COUNT)
+    disk_size = sum(path.stat().st_size for path in cache_dir.iterdir())
+
+    cache = filecache.FileCache(cache_dir)
+    tracemalloc.start()
+    start = time.perf_counter()
+    cache.load()
+    for number in range(SUBJECT_COUNT):
+        cache.subject(**_subject_kwargs(temppath, number))
+    duration = time.perf_counter() - start
+    # The JSON data was freed again at this point, so this only counts the cache itself.
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"\n{ENTRY_COUNT} entries: {size / ENTRY_COUNT:.0f} bytes/entry, "
+          f"loaded in {duration:.2f}s (with tracemalloc), "
+          f"{disk_size / ENTRY_COUNT:.0f} bytes/entry on disk")
+    assert size / ENTRY_COUNT < 400
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('count', [10_000, 100_000, 1_000_000])
+@pytest.mark.parametrize('fmt', ['json', 'binary'])
+def test_load_write(temppath, count, fmt):
+    cache_dir = temppath / 'filecache'
+    cache = filecache.FileCache(cache_dir, fmt=fmt)
+    subject_cache = cache.subject(**_subject_kwargs(temppath, 0))
+    for i in range(count):
+        key = f'Unterlagen/Woche{i % 14}/file{i}.pdf'
+        subject_cache._data[key] = filecache.File(cached_digest=f'{i}-1520000000')
+
+    start = time.perf_counter()
+    cache.write()
+    write_duration = time.perf_counter() - start
+
+    del cache, subject_cache
+    cache = filecache.FileCache(cache_dir, fmt=fmt)
+    start = time.perf_counter()
+    cache.load()
+    subject_cache = cache.subject(**_subject_kwargs(temppath, 0))
+    middle = count // 2
+    file = subject_cache._lookup(f'Unterlagen/Woche{middle % 14}/file{middle}.pdf')
+    lookup_duration = time.perf_counter() - start
+    subject_cache.materialize()
+    load_duration = time.perf_counter() - start
+
+    assert file is not None
+    assert len(subject_cache) == count
+    print(f"\n{fmt}, {count} entries: write {write_duration * 1000:.0f} ms, "
+          f"first lookup {lookup_duration * 1000:.1f} ms, full load {load_duration * 1000:.0f} ms")
@@ -0,0 +1,72 @@
+"""Content hashing of a tree of multi-GB files, sequential vs. parallel."""
+
+import os
+import time
+
+import pytest
+
+from kitovu.sync import filecache, hashing, localindex
+from helpers import dummyplugin
+
+
+FILE_COUNT = 4
+FILE_SIZE = 2 * 1024 ** 3
+
+
+@pytest.fixture(scope='module')
+def big_tree(tmp_path_factory):
+    """FILE_COUNT sparse files of FILE_SIZE bytes each."""
+    local_dir = tmp_path_factory.mktemp('bench') / 'local'
+    local_dir.mkdir()
+    paths = []
+    for i in range(FILE_COUNT):
+        path = local_dir / f'file{i}.iso'
+        with path.open('wb') as f:
+            f.truncate(FILE_SIZE)
+        paths.append(path)
+    return local_dir, paths
+
+
+def _throughput(paths, jobs):
+    start = time.perf_counter()
+    results = hashing.hash_files(paths, 'sha256', jobs=jobs)
+    elapsed = time.perf_counter() - start
+    assert len(results) == len(paths)
+    return FILE_COUNT * FILE_SIZE / elapsed / 1024 ** 2
+
+
+@pytest.mark.benchmark
+def test_parallel_hashing(big_tree):
+    _local_dir, paths = big_tree
+    sequential = _throughput(paths, jobs=1)
+    parallel = _throughput(paths, jobs=os.cpu_count())
+    print(f"\n{FILE_COUNT} x {FILE_SIZE // 1024 ** 3} GiB, sha256: "
+          f"1 thread {sequential:.0f} MiB/s, {os.cpu_count()} threads {parallel:.0f} MiB/s")
+    if (os.cpu_count() or 1) > 1:
+        assert parallel > sequential
+
+
+@pytest.mark.benchmark
+def test_unchanged_files_are_not_hashed(big_tree, tmp_path):
+    local_dir, paths = big_tree
+    plugin = dummyplugin.DummyPlugin(tmp_path)
+    cache = filecache.FileCache(tmp_path / 'filecache', hash_algorithm='sha256').subject(
+        connection='connection', name='subject', remote_dir=local_dir, local_dir=local_dir,
+        plugin_name=plugin.NAME)
+    for path in paths:
+        cache.modify(path, plugin, 'digest', content_hash='sha256-outdated', stat=path.stat())
+    os.utime(str(paths[0]), ns=(0, 0))
+
+    index = localindex.LocalIndex(local_dir)
+    index.scan()
+
+    start = time.perf_counter()
+    assert cache.update_hashes(index) == 1
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert cache.update_hashes(index) == 0
+    second = time.perf_counter() - start
+
+    print(f"\nupdate_hashes with 1 touched file: {first:.2f} s, unchanged: {second * 1e3:.2f} ms")
+    assert second < first
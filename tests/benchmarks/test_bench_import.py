@@ -0,0 +1,42 @@
+"""Startup time of the command line interface.
+
+The GUI runs "python -m kitovu sync" for every sync, so the startup time is
+paid on every click.
+"""
+
+import sys
+import subprocess
+
+import pytest
+
+
+# Cumulative import time of kitovu.cli, in seconds.
+STARTUP_BUDGET = 0.3
+RUNS = 5
+
+
+def _import_times(module):
+    """Get the cumulative import times (in seconds) reported by -X importtime."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          check=True, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us) / 1_000_000
+    return times
+
+
+@pytest.mark.benchmark
+def test_cli_startup():
+    runs = [_import_times('kitovu.cli') for _ in range(RUNS)]
+    best = min(run['kitovu.cli'] for run in runs)
+
+    slowest = sorted(runs[0].items(), key=lambda item: item[1], reverse=True)[:10]
+    print()
+    print(f"import kitovu.cli: {best * 1000:.1f} ms (best of {RUNS})")
+    for name, seconds in slowest:
+        print(f"  {name}: {seconds * 1000:.1f} ms")
+
+    assert best < STARTUP_BUDGET
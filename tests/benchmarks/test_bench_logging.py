@@ -0,0 +1,88 @@
+"""Per-file logging overhead of the sync engine at info vs. debug level."""
+
+import logging
+import pathlib
+import time
+
+import pytest
+
+from kitovu.sync import syncing, filecache, localindex
+from helpers import dummyplugin
+
+
+FILE_COUNT = 100_000
+
+
+class _FormattingHandler(logging.Handler):
+
+    """A handler which formats every record like a real one would, but drops the result."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.format(record)
+
+
+@pytest.fixture(scope='module')
+def synced_tree(tmp_path_factory):
+    """A local tree of FILE_COUNT files which are all up to date."""
+    temppath = tmp_path_factory.mktemp('bench')
+    local_dir = temppath / 'local'
+    remote_dir = pathlib.PurePath('remote')
+
+    local_digests = {}
+    remote_digests = {}
+    for i in range(FILE_COUNT):
+        local_path = local_dir / f'dir{i % 100}' / f'file{i}.pdf'
+        remote_digests[remote_dir / f'dir{i % 100}' / f'file{i}.pdf'] = str(i)
+        local_digests[local_path] = str(i)
+
+    for i in range(100):
+        (local_dir / f'dir{i}').mkdir(parents=True)
+    for path in local_digests:
+        path.touch()
+
+    plugin = dummyplugin.DummyPlugin(temppath, local_digests=local_digests,
+                                     remote_digests=remote_digests)
+    plugin.connect()
+
+    cache = filecache.FileCache(temppath / 'filecache.json').subject(
+        connection='connection', name='subject', remote_dir=remote_dir, local_dir=local_dir,
+        plugin_name=plugin.NAME)
+    for path, digest in local_digests.items():
+        cache.modify(path, plugin, digest)
+
+    index = localindex.LocalIndex(local_dir)
+    index.scan()
+
+    return plugin, cache, index, local_dir, remote_dir
+
+
+@pytest.fixture
+def kitovu_logger(monkeypatch):
+    logger = logging.getLogger('kitovu')
+    handler = _FormattingHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)5s] %(name)25s %(message)s'))
+    monkeypatch.setattr(logger, 'handlers', [handler])
+    monkeypatch.setattr(logger, 'propagate', False)
+    level = logger.level
+    yield logger
+    logger.setLevel(level)
+
+
+def _time_per_file(synced_tree, logger, level):
+    plugin, cache, index, local_dir, remote_dir = synced_tree
+    logger.setLevel(level)
+
+    start = time.perf_counter()
+    for remote_full_path in plugin.list_path(remote_dir):
+        syncing._plan_path(remote_full_path, local_dir, remote_dir, plugin, cache, index)
+    return (time.perf_counter() - start) / FILE_COUNT
+
+
+@pytest.mark.benchmark
+def test_logging_overhead(synced_tree, kitovu_logger):
+    per_file_info = _time_per_file(synced_tree, kitovu_logger, logging.INFO)
+    per_file_debug = _time_per_file(synced_tree, kitovu_logger, logging.DEBUG)
+
+    print(f"\n{FILE_COUNT} files, per-file time: info {per_file_info * 1e6:.1f} µs, "
+          f"debug {per_file_debug * 1e6:.1f} µs")
+    assert per_file_info < per_file_debug
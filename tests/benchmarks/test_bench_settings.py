@@ -0,0 +1,58 @@
+"""Validating a configuration with many connections."""
+
+import os
+import json
+import time
+
+import pytest
+
+from kitovu import utils
+from kitovu.sync import syncing
+
+
+CONNECTION_COUNT = 200
+RUNS = 5
+# Per connection, in seconds.
+BUDGET = 0.001
+
+
+@pytest.fixture
+def config_yml(temppath):
+    lines = [f'root-dir: {temppath}/syncs', 'connections:']
+    for i in range(CONNECTION_COUNT):
+        lines += [f'  - name: conn{i}', '    plugin: smb', f'    username: user{i}']
+    lines.append('subjects:')
+    for i in range(CONNECTION_COUNT):
+        lines += [f'  - name: Subject{i}', '    sources:',
+                  f'      - connection: conn{i}', f'        remote-dir: Subject{i}/Skripte']
+    path = temppath / 'config.yml'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    # Old enough for the parsed settings to be cached, so this measures
+    # validating the connections rather than parsing the YAML.
+    os.utime(str(path), (1000, 1000))
+    return path
+
+
+def _best_time(config_yml):
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        syncing.validate_config(config_yml)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.benchmark
+def test_validate_config(config_yml, monkeypatch):
+    syncing.validate_config(config_yml)  # fill the settings cache
+    memoized = _best_time(config_yml)
+
+    monkeypatch.setattr(utils, 'compile_schema',
+                        lambda schema: utils._compile_schema.__wrapped__(json.dumps(schema)))
+    uncached = _best_time(config_yml)
+
+    print()
+    print(f"validate_config with {CONNECTION_COUNT} connections: "
+          f"{memoized * 1000:.1f} ms memoized, {uncached * 1000:.1f} ms without")
+
+    assert memoized / CONNECTION_COUNT < BUDGET
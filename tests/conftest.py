@@ -1,11 +1,27 @@
 import keyring
 import pathlib
+import appdirs
 import pytest
 
+from kitovu.sync import registry
 from helpers.in_memory_keyring import InMemoryKeyring
 from helpers import dummyplugin
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmarks', action='store_true', default=False,
+                     help="Run the benchmarks in tests/benchmarks.")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmarks'):
+        return
+    skip_benchmark = pytest.mark.skip(reason="Benchmarks only run with --benchmarks")
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 @pytest.fixture(autouse=True)
 def init_keyring():
     ring = InMemoryKeyring()
@@ -14,6 +30,29 @@ def init_keyring():
     ring.clear()
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path_factory):
+    """Don't use (or pollute) the real cache directory, e.g. for the settings."""
+    path = tmp_path_factory.mktemp('cache')
+    monkeypatch.setattr(appdirs, 'user_cache_dir', lambda _name: str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def data_dir(monkeypatch, tmp_path_factory):
+    """Don't use (or pollute) the real data directory, e.g. for the file cache."""
+    path = tmp_path_factory.mktemp('data')
+    monkeypatch.setattr(appdirs, 'user_data_dir', lambda _name: str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def clear_plugin_registry():
+    """Make sure plugins looked up by a test (or mocks of them) don't leak."""
+    yield
+    registry.registry.clear()
+
+
 @pytest.fixture
 def temppath(tmpdir):
     return pathlib.Path(tmpdir)
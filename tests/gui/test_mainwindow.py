@@ -45,3 +45,11 @@ def test_switching_to_sync_screen(window, monkeypatch, qtbot):
     central._conf_screen._cancel_button.click()
     assert not central._conf_screen.isVisible()
     assert central._start_screen.isVisible()
+
+
+def test_close_shuts_down_sync(window, monkeypatch):
+    central: mainwindow.CentralWidget = window.centralWidget()
+    calls = []
+    monkeypatch.setattr(central._sync_screen, 'shutdown', lambda: calls.append(True))
+    window.close()
+    assert calls == [True]
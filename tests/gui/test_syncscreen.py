@@ -41,8 +41,6 @@ def test_success(screen, patcher, qtbot):
     expected_text = '\n'.join([
         'Synchronisation läuft...',
         'Hello World',
-        '',
-        '',
         'Synchronisation erfolgreich beendet.'
     ])
     assert screen._output.toPlainText() == expected_text
@@ -61,8 +59,6 @@ def test_nonzero_exit(screen, patcher, qtbot):
     expected_text = '\n'.join([
         'Synchronisation läuft...',
         'Hello World',
-        '',
-        '',
         'Fehler: Kitovu-Prozess wurde mit Status 1 beendet.'
     ])
     assert screen._output.toPlainText() == expected_text
@@ -85,7 +81,6 @@ def test_crash_exit(screen, patcher, qtbot, cancel):
     assert blocker.args[1] == QProcess.CrashExit
     expected_text = '\n'.join([
         'Synchronisation läuft...',
-        '',
         'Fehler: Kitovu-Prozess ist abgestürzt.'
     ])
     assert screen._output.toPlainText() == expected_text
@@ -102,9 +97,7 @@ def test_stderr_output(screen, patcher, qtbot):
     expected_text = '\n'.join([
         'Synchronisation läuft...',
         'This is stdout',
-        '',
         'This is stderr',
-        '',
         'Synchronisation erfolgreich beendet.'
     ])
     assert screen._output.toPlainText() == expected_text
@@ -121,6 +114,120 @@ def test_back_button(screen, patcher, qtbot):
 
 
 def test_partial_read(screen, patcher, qtbot):
-    patcher.patch('print("x", end="")')
+    patcher.patch('import sys, time',
+                  'print("hello ", end="", flush=True)',
+                  'time.sleep(0.1)',
+                  'print("world\\nx", end="")')
     with qtbot.wait_signal(screen.finished):
         screen.start_sync()
+    assert screen._output.toPlainText().splitlines()[1:3] == ['hello world', 'x']
+
+
+def test_many_lines(screen, patcher, qtbot, monkeypatch):
+    monkeypatch.setattr(syncscreen.SyncScreen, 'MAX_LINES', 100)
+    screen = syncscreen.SyncScreen()
+    qtbot.add_widget(screen)
+    patcher.patch('for i in range(50000):',
+                  '    print(f"DEBUG line {i}")')
+    appended = []
+    append_plain_text = screen._output.appendPlainText
+
+    def recording_append_plain_text(text):
+        appended.append(text)
+        append_plain_text(text)
+
+    monkeypatch.setattr(screen._output, 'appendPlainText', recording_append_plain_text)
+
+    with qtbot.wait_signal(screen.finished, timeout=30000):
+        screen.start_sync()
+
+    lines = screen._output.toPlainText().splitlines()
+    assert len(lines) == 100
+    assert lines[-2:] == ['DEBUG line 49999', 'Synchronisation erfolgreich beendet.']
+    # Lines are shown in batches, not one by one.
+    assert len(appended) < 1000
+
+
+def test_progress_events(screen, patcher, qtbot):
+    patcher.patch('import json',
+                  'def emit(**data): print(json.dumps(data), flush=True)',
+                  'emit(event="planned", size=100, **{"local-path": "/a"})',
+                  'emit(event="planned", size=300, **{"local-path": "/b"})',
+                  'emit(event="done", size=100, **{"local-path": "/a"})',
+                  'print("Downloading /b", flush=True)',
+                  'emit(event="transfer", bytes=100, **{"local-path": "/b"})',
+                  'print("{not json}")')
+    bar_values = []
+    screen._progress.valueChanged.connect(bar_values.append)
+
+    with qtbot.wait_signal(screen.finished):
+        screen.start_sync()
+
+    assert '"event"' not in screen._output.toPlainText()
+    assert 'Downloading /b' in screen._output.toPlainText()
+    assert '{not json}' in screen._output.toPlainText()
+    assert 500 in bar_values  # 200 of 400 bytes
+    assert screen._progress.value() == screen._progress.maximum()
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSyncProgress:
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def progress(self, clock):
+        progress = syncscreen.SyncProgress(clock=clock)
+        progress.handle({'event': 'planned', 'local-path': '/a', 'size': 1000})
+        progress.handle({'event': 'planned', 'local-path': '/b', 'size': 3000})
+        return progress
+
+    def test_empty(self):
+        progress = syncscreen.SyncProgress()
+        assert progress.fraction == 0
+        assert progress.format_text() == '0%'
+
+    def test_transfers(self, progress, clock):
+        assert progress.total == 4000
+        assert progress.fraction == 0
+        progress.handle({'event': 'transfer', 'local-path': '/a', 'bytes': 500})
+        clock.now += 1
+        progress.handle({'event': 'transfer', 'local-path': '/a', 'bytes': 500})
+        progress.handle({'event': 'done', 'local-path': '/a', 'size': 1000})
+        assert progress.fraction == 0.25
+        assert progress.throughput == 1000
+        assert progress.remaining_seconds == 3
+        assert progress.format_text() == '25%, 1000 B / 3.9 KiB, 1000 B/s, noch 0:03'
+
+    def test_skipped_and_failed(self, progress):
+        progress.handle({'event': 'skipped', 'local-path': '/a'})
+        assert progress.fraction == 0.25
+        progress.handle({'event': 'transfer', 'local-path': '/b', 'bytes': 10})
+        progress.handle({'event': 'error', 'local-path': '/b', 'message': 'Timeout'})
+        assert progress.fraction == 1
+
+    def test_without_path(self, progress):
+        progress.handle({'event': 'planned', 'size': 1000})
+        progress.handle({'event': 'transfer', 'bytes': 500})
+        progress.handle({'event': 'error', 'message': 'Could not connect'})
+        assert progress.total == 4000
+        assert progress.transferred == 0
+        assert progress.fraction == 0
+
+    def test_unknown_sizes(self):
+        progress = syncscreen.SyncProgress()
+        for path in ['/a', '/b']:
+            progress.handle({'event': 'planned', 'local-path': path, 'size': None})
+        progress.handle({'event': 'done', 'local-path': '/a', 'size': 10})
+        assert progress.fraction == 0.5
+        assert progress.remaining_seconds is None
@@ -0,0 +1,109 @@
+import logging
+import pathlib
+
+import pytest
+from PyQt5.QtCore import QProcess
+
+from kitovu import utils
+from kitovu.gui import syncscreen
+from kitovu.sync import filecache, planning, syncing
+
+
+class FakeSync:
+
+    """A replacement for syncing.start_all, running in the worker thread."""
+
+    def __init__(self):
+        self.sessions = []
+        self.error = None
+        self.wait_for_cancel = False
+
+    def __call__(self, config_file, options):
+        assert config_file is None
+        self.sessions.append(options.session)
+        if self.wait_for_cancel:
+            assert options.cancel.wait(10)
+        planned = planning.PlannedFile(connection='conn', subject='subject',
+                                       remote_dir=pathlib.PurePath('/remote'),
+                                       local_dir=pathlib.Path('/local'),
+                                       remote_path=pathlib.PurePath('/remote/a'),
+                                       local_path=pathlib.Path('/local/a'),
+                                       state=filecache.FileState.NEW,
+                                       remote_digest='1', size=100)
+        options.reporter.planned(planned)
+        logging.getLogger('kitovu.sync.syncing').info('Downloading %s', planned.local_path)
+        options.reporter.done(planned, 100)
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def fake_sync(monkeypatch):
+    fake = FakeSync()
+    monkeypatch.setattr(syncing, 'start_all', fake)
+    return fake
+
+
+@pytest.fixture
+def screen(qtbot):
+    widget = syncscreen.SyncScreen(in_process=True)
+    qtbot.add_widget(widget)
+    yield widget
+    widget.shutdown()
+
+
+def test_success(screen, fake_sync, qtbot):
+    with qtbot.wait_signal(screen.finished) as blocker:
+        screen.start_sync()
+
+    assert blocker.args == [0, QProcess.NormalExit]
+    expected_text = '\n'.join([
+        'Synchronisation läuft...',
+        'Downloading /local/a',
+        'Synchronisation erfolgreich beendet.'
+    ])
+    assert screen._output.toPlainText() == expected_text
+    assert screen._sync_progress.fraction == 1
+
+
+def test_session_reused(screen, fake_sync, qtbot):
+    for _ in range(2):
+        with qtbot.wait_signal(screen.finished):
+            screen.start_sync()
+
+    first, second = fake_sync.sessions
+    assert isinstance(first, syncing.Session)
+    assert first is second
+
+
+@pytest.mark.parametrize('error, message', [
+    (utils.UsageError('Invalid config'), 'Invalid config'),
+    (ValueError('oops'), 'ValueError: oops'),
+])
+def test_error(screen, fake_sync, qtbot, error, message):
+    fake_sync.error = error
+    with qtbot.wait_signal(screen.finished) as blocker:
+        screen.start_sync()
+
+    assert blocker.args[0] == 1
+    assert screen._output.toPlainText().splitlines()[-1] == f'Fehler: {message}'
+
+
+def test_cancel(screen, fake_sync, qtbot):
+    fake_sync.wait_for_cancel = True
+    screen.start_sync()
+
+    with qtbot.wait_signal(screen.finished) as blocker:
+        with qtbot.wait_signal(screen.close_requested):
+            screen._cancel_button.click()
+
+    assert blocker.args[0] == 1
+    lines = screen._output.toPlainText().splitlines()
+    assert 'Synchronisation wird abgebrochen...' in lines
+    assert lines[-1] == 'Fehler: Synchronisation abgebrochen.'
+    assert 'Synchronisation erfolgreich beendet.' not in lines
+
+    # The next sync isn't cancelled right away.
+    fake_sync.wait_for_cancel = False
+    with qtbot.wait_signal(screen.finished):
+        screen.start_sync()
@@ -19,6 +19,7 @@ class Digests:
 class DummyPlugin(syncplugin.AbstractSyncPlugin):
 
     NAME: str = "dummyplugin"
+    THREAD_SAFE: bool = True
 
     def __init__(self,
                  temppath: pathlib.Path,
@@ -62,6 +63,11 @@ class DummyPlugin(syncplugin.AbstractSyncPlugin):
 
     def create_local_digest(self, path: pathlib.Path) -> str:
         assert self.is_connected
+        if path not in self.local_digests and path.exists():
+            # Maybe a local copy of a retrieved file, see retrieve_file.
+            lines = path.read_text().splitlines()
+            if len(lines) == 2:
+                return lines[1]
         return self.local_digests.get(path, '')
 
     def create_remote_digest(self, path: pathlib.PurePath) -> str:
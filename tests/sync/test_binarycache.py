@@ -0,0 +1,77 @@
+import struct
+
+import pytest
+
+from kitovu.sync import binarycache
+
+
+ENTRIES = sorted([
+    ("Dokumente/Anleitung.pdf", "1024-1520000000", ""),
+    ("Dokumente/Vorlage.docx", "2048-1520000000", "1:2048:1520000000:sha256-ab:sha256-ab"),
+    ("Übungen/Blatt 1.pdf", "512-1520000000", ""),
+    ("a.txt", "1-2", ""),
+])
+
+
+@pytest.fixture
+def table(temppath):
+    path = temppath / "shard.bin"
+    binarycache.write(path, "smb", ENTRIES)
+    table = binarycache.Table(path)
+    yield table
+    table.close()
+
+
+def test_items(table):
+    assert list(table.items()) == ENTRIES
+    assert len(table) == len(ENTRIES)
+
+
+def test_plugin_name(table):
+    assert table.plugin_name == "smb"
+
+
+@pytest.mark.parametrize("key, digest, hashes", ENTRIES)
+def test_get(table, key, digest, hashes):
+    assert table.get(key) == (digest, hashes)
+
+
+@pytest.mark.parametrize("key", ["", "Dokumente", "Dokumente/Anleitung.pd", "zzz"])
+def test_get_missing(table, key):
+    assert table.get(key) is None
+
+
+def test_empty_table(temppath):
+    path = temppath / "shard.bin"
+    binarycache.write(path, "smb", [])
+    table = binarycache.Table(path)
+    assert list(table.items()) == []
+    assert table.get("a.txt") is None
+    table.close()
+
+
+def test_version_1(temppath):
+    """Files written before content hashes existed can still be read."""
+    path = temppath / "shard.bin"
+    record = b"\x05\x00a.txt\x03\x001-2"
+    offset = binarycache._HEADER.size + len(b"smb") + 4
+    path.write_bytes(binarycache._HEADER.pack(b"KVFC", 1, 3, 1) + b"smb" +
+                     struct.pack("<I", offset) + record)
+
+    table = binarycache.Table(path)
+    assert list(table.items()) == [("a.txt", "1-2", "")]
+    assert table.get("a.txt") == ("1-2", "")
+    table.close()
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"", "is empty"),
+    (b"KVFC", "is truncated"),
+    (b"XXXX\x01\x00\x00\x00\x00\x00\x00\x00", "unknown format or version"),
+    (b"KVFC\x63\x00\x00\x00\x00\x00\x00\x00", "unknown format or version"),
+])
+def test_invalid_file(temppath, data, message):
+    path = temppath / "shard.bin"
+    path.write_bytes(data)
+    with pytest.raises(binarycache.FormatError, match=message):
+        binarycache.Table(path)
@@ -0,0 +1,133 @@
+import pytest
+
+from kitovu import utils
+from kitovu.sync import concurrency
+from helpers import dummyplugin
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _run_window(controller, clock, size, duration):
+    """Start as many downloads as allowed and let them finish after duration."""
+    count = controller.limit
+    for _ in range(count):
+        assert controller.has_capacity()
+        controller.started()
+    assert not controller.has_capacity()
+    clock.now += duration
+    for _ in range(count):
+        controller.finished(size)
+
+
+class TestAimdController:
+
+    def test_grows_while_throughput_improves(self, clock):
+        controller = concurrency.AimdController(maximum=3, clock=clock)
+        assert controller.limit == 1
+
+        _run_window(controller, clock, size=100, duration=1)
+        assert controller.limit == 2
+        _run_window(controller, clock, size=100, duration=1)  # 200 B/s
+        assert controller.limit == 3
+        _run_window(controller, clock, size=100, duration=1)  # 300 B/s
+        assert controller.limit == 3  # the maximum
+
+        assert controller.files == 6
+        assert controller.total_bytes == 600
+        assert controller.throughput == 200
+        assert controller.peak == 3
+
+    def test_stops_growing(self, clock):
+        controller = concurrency.AimdController(maximum=10, clock=clock)
+        _run_window(controller, clock, size=100, duration=1)
+        assert controller.limit == 2
+        # Two downloads in parallel, but each one takes twice as long.
+        _run_window(controller, clock, size=100, duration=2)
+        assert controller.limit == 2
+
+    def test_backs_off_on_errors(self, clock):
+        controller = concurrency.AimdController(maximum=10, clock=clock)
+        for _ in range(3):
+            _run_window(controller, clock, size=100 * controller.limit, duration=1)
+        assert controller.limit == 4
+
+        controller.started()
+        controller.failed()
+        assert controller.limit == 2
+        controller.started()
+        controller.failed()
+        controller.started()
+        controller.failed()
+        assert controller.limit == 1
+        assert controller.errors == 3
+
+    def test_cap(self, clock):
+        controller = concurrency.AimdController(maximum=10, clock=clock)
+        for _ in range(3):
+            _run_window(controller, clock, size=100 * controller.limit, duration=1)
+        controller.cap(2)
+        assert controller.limit == 2
+        assert controller.maximum == 2
+
+
+class UnsafePlugin(dummyplugin.DummyPlugin):
+
+    THREAD_SAFE = False
+
+
+class TestPluginPool:
+
+    def test_thread_safe(self, temppath):
+        plugin = dummyplugin.DummyPlugin(temppath)
+        pool = concurrency.PluginPool(plugin, factory=pytest.fail)
+        assert pool.acquire() is plugin
+        assert pool.acquire() is plugin
+        assert len(pool) == 1
+
+    def test_not_thread_safe(self, temppath):
+        created = []
+
+        def factory():
+            plugin = UnsafePlugin(temppath)
+            plugin.connect()
+            created.append(plugin)
+            return plugin
+
+        plugin = UnsafePlugin(temppath)
+        plugin.connect()
+        pool = concurrency.PluginPool(plugin, factory)
+
+        first = pool.acquire()
+        second = pool.acquire()
+        assert first is plugin
+        assert created == [second]
+
+        pool.release(second)
+        assert pool.acquire() is second
+        assert len(pool) == 2
+
+        pool.disconnect()
+        assert not plugin.is_connected
+        assert not second.is_connected
+
+    def test_connection_error(self, temppath, caplog):
+        def factory():
+            raise utils.PluginOperationError("Too many connections")
+
+        pool = concurrency.PluginPool(UnsafePlugin(temppath), factory)
+        assert pool.acquire() is not None
+        assert pool.acquire() is None
+        assert caplog.records[-1].message == ('Could not open another connection '
+                                              '(Too many connections), continuing with 1')
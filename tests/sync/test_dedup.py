@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from kitovu.sync import dedup
+
+
+@pytest.fixture
+def source(temppath):
+    path = temppath / 'source.txt'
+    path.write_text('kitovu')
+    os.utime(str(path), (0, 13371337))
+    return path
+
+
+@pytest.mark.parametrize('existing', [True, False])
+def test_copy(monkeypatch, temppath, source, existing):
+    monkeypatch.setattr(dedup, '_reflink', lambda _source, _target: False)
+    target = temppath / 'sub' / 'target.txt'
+    if existing:
+        target.parent.mkdir()
+        target.write_text('old content')
+
+    assert dedup.materialize(source, target, 'copy') == 'copy'
+
+    assert target.read_text() == 'kitovu'
+    assert target.stat().st_mtime == 13371337
+    assert not os.path.samefile(str(source), str(target))
+
+
+@pytest.mark.parametrize('method', ['copy', 'hardlink'])
+def test_dangling_symlink(temppath, source, method):
+    target = temppath / 'target.txt'
+    target.symlink_to(temppath / 'does-not-exist')
+
+    dedup.materialize(source, target, method)
+
+    assert not target.is_symlink()
+    assert target.read_text() == 'kitovu'
+
+
+def test_copy_interrupted(monkeypatch, temppath, source):
+    def copyfile(_source, target):
+        with open(target, 'w') as f:
+            f.write('kit')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(dedup, '_reflink', lambda _source, _target: False)
+    monkeypatch.setattr(dedup.shutil, 'copyfile', copyfile)
+    target = temppath / 'target.txt'
+    target.write_text('old content')
+
+    with pytest.raises(KeyboardInterrupt):
+        dedup.materialize(source, target, 'copy')
+
+    assert target.read_text() == 'old content'
+    assert sorted(p.name for p in temppath.iterdir()) == ['source.txt', 'target.txt']
+
+
+def test_reflink(monkeypatch, temppath, source):
+    calls = []
+    monkeypatch.setattr(dedup.fcntl, 'ioctl', lambda *args: calls.append(args))
+    target = temppath / 'target.txt'
+
+    assert dedup.materialize(source, target, 'copy') == 'reflink'
+    assert len(calls) == 1
+    assert calls[0][1] == dedup._FICLONE
+    assert target.stat().st_mtime == 13371337
+
+
+def test_reflink_unsupported(monkeypatch, temppath, source):
+    def ioctl(*_args):
+        raise OSError(95, 'Operation not supported')
+
+    monkeypatch.setattr(dedup.fcntl, 'ioctl', ioctl)
+    target = temppath / 'target.txt'
+    assert dedup.materialize(source, target, 'copy') == 'copy'
+    assert target.read_text() == 'kitovu'
+
+
+def test_hardlink(temppath, source):
+    target = temppath / 'target.txt'
+    assert dedup.materialize(source, target, 'hardlink') == 'hardlink'
+    assert os.path.samefile(str(source), str(target))
+
+
+def test_hardlink_unsupported(monkeypatch, temppath, source):
+    def link(_source, _target):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(dedup.os, 'link', link)
+    monkeypatch.setattr(dedup, '_reflink', lambda _source, _target: False)
+    target = temppath / 'target.txt'
+    assert dedup.materialize(source, target, 'hardlink') == 'copy'
+    assert target.read_text() == 'kitovu'
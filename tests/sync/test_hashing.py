@@ -0,0 +1,63 @@
+import io
+import hashlib
+
+import pytest
+
+from kitovu.sync import hashing
+
+
+@pytest.fixture
+def testfile(temppath):
+    path = temppath / "testfile.bin"
+    path.write_bytes(b"kitovu" * 100_000)
+    return path
+
+
+def _expected(algorithm, data):
+    return f"{algorithm}-{hashlib.new(algorithm, data).hexdigest()}"
+
+
+@pytest.mark.parametrize("algorithm", hashing.ALGORITHMS)
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_hash_file(monkeypatch, testfile, algorithm, use_mmap):
+    if use_mmap:
+        monkeypatch.setattr(hashing, "_MMAP_THRESHOLD", 0)
+        monkeypatch.setattr(hashing, "_MMAP_CHUNK_SIZE", 4096)
+    assert hashing.hash_file(testfile, algorithm) == _expected(algorithm, testfile.read_bytes())
+
+
+def test_hash_empty_file(monkeypatch, temppath):
+    monkeypatch.setattr(hashing, "_MMAP_THRESHOLD", 0)
+    path = temppath / "empty"
+    path.touch()
+    assert hashing.hash_file(path, "sha256") == _expected("sha256", b"")
+
+
+def test_hash_files(temppath, caplog):
+    paths = []
+    for i in range(20):
+        path = temppath / f"file{i}"
+        path.write_bytes(str(i).encode("ascii"))
+        paths.append(path)
+    missing = temppath / "missing"
+
+    results = hashing.hash_files(paths + [missing], "sha256", jobs=4)
+
+    assert results == {path: _expected("sha256", path.read_bytes()) for path in paths}
+    assert caplog.records[-1].message.startswith(f"Could not hash {missing}")
+
+
+def test_hash_info_roundtrip():
+    info = hashing.HashInfo(synced="sha256-ab", current="sha256-cd", signature=(1, 2, 3))
+    assert info.serialize() == "1:2:3:sha256-ab:sha256-cd"
+    assert hashing.HashInfo.parse(info.serialize()) == info
+
+
+def test_hashing_writer():
+    fileobj = io.BytesIO()
+    writer = hashing.HashingWriter(fileobj, "blake2b")
+    writer.write(b"kit")
+    writer.write(b"ovu")
+    assert fileobj.getvalue() == b"kitovu"
+    assert writer.content_hash() == _expected("blake2b", b"kitovu")
+    assert writer.tell() == 6
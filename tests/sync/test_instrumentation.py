@@ -0,0 +1,159 @@
+import io
+import pathlib
+
+import pytest
+
+from kitovu import utils
+from kitovu.sync import instrumentation
+
+from helpers import dummyplugin
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def stats(clock):
+    return instrumentation.Stats(clock=clock)
+
+
+class TestOperation:
+
+    def test_record(self):
+        operation = instrumentation.Operation()
+        for seconds in [0.0005, 0.003, 0.003, 20]:
+            operation.record(seconds, failed=False)
+        operation.record(0.2, failed=True)
+
+        assert operation.calls == 5
+        assert operation.errors == 1
+        assert operation.seconds == pytest.approx(20.2065)
+        assert operation.max_seconds == 20
+        assert operation.bucket_counts == [1, 0, 2, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1]
+
+    @pytest.mark.parametrize('fraction, expected', [
+        (0.25, 0.001),
+        (0.5, 0.005),
+        (0.95, 20),
+    ])
+    def test_quantile(self, fraction, expected):
+        operation = instrumentation.Operation()
+        for seconds in [0.0005, 0.003, 0.003, 20]:
+            operation.record(seconds, failed=False)
+        assert operation.quantile(fraction) == expected
+
+    def test_quantile_below_bound(self):
+        operation = instrumentation.Operation()
+        operation.record(0.3, failed=False)
+        assert operation.quantile(0.95) == 0.3
+
+    def test_quantile_empty(self):
+        assert instrumentation.Operation().quantile(0.5) == 0
+
+
+class TestStats:
+
+    def test_time(self, stats, clock):
+        with stats.time('op'):
+            clock.now += 2
+
+        with pytest.raises(ValueError):
+            with stats.time('op'):
+                clock.now += 1
+                raise ValueError
+
+        assert stats['op'].calls == 2
+        assert stats['op'].errors == 1
+        assert stats['op'].seconds == 3
+
+    def test_timed_without_stats(self):
+        with instrumentation.timed(None, 'op'):
+            pass
+
+    def test_to_json(self, stats):
+        stats.record('b', 0.02)
+        stats.add_bytes('b', 1000)
+        stats.record('a', 0.5)
+        data = stats.to_json()
+        assert list(data['operations']) == ['a', 'b']
+        assert data['operations']['b'] == {
+            'calls': 1,
+            'errors': 0,
+            'seconds': 0.02,
+            'max-seconds': 0.02,
+            'bytes': 1000,
+            'buckets': list(instrumentation.BUCKETS),
+            'bucket-counts': [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        }
+
+    def test_format_text(self, stats):
+        stats.record('smb.retrieve_file', 0.02)
+        stats.record('smb.retrieve_file', 0.04)
+        stats.add_bytes('smb.retrieve_file', 2048)
+        stats.record('filecache.load', 0.001)
+        assert stats.format_text().splitlines() == [
+            'Operation          Calls  Errors  Total ms  Mean ms  p95 ms  Max ms    Bytes',
+            'filecache.load         1       0       1.0      1.0     1.0     1.0',
+            'smb.retrieve_file      2       0      60.0     30.0    40.0    40.0  2.0 KiB',
+        ]
+
+
+class TestInstrumentedPlugin:
+
+    @pytest.fixture
+    def plugin(self, temppath):
+        return dummyplugin.DummyPlugin(temppath)
+
+    @pytest.fixture
+    def instrumented(self, plugin, stats):
+        return instrumentation.InstrumentedPlugin(plugin, stats, prefix='dummy')
+
+    def test_attributes(self, plugin, instrumented):
+        assert instrumented.NAME == plugin.NAME
+        assert instrumented.THREAD_SAFE == plugin.THREAD_SAFE
+        assert instrumented.remote_digests is plugin.remote_digests
+
+    def test_hooks(self, instrumented, stats, temppath):
+        instrumented.connect()
+        assert instrumented.list_path(pathlib.PurePath('remote_dir')) == [
+            pathlib.PurePath(f'remote_dir/test/example{i}.txt') for i in range(1, 5)]
+        path = temppath / 'local_dir/test/example1.txt'
+        assert instrumented.create_local_digest_from_stat(path, None) == '1'
+        remote_path = pathlib.PurePath('remote_dir/test/example1.txt')
+        assert instrumented.create_remote_digest(remote_path) == '1'
+        instrumented.disconnect()
+
+        for hook in ['connect', 'list_path', 'create_local_digest', 'create_remote_digest',
+                     'disconnect']:
+            assert stats[f'dummy.{hook}'].calls == 1, hook
+
+    def test_retrieve_file(self, instrumented, stats):
+        instrumented.connect()
+        fileobj = io.BytesIO()
+        fileobj.name = 'example1.txt'
+        instrumented.retrieve_file(pathlib.PurePath('remote_dir/test/example1.txt'), fileobj)
+
+        assert stats['dummy.retrieve_file'].calls == 1
+        assert stats['dummy.retrieve_file'].transferred == len(fileobj.getvalue())
+
+    def test_error(self, plugin, instrumented, stats):
+        plugin.error_connect = True
+        with pytest.raises(utils.PluginOperationError):
+            instrumented.connect()
+        assert stats['dummy.connect'].errors == 1
+
+    def test_default_prefix(self, plugin, stats):
+        instrumented = instrumentation.InstrumentedPlugin(plugin, stats)
+        instrumented.configure({})
+        assert 'dummyplugin.configure' in stats
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from kitovu.sync import localindex
+
+
+@pytest.fixture
+def tree(temppath):
+    root = temppath / 'root'
+    (root / 'dir/subdir').mkdir(parents=True)
+    (root / 'file1.txt').write_text('1')
+    (root / 'dir/file2.txt').write_text('22')
+    (root / 'dir/subdir/file3.txt').write_text('333')
+    return root
+
+
+def test_scan(tree):
+    index = localindex.LocalIndex(tree)
+    index.scan()
+    assert sorted(index) == ['dir/file2.txt', 'dir/subdir/file3.txt', 'file1.txt']
+    assert index.get('dir/subdir/file3.txt').st_size == 3
+    assert index.get('dir') is None
+    assert index.get('missing.txt') is None
+
+
+def test_scan_missing_root(temppath):
+    index = localindex.LocalIndex(temppath / 'missing')
+    index.scan()
+    assert not len(index)
+    assert index.get('file.txt') is None
+
+
+def test_refresh(tree):
+    index = localindex.LocalIndex(tree)
+    index.scan()
+
+    (tree / 'new.txt').write_text('4444')
+    assert index.get('new.txt') is None
+    assert index.refresh('new.txt').st_size == 4
+    assert index.get('new.txt').st_size == 4
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason="Needs symlinks")
+def test_symlinked_dir(tree, temppath):
+    (tree / 'link').symlink_to(tree)  # a loop
+    index = localindex.LocalIndex(tree)
+    index.scan()
+
+    assert sorted(index) == ['dir/file2.txt', 'dir/subdir/file3.txt', 'file1.txt']
+    assert index.get('link/file1.txt').st_size == 1
+    assert index.get('link/missing.txt') is None
@@ -0,0 +1,154 @@
+import pathlib
+
+import pytest
+
+from kitovu.sync import metrics, planning, filecache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def reporter(clock):
+    return metrics.MetricsReporter(clock=clock)
+
+
+def _planned(name, subject='subject'):
+    return planning.PlannedFile(
+        connection='conn',
+        subject=subject,
+        remote_dir=pathlib.PurePath('remote'),
+        local_dir=pathlib.Path('/local'),
+        remote_path=pathlib.PurePath('remote') / name,
+        local_path=pathlib.Path('/local') / name,
+        state=filecache.FileState.NEW,
+        remote_digest='1',
+        size=10,
+    )
+
+
+def _sync(reporter, clock):
+    reporter.listing('conn', 'subject')
+    clock.now += 0.5
+    reporter.listed('conn', 'subject', 3)
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        reporter.planned(_planned(name))
+    reporter.done(_planned('a.txt'), 10)
+    reporter.skipped(_planned('b.txt'))
+    reporter.error('conn', 'Timeout', _planned('c.txt'))
+    reporter.summary('conn', files=1, size=10, failed=1, seconds=2.25)
+    clock.now += 3
+    reporter.finished()
+
+
+def test_format(reporter, clock):
+    _sync(reporter, clock)
+    cache_stats = filecache.CacheStats(subjects=[
+        filecache.SubjectStats(connection='conn', subject='subject', remote_dir='remote',
+                               plugin='dummy', entries=5, size=100),
+        filecache.SubjectStats(connection='conn', subject='subject', remote_dir='other',
+                               plugin='dummy', entries=2, size=50),
+    ], size=150, load_time=0.1)
+
+    text = metrics.format_metrics(reporter, success=True, now=1500000000.5,
+                                  cache_stats=cache_stats)
+
+    lines = [line for line in text.splitlines() if not line.startswith('# HELP')]
+    assert lines == [
+        '# TYPE kitovu_sync_success gauge',
+        'kitovu_sync_success 0',
+        '# TYPE kitovu_sync_timestamp_seconds gauge',
+        'kitovu_sync_timestamp_seconds 1500000000.5',
+        '# TYPE kitovu_sync_duration_seconds gauge',
+        'kitovu_sync_duration_seconds 3.5',
+        '# TYPE kitovu_connection_errors gauge',
+        'kitovu_connection_errors{connection="conn"} 1',
+        '# TYPE kitovu_connection_downloaded_files gauge',
+        'kitovu_connection_downloaded_files{connection="conn"} 1',
+        '# TYPE kitovu_connection_downloaded_bytes gauge',
+        'kitovu_connection_downloaded_bytes{connection="conn"} 10',
+        '# TYPE kitovu_connection_failed_files gauge',
+        'kitovu_connection_failed_files{connection="conn"} 1',
+        '# TYPE kitovu_connection_download_duration_seconds gauge',
+        'kitovu_connection_download_duration_seconds{connection="conn"} 2.25',
+        '# TYPE kitovu_subject_listed_files gauge',
+        'kitovu_subject_listed_files{connection="conn",subject="subject"} 3',
+        '# TYPE kitovu_subject_listing_duration_seconds gauge',
+        'kitovu_subject_listing_duration_seconds{connection="conn",subject="subject"} 0.5',
+        '# TYPE kitovu_subject_planned_files gauge',
+        'kitovu_subject_planned_files{connection="conn",subject="subject"} 3',
+        '# TYPE kitovu_subject_downloaded_files gauge',
+        'kitovu_subject_downloaded_files{connection="conn",subject="subject"} 1',
+        '# TYPE kitovu_subject_downloaded_bytes gauge',
+        'kitovu_subject_downloaded_bytes{connection="conn",subject="subject"} 10',
+        '# TYPE kitovu_subject_skipped_files gauge',
+        'kitovu_subject_skipped_files{connection="conn",subject="subject"} 1',
+        '# TYPE kitovu_subject_failed_files gauge',
+        'kitovu_subject_failed_files{connection="conn",subject="subject"} 1',
+        '# TYPE kitovu_filecache_size_bytes gauge',
+        'kitovu_filecache_size_bytes 150',
+        '# TYPE kitovu_subject_cache_entries gauge',
+        'kitovu_subject_cache_entries{connection="conn",subject="subject"} 7',
+        '# EOF',
+    ]
+
+
+def test_escape_labels(reporter):
+    reporter.listing('conn', 'Sub "1"\\n')
+    text = metrics.format_metrics(reporter, success=True, now=0)
+    assert 'subject="Sub \\"1\\"\\\\n"' in text
+
+
+@pytest.mark.parametrize('success', [True, False])
+def test_last_success(reporter, success):
+    reporter.listing('conn', 'subject')
+    previous = {
+        ('kitovu_sync_last_success_timestamp_seconds', ''): 1000,
+        ('kitovu_connection_last_success_timestamp_seconds', '{connection="conn"}'): 1000,
+    }
+    text = metrics.format_metrics(reporter, success=success, now=2000, previous=previous)
+
+    expected = 2000 if success else 1000
+    assert f'kitovu_sync_last_success_timestamp_seconds {expected}' in text
+    assert (f'kitovu_connection_last_success_timestamp_seconds{{connection="conn"}} {expected}'
+            in text)
+
+
+def test_last_success_unknown(reporter):
+    text = metrics.format_metrics(reporter, success=False, now=2000)
+    assert 'last_success' not in text
+
+
+def test_write(reporter, clock, temppath):
+    path = temppath / 'kitovu.prom'
+    reporter.listing('conn', 'subject')
+    metrics.write(path, reporter, success=True)
+    first = metrics.read_samples(path)
+    assert first[('kitovu_sync_success', '')] == 1
+    last_success = first[('kitovu_connection_last_success_timestamp_seconds',
+                          '{connection="conn"}')]
+
+    reporter.error('conn', 'Could not connect')
+    metrics.write(path, reporter, success=True)
+
+    second = metrics.read_samples(path)
+    assert second[('kitovu_sync_success', '')] == 0
+    assert second[('kitovu_connection_errors', '{connection="conn"}')] == 1
+    assert second[('kitovu_connection_last_success_timestamp_seconds',
+                   '{connection="conn"}')] == last_success
+    assert [p.name for p in temppath.iterdir()] == ['kitovu.prom']
+
+
+def test_read_samples_missing(temppath):
+    assert metrics.read_samples(temppath / 'does-not-exist') == {}
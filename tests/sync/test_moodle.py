@@ -1,10 +1,14 @@
 import io
+import time
 import typing
 import urllib.parse
 import pathlib
+import concurrent.futures
 
 import attr
 import keyring
+import requests
+import urllib3
 import pytest
 
 from kitovu import utils
@@ -188,7 +192,34 @@ class TestConnect:
 
     def test_for_http_error_statuscode(self, plugin, credentials, patch_get_site_info_server_error):
         plugin.configure({})
-        with pytest.raises(utils.PluginOperationError):
+        with pytest.raises(utils.TransientError):
+            plugin.connect()
+
+    @pytest.mark.parametrize('status, transient', [
+        (404, False),
+        (429, True),
+        (503, True),
+    ])
+    def test_transient_http_errors(self, plugin, credentials, responses, status, transient):
+        _patch_request(responses, 'core_webservice_get_site_info', body="Kitovu-Error",
+                       status=status)
+        plugin.configure({})
+        with pytest.raises(utils.PluginOperationError) as excinfo:
+            plugin.connect()
+        assert isinstance(excinfo.value, utils.TransientError) == transient
+
+    def test_request_error(self, plugin, credentials, responses):
+        responses.add(responses.GET, 'https://moodle.hsr.ch/webservice/rest/server.php',
+                      body=requests.exceptions.ChunkedEncodingError('Connection broken'))
+        plugin.configure({})
+        with pytest.raises(utils.TransientError, match='Connection error: Connection broken.'):
+            plugin.connect()
+
+    def test_connection_error(self, plugin, credentials, responses):
+        responses.add(responses.GET, 'https://moodle.hsr.ch/webservice/rest/server.php',
+                      body=requests.exceptions.ConnectionError('Connection refused'))
+        plugin.configure({})
+        with pytest.raises(utils.TransientError, match='Connection error: Connection refused.'):
             plugin.connect()
 
 
@@ -303,6 +334,12 @@ class TestWithConnectedPlugin:
 
         assert plugin.create_local_digest(testfile) == f'{expected_size}-13371337'
 
+    @pytest.mark.parametrize('filename, expected', [('foo.png', '12-13371337'),
+                                                    ('foo.html', '0-13371337')])
+    def test_create_local_digest_from_stat(self, plugin, filename, expected, temppath):
+        stat = FakeStatResult(st_size=12, st_mtime=13371337.4242)
+        assert plugin.create_local_digest_from_stat(temppath / filename, stat) == expected
+
     def test_create_remote_digest(self, plugin, connect_and_configure_plugin,
                                   patch_get_users_courses, patch_course_get_contents):
         course_contents: typing.Iterable[pathlib.PurePath] = list(
@@ -350,6 +387,20 @@ class TestWithConnectedPlugin:
         assert plugin.retrieve_file(remote_full_path, fileobj) == 1520803270
         assert fileobj.getvalue() == b"HELLO KITOVU"
 
+    def test_retrieve_file_chunks(self, plugin, connect_and_configure_plugin,
+                                  patch_get_users_courses, patch_course_get_contents, responses):
+        responses.add(responses.GET, RETRIEVE_FILE_URL, content_type="application/octet-stream",
+                      body=b"x" * (moodle.CHUNK_SIZE + 10), match_querystring=True)
+        list(plugin.list_path(pathlib.PurePath("Wirtschaftsinformatik 2 FS2018")))
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            'Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf')
+
+        chunks = []
+        fileobj = io.BytesIO()
+        fileobj.write = lambda data: chunks.append(len(data))
+        plugin.retrieve_file(remote_full_path, fileobj)
+        assert chunks == [moodle.CHUNK_SIZE, 10]
+
     def test_retrieve_file_server_error(self, plugin, connect_and_configure_plugin,
                                         patch_get_users_courses, patch_course_get_contents,
                                         patch_retrieve_file_server_error):
@@ -371,3 +422,93 @@ class TestWithConnectedPlugin:
 
         with pytest.raises(utils.PluginOperationError):
             plugin.retrieve_file(remote_full_path, fileobj)
+
+    def test_retrieve_file_interrupted(self, plugin, connect_and_configure_plugin,
+                                       patch_get_users_courses, patch_course_get_contents,
+                                       monkeypatch):
+        class InterruptedBody:
+
+            def stream(self, _chunk_size, decode_content):
+                yield b"HELLO "
+                raise urllib3.exceptions.ProtocolError('Connection broken: IncompleteRead')
+
+            def close(self):
+                pass
+
+            def release_conn(self):
+                pass
+
+        def get(_url, _params, stream):
+            assert stream
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['content-type'] = 'application/octet-stream'
+            response.raw = InterruptedBody()
+            return response
+
+        list(plugin.list_path(pathlib.PurePath("Wirtschaftsinformatik 2 FS2018")))
+        monkeypatch.setattr(requests, 'get', get)
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            'Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf')
+        fileobj = io.BytesIO()
+
+        with pytest.raises(utils.TransientError, match='Connection broken'):
+            plugin.retrieve_file(remote_full_path, fileobj)
+        assert fileobj.getvalue() == b"HELLO "
+
+    def test_retrieve_file_without_listing(self, plugin, connect_and_configure_plugin,
+                                           patch_get_users_courses, patch_course_get_contents,
+                                           patch_retrieve_file):
+        """Files are found without listing the course first, e.g. when executing a plan."""
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            'Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf')
+        assert plugin.create_remote_digest(remote_full_path) == '4267895-1520803270'
+        fileobj = io.BytesIO()
+        assert plugin.retrieve_file(remote_full_path, fileobj) == 1520803270
+        assert fileobj.getvalue() == b"HELLO KITOVU"
+
+    def test_retrieve_file_without_listing_parallel(self, plugin, connect_and_configure_plugin,
+                                                    patch_get_users_courses,
+                                                    patch_course_get_contents, responses,
+                                                    monkeypatch):
+        list_courses = plugin._list_courses
+
+        def slow_list_courses():
+            time.sleep(0.05)
+            return list_courses()
+
+        monkeypatch.setattr(plugin, '_list_courses', slow_list_courses)
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            'Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            digests = list(executor.map(plugin.create_remote_digest, [remote_full_path] * 4))
+
+        assert digests == ['4267895-1520803270'] * 4
+        wsfunctions = [urllib.parse.parse_qs(urllib.parse.urlparse(call.request.url).query)['wsfunction']
+                       for call in responses.calls]
+        assert wsfunctions.count(['core_course_get_contents']) == 1
+
+    def test_missing_remote_file(self, plugin, connect_and_configure_plugin,
+                                 patch_get_users_courses, patch_course_get_contents):
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/missing.pdf')
+        with pytest.raises(utils.PluginOperationError,
+                           match=f"The remote file '{remote_full_path}' was not found."):
+            plugin.create_remote_digest(remote_full_path)
+
+    @pytest.mark.parametrize('filename, expected', [
+        ('Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf', 4267895),
+        ('Lösung Aufgabe 1/index.html', None),
+    ])
+    def test_remote_size(self, plugin, connect_and_configure_plugin,
+                         patch_get_users_courses, patch_course_get_contents, filename, expected):
+        list(plugin.list_path(pathlib.PurePath("Wirtschaftsinformatik 2 FS2018")))
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            + filename)
+        assert plugin.remote_size(remote_full_path) == expected
+
+    def test_remote_mtime(self, plugin, connect_and_configure_plugin,
+                          patch_get_users_courses, patch_course_get_contents):
+        list(plugin.list_path(pathlib.PurePath("Wirtschaftsinformatik 2 FS2018")))
+        remote_full_path = pathlib.PurePath('Wirtschaftsinformatik 2 FS2018/02 - Geschäftsprozessmanagement/'
+                                            'Geschäftsprozessmanagement/Geschäftsprozessmanagement.pdf')
+        assert plugin.remote_mtime(remote_full_path) == 1520803270
@@ -0,0 +1,116 @@
+import pathlib
+
+import pytest
+
+from kitovu import utils
+from kitovu.sync import planning, filecache
+
+
+def _planned(name, size, state=filecache.FileState.NEW):
+    return planning.PlannedFile(
+        connection='conn', subject='subject',
+        remote_dir=pathlib.PurePath('remote'), local_dir=pathlib.Path('/local'),
+        remote_path=pathlib.PurePath('remote') / name, local_path=pathlib.Path('/local') / name,
+        state=state, remote_digest='1-2', size=size)
+
+
+@pytest.fixture
+def plan():
+    return planning.Plan(files=[
+        _planned('a.pdf', 2048),
+        _planned('b.pdf', 3 * 1024 * 1024, filecache.FileState.REMOTE_CHANGED),
+        _planned('c.html', None, filecache.FileState.BOTH_CHANGED),
+    ])
+
+
+@pytest.mark.parametrize('size, expected', [
+    (None, '?'),
+    (0, '0 B'),
+    (1023, '1023 B'),
+    (1536, '1.5 KiB'),
+    (5 * 1024 ** 3, '5.0 GiB'),
+    (5 * 1024 ** 4, '5120.0 GiB'),
+])
+def test_format_size(size, expected):
+    assert planning.format_size(size) == expected
+
+
+def test_total_bytes(plan):
+    assert plan.total_bytes == 2048 + 3 * 1024 * 1024
+
+
+def test_json_roundtrip(plan):
+    data = plan.to_json()
+    assert data['version'] == 1
+    assert data['total-bytes'] == plan.total_bytes
+    assert data['files'][0] == {
+        'connection': 'conn',
+        'subject': 'subject',
+        'remote-dir': 'remote',
+        'local-dir': '/local',
+        'remote-path': 'remote/a.pdf',
+        'local-path': '/local/a.pdf',
+        'state': 'NEW',
+        'remote-digest': '1-2',
+        'size': 2048,
+        'mtime': None,
+        'priority': 0,
+    }
+    assert planning.Plan.from_json(data) == plan
+
+
+@pytest.mark.parametrize('data, message', [
+    ([], 'Unknown plan format'),
+    ({'version': 2, 'files': []}, 'Unknown plan format'),
+    ({'version': 1}, 'Invalid plan'),
+    ({'version': 1, 'files': [{'connection': 'conn'}]}, 'Invalid plan'),
+])
+def test_invalid_json(data, message):
+    with pytest.raises(utils.UsageError, match=message):
+        planning.Plan.from_json(data)
+
+
+def test_format_text(plan):
+    assert plan.format_text().splitlines() == [
+        'NEW                2.0 KiB  /local/a.pdf',
+        'REMOTE_CHANGED     3.0 MiB  /local/b.pdf',
+        'BOTH_CHANGED             ?  /local/c.html',
+        'Total: 3 files, 3.0 MiB (1 of unknown size)',
+    ]
+
+
+def test_for_connection(plan):
+    assert planning.Plan().for_connection('conn') == []
+    assert plan.for_connection('conn') == plan.files
+    assert plan.for_connection('other') == []
+
+
+def test_from_json_defaults(plan):
+    data = plan.to_json()
+    for entry in data['files']:
+        del entry['mtime']
+        del entry['priority']
+    assert planning.Plan.from_json(data) == plan
+
+
+@pytest.mark.parametrize('order, expected', [
+    ('listing', ['high-big', 'high-small', 'unknown', 'big-old', 'small-new']),
+    ('smallest', ['high-small', 'high-big', 'small-new', 'big-old', 'unknown']),
+    ('newest', ['high-small', 'high-big', 'small-new', 'big-old', 'unknown']),
+])
+def test_schedule(order, expected):
+    files = []
+    for name, size, mtime, priority in [
+            ('high-big', 2000, 100, 1),
+            ('high-small', 1000, 200, 1),
+            ('unknown', None, None, 0),
+            ('big-old', 3000, 100, 0),
+            ('small-new', 10, 200, 0),
+    ]:
+        planned = _planned(name, size)
+        planned.mtime = mtime
+        planned.priority = priority
+        files.append(planned)
+
+    scheduled = planning.schedule(files, order)
+    assert [planned.remote_path.name for planned in scheduled] == expected
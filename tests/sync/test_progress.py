@@ -0,0 +1,137 @@
+import io
+import json
+import pathlib
+
+import pytest
+
+from kitovu.sync import progress, planning, filecache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def output():
+    return io.StringIO()
+
+
+@pytest.fixture
+def reporter(output, clock):
+    return progress.JsonLinesReporter(output, clock=clock)
+
+
+def _events(output):
+    events = [json.loads(line) for line in output.getvalue().splitlines()]
+    for event in events:
+        del event['time']
+    return events
+
+
+def _planned(name, size=10):
+    return planning.PlannedFile(
+        connection='conn',
+        subject='subject',
+        remote_dir=pathlib.PurePath('remote'),
+        local_dir=pathlib.Path('/local'),
+        remote_path=pathlib.PurePath('remote') / name,
+        local_path=pathlib.Path('/local') / name,
+        state=filecache.FileState.NEW,
+        remote_digest='1',
+        size=size,
+    )
+
+
+def test_planned(reporter, output):
+    reporter.listing('conn', 'subject')
+    reporter.listed('conn', 'subject', 3)
+    reporter.planned(_planned('a.txt'))
+    reporter.planned(_planned('b.txt', size=None))
+    assert _events(output) == [
+        {'event': 'listing', 'connection': 'conn', 'subject': 'subject'},
+        {'event': 'listed', 'connection': 'conn', 'subject': 'subject', 'files': 3},
+        {'event': 'planned', 'connection': 'conn', 'subject': 'subject', 'size': 10,
+         'remote-path': 'remote/a.txt', 'local-path': '/local/a.txt'},
+        {'event': 'planned', 'connection': 'conn', 'subject': 'subject', 'size': None,
+         'remote-path': 'remote/b.txt', 'local-path': '/local/b.txt'},
+    ]
+
+
+def test_transfers_throttled(reporter, output, clock):
+    planned = _planned('a.txt')
+    reporter.transferred(planned, 1)
+    reporter.transferred(planned, 2)
+    reporter.transferred(planned, 3)
+    clock.now += 1
+    reporter.transferred(planned, 4)
+    reporter.transferred(planned, 5)
+    reporter.done(planned, 15)
+
+    assert _events(output) == [
+        {'event': 'transfer', 'connection': 'conn', 'local-path': '/local/a.txt', 'bytes': 1},
+        {'event': 'transfer', 'connection': 'conn', 'local-path': '/local/a.txt', 'bytes': 9},
+        {'event': 'transfer', 'connection': 'conn', 'local-path': '/local/a.txt', 'bytes': 5},
+        {'event': 'done', 'connection': 'conn', 'local-path': '/local/a.txt', 'size': 15},
+    ]
+
+
+def test_errors(reporter, output):
+    planned = _planned('a.txt')
+    reporter.transferred(planned, 1)  # sent right away
+    reporter.transferred(planned, 2)  # dropped because of the error
+    reporter.error('conn', 'Timeout', planned)
+    reporter.error('conn', 'Listing failed')
+    reporter.skipped(_planned('b.txt'))
+    reporter.done(_planned('c.txt'), 3)
+    reporter.summary('conn', files=1, size=3, failed=1, seconds=1.23456)
+    reporter.finished()
+
+    assert _events(output)[1:] == [
+        {'event': 'error', 'connection': 'conn', 'local-path': '/local/a.txt',
+         'message': 'Timeout'},
+        {'event': 'error', 'connection': 'conn', 'local-path': None,
+         'message': 'Listing failed'},
+        {'event': 'skipped', 'connection': 'conn', 'local-path': '/local/b.txt'},
+        {'event': 'done', 'connection': 'conn', 'local-path': '/local/c.txt', 'size': 3},
+        {'event': 'summary', 'connection': 'conn', 'files': 1, 'bytes': 3, 'failed': 1,
+         'seconds': 1.235},
+        {'event': 'finished', 'files': 1, 'bytes': 3, 'failed': 1},
+    ]
+
+
+def test_writer(reporter, output):
+    target = io.BytesIO()
+    writer = progress.ProgressWriter(target, reporter, _planned('a.txt'))
+    assert writer.write(b'kitovu') == 6
+    writer.flush()
+    assert target.getvalue() == b'kitovu'
+    assert _events(output) == [
+        {'event': 'transfer', 'connection': 'conn', 'local-path': '/local/a.txt', 'bytes': 6},
+    ]
+
+
+def test_multi_reporter(reporter, output, mocker):
+    other = mocker.Mock(spec=progress.Reporter, enabled=False)
+    multi = progress.MultiReporter([reporter, other])
+    assert multi.enabled
+    planned = _planned('a.txt')
+
+    multi.listed('conn', 'subject', 1)
+    multi.transferred(planned, 6)
+    multi.done(planned, 6)
+
+    assert [event['event'] for event in _events(output)] == ['listed', 'transfer', 'done']
+    other.listed.assert_called_once_with('conn', 'subject', 1)
+    other.transferred.assert_not_called()
+    other.done.assert_called_once_with(planned, 6)
+    assert not progress.MultiReporter([other]).enabled
@@ -0,0 +1,93 @@
+import io
+import threading
+
+import pytest
+
+from kitovu.sync import ratelimit
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_bucket_burst(clock):
+    bucket = ratelimit.TokenBucket(10, clock=clock, sleep=clock.sleep)
+    for _ in range(10):
+        assert bucket.consume(1) == 0
+    assert bucket.consume(1) == pytest.approx(0.1)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_bucket_refill(clock):
+    bucket = ratelimit.TokenBucket(100, clock=clock, sleep=clock.sleep)
+    bucket.consume(100)
+    clock.now += 0.5
+    assert bucket.consume(50) == 0
+    # The bucket doesn't fill up beyond its burst size.
+    clock.now += 10
+    assert bucket.consume(150) == pytest.approx(0.5)
+
+
+def test_bucket_bigger_than_burst(clock):
+    bucket = ratelimit.TokenBucket(1000, clock=clock, sleep=clock.sleep)
+    assert bucket.consume(3000) == pytest.approx(2)
+    # The debt is paid back by now, but there are no tokens left.
+    assert bucket.consume(1000) == pytest.approx(1)
+
+
+def test_bucket_threads():
+    sleeps = []
+    bucket = ratelimit.TokenBucket(10, clock=lambda: 0.0, sleep=sleeps.append)
+    threads = [threading.Thread(target=bucket.consume, args=(1,)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every thread reserved its own share.
+    assert sorted(sleeps) == [pytest.approx(i / 10) for i in range(1, 11)]
+
+
+@pytest.mark.parametrize('data, expected', [
+    (None, None),
+    ({}, ratelimit.RateLimit()),
+    ({'bytes-per-second': 1000, 'requests-per-second': 2.5},
+     ratelimit.RateLimit(bytes_per_second=1000, requests_per_second=2.5)),
+])
+def test_rate_limit_from_json(data, expected):
+    assert ratelimit.RateLimit.from_json(data) == expected
+
+
+def test_limiter_from_limit():
+    global_limiter = ratelimit.Limiter.from_limit(ratelimit.RateLimit(bytes_per_second=1000))
+    limiter = ratelimit.Limiter.from_limit(ratelimit.RateLimit(requests_per_second=2),
+                                           parent=global_limiter)
+    assert limiter.byte_buckets == global_limiter.byte_buckets
+    assert [bucket.rate for bucket in limiter.request_buckets] == [2]
+    assert limiter.limits_bytes
+    assert not ratelimit.Limiter.from_limit(None).limits_bytes
+
+
+def test_throttled_writer(clock):
+    bucket = ratelimit.TokenBucket(1000, clock=clock, sleep=clock.sleep)
+    fileobj = io.BytesIO()
+    writer = ratelimit.ThrottledWriter(fileobj, ratelimit.Limiter(byte_buckets=[bucket]))
+    for _ in range(3):
+        writer.write(b'x' * 1000)
+    assert fileobj.getvalue() == b'x' * 3000
+    assert sum(clock.sleeps) == pytest.approx(2)
+    assert writer.tell() == 3000
@@ -0,0 +1,57 @@
+import functools
+
+import pytest
+import stevedore
+
+from kitovu import utils
+from kitovu.sync import registry
+from kitovu.sync.plugin import smb, moodle
+from helpers import dummyplugin
+
+
+@pytest.fixture
+def plugins():
+    return registry.PluginRegistry()
+
+
+@pytest.mark.parametrize('name, cls', [('smb', smb.SmbPlugin), ('moodle', moodle.MoodlePlugin)])
+def test_builtin(plugins, mocker, name, cls):
+    manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
+    assert plugins.get_class(name) is cls
+    assert isinstance(plugins.create(name), cls)
+    assert not manager.called
+
+
+def test_new_instances(plugins):
+    assert plugins.create('smb') is not plugins.create('smb')
+
+
+def test_external_scanned_once(plugins, mocker, temppath):
+    manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
+    manager.return_value.driver = functools.partial(dummyplugin.DummyPlugin, temppath)
+
+    for _ in range(3):
+        assert isinstance(plugins.create('dummy'), dummyplugin.DummyPlugin)
+
+    manager.assert_called_once_with(namespace='kitovu.sync.plugin', name='dummy',
+                                    invoke_on_load=False)
+
+
+def test_missing_scanned_once(plugins, mocker):
+    manager = mocker.patch('stevedore.driver.DriverManager', autospec=True,
+                           side_effect=stevedore.exception.NoMatches)
+
+    for _ in range(2):
+        with pytest.raises(utils.NoPluginError, match='The plugin doesnotexist was not found'):
+            plugins.get_class('doesnotexist')
+
+    assert manager.call_count == 1
+
+
+def test_clear(plugins, mocker):
+    manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
+    manager.return_value.driver = dummyplugin.DummyPlugin
+    plugins.get_class('dummy')
+    plugins.clear()
+    plugins.get_class('dummy')
+    assert manager.call_count == 2
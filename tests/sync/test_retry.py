@@ -0,0 +1,97 @@
+import pytest
+
+from kitovu import utils
+from kitovu.sync import retry
+from helpers import dummyplugin
+
+
+@pytest.fixture
+def plugin(temppath):
+    plugin = dummyplugin.DummyPlugin(temppath)
+    plugin.connect()
+    return plugin
+
+
+class Flaky:
+
+    """A function failing with the given errors first."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'result'
+
+
+@pytest.mark.parametrize('attempt, maximum', [(1, 1), (2, 2), (3, 4), (10, 60)])
+def test_backoff(monkeypatch, attempt, maximum):
+    monkeypatch.setattr(retry.random, 'uniform', lambda low, high: (low, high))
+    assert retry.backoff(attempt) == (0, maximum)
+
+
+def test_retry(plugin, caplog):
+    sleeps = []
+    retries = []
+    budget = retry.RetryBudget(10, sleep=sleeps.append)
+    func = Flaky(utils.TransientError('timeout'), utils.TransientError('timeout'))
+
+    assert budget.call(func, plugin, 'Testing', on_retry=lambda: retries.append(1)) == 'result'
+
+    assert func.calls == 3
+    assert len(sleeps) == len(retries) == 2
+    assert budget.remaining == 8
+    assert budget.used == 2
+    assert caplog.records[-1].message.startswith('Testing failed (timeout), retrying in ')
+
+
+def test_non_transient_error(plugin):
+    budget = retry.RetryBudget(10, sleep=pytest.fail)
+    func = Flaky(utils.PluginOperationError('not found'))
+    with pytest.raises(utils.PluginOperationError, match='not found'):
+        budget.call(func, plugin, 'Testing')
+    assert func.calls == 1
+
+
+def test_max_attempts(plugin):
+    budget = retry.RetryBudget(100, sleep=lambda _delay: None)
+    func = Flaky(*[utils.TransientError(str(i)) for i in range(10)])
+    with pytest.raises(utils.TransientError, match=str(retry.MAX_ATTEMPTS - 1)):
+        budget.call(func, plugin, 'Testing')
+    assert func.calls == retry.MAX_ATTEMPTS
+
+
+def test_budget_exhausted(plugin, caplog):
+    budget = retry.RetryBudget(1, sleep=lambda _delay: None)
+    assert budget.call(Flaky(utils.TransientError('1')), plugin, 'Testing') == 'result'
+
+    for _ in range(2):
+        with pytest.raises(utils.TransientError):
+            budget.call(Flaky(utils.TransientError('2')), plugin, 'Testing')
+    messages = [record.message for record in caplog.records]
+    assert messages.count('No retries left for this run, not retrying failed operations') == 1
+
+
+def test_reconnect(plugin, mocker):
+    connect_spy = mocker.spy(plugin, 'connect')
+    budget = retry.RetryBudget(10, sleep=lambda _delay: None)
+    func = Flaky(utils.TransientError('timeout'), utils.ConnectionLostError('gone'))
+
+    assert budget.call(func, plugin, 'Testing') == 'result'
+    assert connect_spy.call_count == 1
+    assert plugin.is_connected
+
+
+def test_reconnect_failing(plugin, mocker):
+    budget = retry.RetryBudget(10, sleep=lambda _delay: None)
+    func = Flaky(utils.ConnectionLostError('gone'))
+    mocker.patch.object(plugin, 'disconnect')
+    mocker.patch.object(plugin, 'connect', side_effect=[
+        utils.PluginOperationError('Could not connect'), None])
+
+    assert budget.call(func, plugin, 'Testing') == 'result'
+    assert func.calls == 2
+    assert budget.used == 2
@@ -1,11 +1,12 @@
 import os
 import re
+import time
 import pathlib
 
 import pytest
 
 from kitovu import utils
-from kitovu.sync import settings
+from kitovu.sync import settings, ratelimit
 from kitovu.sync.settings import Settings, ConnectionSettings
 
 
@@ -48,6 +49,7 @@ def test_load_a_sample_yaml_file(assets_dir):
                 {
                     'name': 'Engineering-Projekt',
                     'ignore': ['Thumbs.db', '.DS_Store', 'SubDir', 'example.txt'],
+                    'priority': 0,
                     'remote-dir': pathlib.PurePath('Informatik/Fachbereich/Engineering-Projekt/EPJ'),
                     'local-dir': pathlib.Path(f'{expected_root_dir}/Engineering-Projekt'),
                 }
@@ -92,3 +94,231 @@ def test_invalid_yaml_files(temppath: pathlib.Path):
     assert str(excinfo.value) == f"""Failed to load configuration:
 mapping values are not allowed here
   in "{config_yml}", line 5, column 16"""
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('', 'json'),
+    ('filecache-format: json', 'json'),
+    ('filecache-format: binary', 'binary'),
+])
+def test_filecache_format(temppath: pathlib.Path, line, expected):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text(f"""
+root-dir: ./asdf
+connections: []
+subjects: []
+{line}
+""", encoding='utf-8')
+    assert Settings.from_yaml_file(config_yml).filecache_format == expected
+
+
+def test_invalid_filecache_format(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+connections: []
+subjects: []
+filecache-format: xml
+""", encoding='utf-8')
+    with pytest.raises(utils.InvalidSettingsError, match="'xml' is not one of"):
+        Settings.from_yaml_file(config_yml)
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('', None),
+    ('content-hash: sha256', 'sha256'),
+    ('content-hash: blake2b', 'blake2b'),
+])
+def test_content_hash(temppath: pathlib.Path, line, expected):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text(f"""
+root-dir: ./asdf
+connections: []
+subjects: []
+{line}
+""", encoding='utf-8')
+    assert Settings.from_yaml_file(config_yml).content_hash == expected
+
+
+def test_invalid_content_hash(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+connections: []
+subjects: []
+content-hash: md5
+""", encoding='utf-8')
+    with pytest.raises(utils.InvalidSettingsError, match="'md5' is not one of"):
+        Settings.from_yaml_file(config_yml)
+
+
+def test_subject_priority(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+connections:
+  - name: conn
+    plugin: smb
+subjects:
+  - name: important
+    priority: 10
+    sources:
+      - connection: conn
+        remote-dir: a
+  - name: other
+    sources:
+      - connection: conn
+        remote-dir: b
+""", encoding='utf-8')
+    subjects = Settings.from_yaml_file(config_yml).connections['conn'].subjects
+    assert [(subject['name'], subject['priority']) for subject in subjects] == [
+        ('important', 10), ('other', 0)]
+
+
+def test_rate_limit(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+rate-limit:
+  bytes-per-second: 1000000
+connections:
+  - name: conn
+    plugin: smb
+    username: user
+    rate-limit:
+      requests-per-second: 5
+  - name: other
+    plugin: moodle
+subjects: []
+""", encoding='utf-8')
+    settings = Settings.from_yaml_file(config_yml)
+    assert settings.rate_limit == ratelimit.RateLimit(bytes_per_second=1000000)
+    assert settings.connections['conn'].rate_limit == ratelimit.RateLimit(requests_per_second=5)
+    assert settings.connections['conn'].connection == {'username': 'user'}
+    assert settings.connections['other'].rate_limit is None
+
+
+def test_invalid_rate_limit(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+rate-limit:
+  bytes-per-second: 0
+connections: []
+subjects: []
+""", encoding='utf-8')
+    with pytest.raises(utils.InvalidSettingsError, match="less than or equal to the minimum of 0"):
+        Settings.from_yaml_file(config_yml)
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('', 'copy'),
+    ('deduplicate: hardlink', 'hardlink'),
+    ('deduplicate: "off"', 'off'),
+    ('deduplicate: off', 'off'),
+])
+def test_deduplicate(temppath: pathlib.Path, line, expected):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text(f"""
+root-dir: ./asdf
+connections: []
+subjects: []
+{line}
+""", encoding='utf-8')
+    assert Settings.from_yaml_file(config_yml).deduplicate == expected
+
+
+def test_invalid_deduplicate(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: ./asdf
+connections: []
+subjects: []
+deduplicate: symlink
+""", encoding='utf-8')
+    with pytest.raises(utils.InvalidSettingsError, match="'symlink' is not one of"):
+        Settings.from_yaml_file(config_yml)
+
+
+def test_unsafe_yaml(temppath: pathlib.Path):
+    config_yml = temppath / 'config.yml'
+    config_yml.write_text("""
+root-dir: !!python/object/apply:os.getcwd []
+connections: []
+subjects: []
+""", encoding='utf-8')
+    with pytest.raises(utils.UsageError, match='Failed to load configuration'):
+        Settings.from_yaml_file(config_yml)
+
+
+class TestCache:
+
+    @pytest.fixture
+    def config_yml(self, temppath: pathlib.Path):
+        config_yml = temppath / 'config.yml'
+        self._write(config_yml, 'json', mtime=1000)
+        return config_yml
+
+    def _write(self, path, filecache_format, mtime):
+        path.write_text(f"""
+root-dir: ./asdf
+connections: []
+subjects: []
+filecache-format: {filecache_format}
+""", encoding='utf-8')
+        os.utime(str(path), (mtime, mtime))
+
+    @pytest.fixture
+    def loads(self, monkeypatch):
+        """Count how often the YAML file is actually parsed."""
+        calls = []
+        original = Settings.from_yaml_stream.__func__
+
+        def from_yaml_stream(cls, stream):
+            calls.append(stream)
+            return original(cls, stream)
+
+        monkeypatch.setattr(Settings, 'from_yaml_stream', classmethod(from_yaml_stream))
+        return calls
+
+    def test_cached(self, config_yml, loads):
+        first = Settings.from_yaml_file(config_yml)
+        second = Settings.from_yaml_file(config_yml)
+        assert first == second
+        assert first is not second
+        assert len(loads) == 1
+
+    def test_changed_file(self, config_yml, loads):
+        Settings.from_yaml_file(config_yml)
+        self._write(config_yml, 'binary', mtime=2000)
+        assert Settings.from_yaml_file(config_yml).filecache_format == 'binary'
+        assert len(loads) == 2
+
+    def test_changed_version(self, config_yml, loads, monkeypatch):
+        Settings.from_yaml_file(config_yml)
+        monkeypatch.setattr('kitovu.__version__', '1337.0.0')
+        Settings.from_yaml_file(config_yml)
+        assert len(loads) == 2
+
+    def test_recently_changed(self, temppath, loads):
+        config_yml = temppath / 'config.yml'
+        self._write(config_yml, 'json', mtime=time.time())
+        Settings.from_yaml_file(config_yml)
+        Settings.from_yaml_file(config_yml)
+        assert len(loads) == 2
+        assert not settings.get_cache_path().exists()
+
+    def test_invalid_cache(self, config_yml, loads):
+        Settings.from_yaml_file(config_yml)
+        for cache_file in settings.get_cache_path().iterdir():
+            cache_file.write_bytes(b'garbage')
+        assert Settings.from_yaml_file(config_yml).filecache_format == 'json'
+        assert len(loads) == 2
+
+    def test_invalid_not_cached(self, config_yml, loads):
+        config_yml.write_text('root-dir: ./asdf\n', encoding='utf-8')
+        os.utime(str(config_yml), (1000, 1000))
+        for _ in range(2):
+            with pytest.raises(utils.InvalidSettingsError):
+                Settings.from_yaml_file(config_yml)
+        assert len(loads) == 2
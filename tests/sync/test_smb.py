@@ -7,6 +7,7 @@ import pytest
 import attr
 import keyring
 from smb.SMBConnection import SMBConnection
+from smb.base import NotConnectedError, SMBTimeout
 from smb.smb_structs import OperationFailure, ProtocolError
 
 from kitovu.sync import syncing
@@ -70,11 +71,15 @@ class SMBConnectionMock:
     def getAttributes(self, share, path):
         if path.endswith('missing'):
             raise OperationFailure('msg1', 'msg2')
+        elif path.endswith('timeout'):
+            raise SMBTimeout()
         return self.AttributesMock(1024, 988824605.56)
 
     def listPath(self, share, path):
         if path.endswith('missing'):
             raise OperationFailure('msg1', 'msg2')
+        elif path.endswith('disconnected'):
+            raise NotConnectedError()
         if str(path).endswith('example_dir') or str(path).endswith('sub'):
             return [self.SharedFileMock('sub_file', False)]
         return [
@@ -90,6 +95,8 @@ class SMBConnectionMock:
     def retrieveFile(self, share, path, fileobj):
         if path.endswith('missing'):
             raise OperationFailure('msg1', 'msg2')
+        elif path.endswith('reset'):
+            raise ConnectionResetError('Connection reset by peer')
         fileobj.write(b'HELLO KITOVU')
 
     def is_connected(self):
@@ -241,6 +248,10 @@ class TestWithConnectedPlugin:
 
         assert plugin.create_local_digest(testfile) == f'{len(text)}-13371337'
 
+    def test_create_local_digest_from_stat(self, plugin, temppath):
+        stat = FakeStatResult(st_size=12, st_mtime=13371337.4242)
+        assert plugin.create_local_digest_from_stat(temppath / 'foo.txt', stat) == '12-13371337'
+
     def test_create_remote_digest(self, plugin):
         assert plugin.create_remote_digest(pathlib.PurePath('/test')) == '1024-988824605'
 
@@ -251,6 +262,16 @@ class TestWithConnectedPlugin:
 
         assert str(excinfo.value) == f'Could not find remote file {path} in share "skripte"'
 
+    def test_remote_size(self, plugin):
+        path = pathlib.PurePath('/test')
+        plugin.create_remote_digest(path)
+        assert plugin.remote_size(path) == 1024
+
+    def test_remote_mtime(self, plugin):
+        path = pathlib.PurePath('/test')
+        plugin.create_remote_digest(path)
+        assert plugin.remote_mtime(path) == 988824605
+
     def test_list_path(self, plugin):
         paths = list(plugin.list_path(pathlib.PurePath('/some/test/dir')))
         assert paths == [
@@ -277,6 +298,25 @@ class TestWithConnectedPlugin:
         assert plugin.retrieve_file(path, fileobj) == mtime
         assert fileobj.getvalue() == b"HELLO KITOVU"
 
+    def test_retrieve_file_without_digest(self, plugin):
+        fileobj = io.BytesIO()
+        assert plugin.retrieve_file(pathlib.PurePath('foo.txt'), fileobj) == 988824605.56
+        assert fileobj.getvalue() == b"HELLO KITOVU"
+
+    def test_connection_lost(self, plugin):
+        with pytest.raises(utils.ConnectionLostError,
+                           match='Lost connection to svm-c213.hsr.ch: SMBTimeout'):
+            plugin.create_remote_digest(pathlib.PurePath('/test/timeout'))
+        with pytest.raises(utils.ConnectionLostError,
+                           match='Lost connection to svm-c213.hsr.ch: NotConnectedError'):
+            list(plugin.list_path(pathlib.PurePath('/test/disconnected')))
+
+        path = pathlib.PurePath('foo.reset')
+        plugin.create_remote_digest(path)
+        with pytest.raises(utils.ConnectionLostError,
+                           match='Lost connection to svm-c213.hsr.ch: Connection reset by peer'):
+            plugin.retrieve_file(path, io.BytesIO())
+
     def test_retrieve_file_error(self, plugin):
         with pytest.raises(utils.PluginOperationError):
             plugin.retrieve_file(pathlib.PurePath('foo.missing'), io.BytesIO())
@@ -1,11 +1,18 @@
+import io
+import os
+import copy
+import json
+import logging
 import pathlib
+import threading
 
 import appdirs
 import stevedore
 import pytest
 
 from kitovu import utils
-from kitovu.sync import syncing
+from kitovu.sync import (syncing, filecache, hashing, planning, ratelimit, progress, instrumentation,
+                         metrics, localindex)
 from kitovu.sync.plugin import smb
 from kitovu.sync.settings import ConnectionSettings
 from helpers import dummyplugin
@@ -33,8 +40,8 @@ def dummy_plugin(temppath):
 def patch_dummy_plugin(dummy_plugin, mocker):
     manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
     instance = manager(namespace='kitovu.sync.plugin', name='test',
-                       invoke_on_load=True)
-    instance.driver = dummy_plugin
+                       invoke_on_load=False)
+    instance.driver = lambda: dummy_plugin
 
 
 class TestFindPlugin:
@@ -53,8 +60,8 @@ class TestFindPlugin:
     def test_load_plugin_external(self, mocker, dummy_plugin):
         manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
         instance = manager(namespace='kitovu.sync.plugin', name='test',
-                           invoke_on_load=True)
-        instance.driver = dummy_plugin
+                           invoke_on_load=False)
+        instance.driver = lambda: dummy_plugin
 
         settings = self._get_settings('test', connection={'some-required-prop': 'test'})
         plugin = syncing._load_plugin(settings)
@@ -72,10 +79,7 @@ class TestSyncAll:
 
     @pytest.fixture(autouse=True)
     def configured_dummy_plugin(self, mocker, temppath):
-        manager = mocker.patch('stevedore.driver.DriverManager', autospec=True)
-        instance = manager(namespace='kitovu.sync.plugin', name='dummy',
-                           invoke_on_load=True)
-        instance.driver = dummyplugin.DummyPlugin(temppath, remote_digests={
+        plugin = dummyplugin.DummyPlugin(temppath, remote_digests={
             pathlib.PurePath('Some/Test/Dir1/group1-file1.txt'): '11',
             pathlib.PurePath('Some/Test/Dir1/group1-file2.txt'): '12',
             pathlib.PurePath('Some/Test/Dir1/group1-file3.txt'): '13',
@@ -88,11 +92,24 @@ class TestSyncAll:
         }, local_digests={
             temppath / 'syncs/sync-1/group1-file1.txt': '11',
         })
-        return instance.driver
 
+        def create_manager(**_kwargs):
+            # All connections are connected at the same time, so every one
+            # needs its own plugin instance (sharing the digests).
+            manager = mocker.Mock()
+            manager.driver = lambda: copy.copy(plugin)
+            return manager
+
+        mocker.patch('stevedore.driver.DriverManager', side_effect=create_manager)
+        return plugin
+
+    @pytest.mark.parametrize('content_hash', [None, 'sha256'])
     @pytest.mark.parametrize('mtime', [None, 13371337])
-    def test_complex_sync_all(self, mtime, temppath: pathlib.Path, configured_dummy_plugin):
+    @pytest.mark.parametrize('thread_safe', [True, False])
+    def test_complex_sync_all(self, mtime, content_hash, thread_safe, temppath: pathlib.Path,
+                              configured_dummy_plugin):
         configured_dummy_plugin.mtime = mtime
+        configured_dummy_plugin.THREAD_SAFE = thread_safe
 
         group1_file1 = temppath / 'syncs/sync-1/group1-file1.txt'
         group1_file1.parent.mkdir(parents=True)
@@ -103,6 +120,7 @@ class TestSyncAll:
         config_yml = temppath / 'config.yml'
         config_yml.write_text(f"""
         root-dir: {temppath}/syncs
+        {'' if content_hash is None else f'content-hash: {content_hash}'}
         global-ignore:
             - group3-file1.txt
         connections:
@@ -143,6 +161,418 @@ class TestSyncAll:
             assert int(group1_file1.stat().st_mtime) != mtime  # no remote changes
             assert int(group1_file2.stat().st_mtime) == mtime
 
+        shards = ''.join(path.read_text() for path in (temppath / 'filecache').glob('*.json'))
+        assert ('sha256-' in shards) == (content_hash is not None)
+
+    def test_migrate_with_several_connections(self, temppath):
+        old_filename = filecache.get_path().with_suffix('.json')
+        old_filename.parent.mkdir(parents=True, exist_ok=True)
+        old_filename.write_text(json.dumps({
+            'version': 2,
+            'subjects': [{
+                'connection': connection,
+                'subject': 'sync-1',
+                'remote-dir': remote_dir,
+                'plugin': 'dummyplugin',
+                'files': [[0, 'unchanged.txt', '1']],
+            } for connection, remote_dir in [('mytest-plugin', 'Some/Test/Dir1'),
+                                             ('another-plugin', 'Another/Test/Dir1')]],
+        }))
+
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        connections:
+          - name: mytest-plugin
+            plugin: dummy
+          - name: another-plugin
+            plugin: dummy
+        subjects:
+          - name: sync-1
+            sources:
+              - connection: mytest-plugin
+                remote-dir: Some/Test/Dir1
+              - connection: another-plugin
+                remote-dir: Another/Test/Dir1
+        """, encoding='utf-8')
+        syncing.start_all(config_yml)
+
+        assert not old_filename.exists()
+        cache = filecache.FileCache(filecache.get_path())
+        cache.load()
+        assert [info.key for info in cache.shard_infos()] == [
+            ('another-plugin', 'sync-1', 'Another/Test/Dir1'),
+            ('mytest-plugin', 'sync-1', 'Some/Test/Dir1'),
+        ]
+
+    def test_parallel_connections(self, temppath, configured_dummy_plugin, mocker, caplog):
+        configured_dummy_plugin.THREAD_SAFE = False
+        connect_spy = mocker.spy(dummyplugin.DummyPlugin, 'connect')
+        disconnect_spy = mocker.spy(dummyplugin.DummyPlugin, 'disconnect')
+
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        connections:
+          - name: mytest-plugin
+            plugin: dummy
+        subjects:
+          - name: sync-1
+            sources:
+              - connection: mytest-plugin
+                remote-dir: Some/Test/Dir1
+        """, encoding='utf-8')
+        caplog.set_level(logging.INFO)
+        syncing.start_all(config_yml, syncing.SyncOptions(jobs=2))
+
+        assert len(list((temppath / 'syncs/sync-1').iterdir())) == 3
+        # After the first download, a second one is started in parallel.
+        assert connect_spy.call_count == 2
+        assert disconnect_spy.call_count == 2
+        summary = [record.message for record in caplog.records
+                   if record.message.startswith('mytest-plugin: ')]
+        assert len(summary) == 1
+        assert summary[0].startswith('mytest-plugin: 3 files (102 B) in ')
+        assert summary[0].endswith(', 0 failed, up to 2 parallel downloads (2 at the end)')
+
+
+class TestPlan:
+
+    @pytest.fixture
+    def config_yml(self, temppath, patch_dummy_plugin):
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        connections:
+          - name: conn
+            plugin: dummy
+            some-required-prop: test
+        subjects:
+          - name: subject
+            sources:
+              - connection: conn
+                remote-dir: remote_dir
+        """, encoding='utf-8')
+        return config_yml
+
+    def test_dry_run(self, temppath, config_yml):
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+
+        local_dir = temppath / 'syncs' / 'subject'
+        assert [(planned.state, planned.local_path) for planned in plan.files] == [
+            (filecache.FileState.NEW, local_dir / 'test' / f'example{i}.txt')
+            for i in range(1, 5)
+        ]
+        assert not local_dir.exists()
+        assert not filecache.get_path().exists()
+
+    def test_execute_plan(self, temppath, config_yml, dummy_plugin):
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        del plan.files[1:3]
+        local_dir = temppath / 'syncs' / 'subject' / 'test'
+
+        # Files already downloaded since the plan was created are skipped.
+        executed = syncing.start_all(config_yml, syncing.SyncOptions(
+            plan=planning.Plan(files=plan.files[1:])))
+        assert len(executed.files) == 1
+        example4 = local_dir / 'example4.txt'
+        assert example4.read_text() == 'remote_dir/test/example4.txt\n4'
+
+        example4.write_text('local changes')
+        dummy_plugin.local_digests[example4] = 'changed'
+        executed = syncing.start_all(config_yml, syncing.SyncOptions(plan=plan))
+        assert len(executed.files) == 2
+        assert sorted(local_dir.iterdir()) == [local_dir / 'example1.txt', example4]
+        assert example4.read_text() == 'local changes'
+
+    def test_recheck_without_lock(self, config_yml, dummy_plugin, monkeypatch):
+        planned = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True)).files[0]
+        lock = threading.Lock()
+        create_remote_digest = dummy_plugin.create_remote_digest
+
+        def unlocked_create_remote_digest(path):
+            # Remote requests of parallel downloads shouldn't wait for each other.
+            assert not lock.locked()
+            return create_remote_digest(path)
+
+        monkeypatch.setattr(dummy_plugin, 'create_remote_digest', unlocked_create_remote_digest)
+        dummy_plugin.connect()
+        cache = filecache.SubjectCache(planned.local_dir, dummy_plugin.NAME)
+        index = localindex.LocalIndex(planned.local_dir)
+        index.scan()
+
+        assert syncing._still_needed(planned, dummy_plugin, cache, index, None, lock)
+
+    def test_rate_limit(self, config_yml, monkeypatch):
+        with config_yml.open('a', encoding='utf-8') as f:
+            f.write("rate-limit: {bytes-per-second: 1000000, requests-per-second: 1000}\n")
+        consumed = []
+        monkeypatch.setattr(ratelimit.TokenBucket, 'consume',
+                            lambda bucket, amount: consumed.append((bucket.rate, amount)))
+
+        syncing.start_all(config_yml)
+
+        requests = [amount for rate, amount in consumed if rate == 1000]
+        transferred = [amount for rate, amount in consumed if rate == 1000000]
+        # One listing, and a remote digest and download per file.
+        assert len(requests) == 1 + 4 + 4
+        assert transferred == [len(f'remote_dir/test/example{i}.txt\n{i}') for i in range(1, 5)]
+
+    @pytest.mark.parametrize('retries, expected', [
+        (0, ['example2.txt']),
+        (100, []),
+    ])
+    def test_retry(self, temppath, config_yml, dummy_plugin, mocker, monkeypatch,
+                   retries, expected):
+        monkeypatch.setattr(syncing.retry, 'backoff', lambda _attempt: 0)
+        errors = [utils.ConnectionLostError('Connection reset')]
+        retrieve_file = dummy_plugin.retrieve_file
+
+        def flaky_retrieve_file(path, fileobj):
+            if path.name == 'example2.txt' and errors:
+                raise errors.pop()
+            return retrieve_file(path, fileobj)
+
+        monkeypatch.setattr(dummy_plugin, 'retrieve_file', flaky_retrieve_file)
+        connect_spy = mocker.spy(dummy_plugin, 'connect')
+
+        syncing.start_all(config_yml, syncing.SyncOptions(jobs=1, retries=retries))
+
+        # Reconnected before retrying
+        assert connect_spy.call_count == (2 if retries else 1)
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        assert [planned.local_path.name for planned in plan.files] == expected
+
+    @pytest.mark.parametrize('deduplicate, retrieved', [
+        ('copy', 4),
+        ('hardlink', 4),
+        ('off', 8),
+    ])
+    def test_deduplicate(self, temppath, dummy_plugin, patch_dummy_plugin, mocker,
+                         deduplicate, retrieved):
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        deduplicate: {deduplicate}
+        connections:
+          - name: conn
+            plugin: dummy
+            some-required-prop: test
+        subjects:
+          - name: subject1
+            sources:
+              - connection: conn
+                remote-dir: remote_dir
+          - name: subject2
+            sources:
+              - connection: conn
+                remote-dir: remote_dir
+        """, encoding='utf-8')
+        retrieve_spy = mocker.spy(dummy_plugin, 'retrieve_file')
+
+        syncing.start_all(config_yml)
+
+        assert retrieve_spy.call_count == retrieved
+        for i in range(1, 5):
+            first = temppath / 'syncs' / 'subject1' / 'test' / f'example{i}.txt'
+            second = temppath / 'syncs' / 'subject2' / 'test' / f'example{i}.txt'
+            assert first.read_text() == second.read_text()
+            assert (deduplicate == 'hardlink') == os.path.samefile(str(first), str(second))
+
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        assert not plan.files
+
+    def test_progress(self, temppath, config_yml):
+        output = io.StringIO()
+        syncing.start_all(config_yml, syncing.SyncOptions(
+            reporter=progress.JsonLinesReporter(output)))
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        kinds = [event['event'] for event in events]
+
+        assert kinds[:6] == ['listing', 'listed'] + ['planned'] * 4
+        assert events[0]['subject'] == 'subject'
+        assert events[1]['files'] == 4
+        assert kinds[-2:] == ['summary', 'finished']
+        assert sorted(kinds[6:-2]) == ['done'] * 4 + ['transfer'] * 4
+
+        local_dir = temppath / 'syncs' / 'subject' / 'test'
+        for i in range(1, 5):
+            local_path = str(local_dir / f'example{i}.txt')
+            planned, = [e for e in events if e['event'] == 'planned' and e['local-path'] == local_path]
+            done, = [e for e in events if e['event'] == 'done' and e['local-path'] == local_path]
+            transferred = sum(e['bytes'] for e in events
+                              if e['event'] == 'transfer' and e['local-path'] == local_path)
+            assert planned['remote-path'] == f'remote_dir/test/example{i}.txt'
+            assert done['size'] == transferred == len(f'remote_dir/test/example{i}.txt\n{i}')
+
+        assert events[-1]['files'] == 4
+        assert events[-1]['failed'] == 0
+        assert events[-2]['connection'] == 'conn'
+
+    def test_session(self, temppath, config_yml, dummy_plugin, mocker):
+        connect_spy = mocker.spy(dummy_plugin, 'connect')
+        session = syncing.Session()
+        options = syncing.SyncOptions(session=session)
+
+        syncing.start_all(config_yml, options)
+        assert dummy_plugin.is_connected
+        dummy_plugin.remote_digests[pathlib.PurePath('remote_dir/test/example5.txt')] = '5'
+        syncing.start_all(config_yml, options)
+
+        assert connect_spy.call_count == 1
+        assert (temppath / 'syncs' / 'subject' / 'test' / 'example5.txt').exists()
+        session.close()
+        assert not dummy_plugin.is_connected
+
+    def test_session_changed_settings(self, config_yml, dummy_plugin, mocker):
+        connect_spy = mocker.spy(dummy_plugin, 'connect')
+        session = syncing.Session()
+        syncing.start_all(config_yml, syncing.SyncOptions(session=session))
+
+        config_yml.write_text(config_yml.read_text().replace(
+            'some-required-prop: test', 'some-required-prop: changed'))
+        syncing.start_all(config_yml, syncing.SyncOptions(session=session))
+
+        assert connect_spy.call_count == 2
+        session.close()
+
+    def test_cancel(self, temppath, config_yml, dummy_plugin, mocker):
+        cancel = threading.Event()
+        retrieve_file = dummy_plugin.retrieve_file
+
+        def retrieve_and_cancel(path, fileobj):
+            cancel.set()
+            return retrieve_file(path, fileobj)
+
+        mocker.patch.object(dummy_plugin, 'retrieve_file', side_effect=retrieve_and_cancel)
+        syncing.start_all(config_yml, syncing.SyncOptions(cancel=cancel, jobs=1))
+
+        local_dir = temppath / 'syncs' / 'subject' / 'test'
+        assert [path.name for path in local_dir.iterdir()] == ['example1.txt']
+        assert not dummy_plugin.is_connected
+
+        # The finished download is in the cache, so only the others are left.
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        assert [planned.local_path.name for planned in plan.files] == [
+            'example2.txt', 'example3.txt', 'example4.txt']
+
+    def test_cancel_while_planning(self, temppath, config_yml, dummy_plugin, mocker):
+        cancel = threading.Event()
+        create_remote_digest = dummy_plugin.create_remote_digest
+        checked = []
+
+        def create_remote_digest_and_cancel(path):
+            checked.append(path.name)
+            cancel.set()
+            return create_remote_digest(path)
+
+        mocker.patch.object(dummy_plugin, 'create_remote_digest',
+                            side_effect=create_remote_digest_and_cancel)
+        syncing.start_all(config_yml, syncing.SyncOptions(cancel=cancel, jobs=1))
+
+        # The other files of the subject aren't checked anymore.
+        assert checked == ['example1.txt']
+        assert not (temppath / 'syncs' / 'subject' / 'test').exists()
+        assert not dummy_plugin.is_connected
+
+    def test_failed_download(self, temppath, config_yml, dummy_plugin, monkeypatch):
+        syncing.start_all(config_yml)
+        local_dir = temppath / 'syncs' / 'subject' / 'test'
+        example2 = local_dir / 'example2.txt'
+        dummy_plugin.remote_digests[pathlib.PurePath('remote_dir/test/example2.txt')] = 'new'
+
+        def failing_retrieve_file(_path, fileobj):
+            fileobj.write(b'half a file')
+            raise utils.PluginOperationError('Permission denied')
+
+        monkeypatch.setattr(dummy_plugin, 'retrieve_file', failing_retrieve_file)
+        syncing.start_all(config_yml)
+
+        # The previous version is kept, and no temporary file is left over.
+        assert example2.read_text() == 'remote_dir/test/example2.txt\n2'
+        assert sorted(path.name for path in local_dir.iterdir()) == [
+            f'example{i}.txt' for i in range(1, 5)]
+
+    def test_changed_during_download(self, temppath, config_yml, dummy_plugin, monkeypatch):
+        example2 = pathlib.PurePath('remote_dir/test/example2.txt')
+        retrieve_file = dummy_plugin.retrieve_file
+
+        def retrieve_changed_file(path, fileobj):
+            if path == example2:
+                # Changed on the server after the file was planned.
+                dummy_plugin.remote_digests[path] = 'new'
+            return retrieve_file(path, fileobj)
+
+        monkeypatch.setattr(dummy_plugin, 'retrieve_file', retrieve_changed_file)
+        reporter = metrics.MetricsReporter()
+        syncing.start_all(config_yml, syncing.SyncOptions(reporter=reporter, jobs=1))
+
+        subject = reporter.subjects[('conn', 'subject')]
+        assert subject.downloaded_files == 3
+        assert reporter.errors == 1
+
+        # It wasn't recorded in the cache, so the next sync checks it again and
+        # finds the newer version which was downloaded.
+        local_path = temppath / 'syncs' / 'subject' / 'test' / 'example2.txt'
+        assert local_path.read_text() == 'remote_dir/test/example2.txt\nnew'
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        assert plan.files == []
+
+    def test_stats(self, config_yml):
+        stats = instrumentation.Stats()
+        syncing.start_all(config_yml, syncing.SyncOptions(stats=stats))
+
+        assert stats['dummy.connect'].calls == 1
+        assert stats['dummy.list_path'].calls == 1
+        assert stats['dummy.create_remote_digest'].calls == 4
+        assert stats['dummy.retrieve_file'].calls == 4
+        assert stats['dummy.retrieve_file'].transferred > 0
+        for name in ['filecache.load', 'filecache.write', 'localindex.scan', 'sync.plan',
+                     'sync.download']:
+            assert stats[name].calls >= 1, name
+
+    def test_metrics(self, config_yml):
+        reporter = metrics.MetricsReporter()
+        syncing.start_all(config_yml, syncing.SyncOptions(reporter=reporter))
+
+        subject = reporter.subjects[('conn', 'subject')]
+        assert subject.listed_files == subject.planned_files == subject.downloaded_files == 4
+        assert subject.downloaded_bytes == reporter.connections['conn'].downloaded_bytes > 0
+        assert reporter.errors == 0
+        assert reporter.seconds is not None
+
+    def test_plan_with_unknown_connection(self, config_yml, caplog):
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        for planned in plan.files:
+            planned.connection = 'other'
+
+        assert syncing.start_all(config_yml, syncing.SyncOptions(plan=plan)).files == []
+        assert caplog.records[-1].message == ('Connection other from the plan is not '
+                                              'configured, skipping it')
+
+    def test_time_budget(self, temppath, config_yml, dummy_plugin, monkeypatch):
+        now = 0
+        monkeypatch.setattr(syncing.time, 'monotonic', lambda: now)
+        retrieve_file = dummy_plugin.retrieve_file
+
+        def slow_retrieve_file(path, fileobj):
+            nonlocal now
+            now += 6
+            return retrieve_file(path, fileobj)
+
+        monkeypatch.setattr(dummy_plugin, 'retrieve_file', slow_retrieve_file)
+
+        syncing.start_all(config_yml, syncing.SyncOptions(time_budget=10, jobs=1))
+
+        # The deadline is checked before each download: two files fit into the
+        # budget, and those are still recorded in the file cache.
+        local_dir = temppath / 'syncs' / 'subject' / 'test'
+        assert sorted(path.name for path in local_dir.iterdir()) == [
+            'example1.txt', 'example2.txt']
+        plan = syncing.start_all(config_yml, syncing.SyncOptions(dry_run=True))
+        assert [planned.local_path.name for planned in plan.files] == [
+            'example3.txt', 'example4.txt']
+
 
 class TestErrorHandling:
 
@@ -156,12 +586,13 @@ class TestErrorHandling:
                 'remote-dir': 'remote_dir/test',
                 'local-dir': 'local_dir/test',
                 'ignore': [],
+                'priority': 0,
             }],
         )
 
     def test_connection_error(self, dummy_plugin, connection_settings, caplog):
         dummy_plugin.error_connect = True
-        syncing._start('connection', connection_settings)
+        syncing._prepare('connection', connection_settings)
 
         expected = 'Error from dummyplugin plugin: Could not connect, skipping this plugin'
         record = caplog.records[-1]
@@ -169,7 +600,7 @@ class TestErrorHandling:
 
     def test_list_path_error(self, dummy_plugin, connection_settings, caplog):
         dummy_plugin.error_list_path = True
-        syncing._start('connection', connection_settings)
+        syncing._prepare('connection', connection_settings)
 
         expected = 'Error from dummyplugin plugin: Could not list path, skipping this subject'
         record = caplog.records[-1]
@@ -177,13 +608,121 @@ class TestErrorHandling:
 
     def test_create_remote_digest_error(self, dummy_plugin, connection_settings, caplog):
         dummy_plugin.error_create_remote_digest = True
-        syncing._start('connection', connection_settings)
+        syncing._prepare('connection', connection_settings)
 
         expected = 'Error from dummyplugin plugin: Could not create remote digest, skipping this file'
         record = caplog.records[-1]
         assert record.message == expected
 
 
+class TestCollectGarbage:
+
+    @pytest.fixture
+    def config_yml(self, temppath):
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        connections:
+          - name: conn
+            plugin: dummy
+        subjects:
+          - name: subject
+            sources:
+              - connection: conn
+                remote-dir: remote_dir
+        """, encoding='utf-8')
+        return config_yml
+
+    def _fill_cache(self, temppath, plugin):
+        cache = filecache.FileCache(filecache.get_path())
+        local_dir = temppath / 'syncs' / 'subject'
+        local_dir.mkdir(parents=True)
+        (local_dir / 'existing.txt').touch()
+        for name, subject_dir in [('subject', local_dir), ('removed', temppath / 'removed')]:
+            subject_cache = cache.subject(connection='conn', name=name,
+                                          remote_dir=pathlib.PurePath('remote_dir'),
+                                          local_dir=subject_dir, plugin_name=plugin.NAME)
+            subject_cache.modify(subject_dir / 'existing.txt', plugin, '1')
+            subject_cache.modify(subject_dir / 'deleted.txt', plugin, '2')
+        cache.write()
+
+    def _loaded_entries(self, temppath):
+        cache = filecache.FileCache(filecache.get_path())
+        cache.load()
+        return {key: info.entries for key, info in cache._shards.items()}
+
+    def test_collect_garbage(self, temppath, config_yml, dummy_plugin):
+        self._fill_cache(temppath, dummy_plugin)
+
+        result = syncing.collect_garbage(config_yml)
+
+        assert result.entries == 3
+        assert result.shards == 1
+        assert result.reclaimed_bytes > 0
+        assert self._loaded_entries(temppath) == {('conn', 'subject', 'remote_dir'): 1}
+
+    def test_missing_local_dir(self, temppath, config_yml, dummy_plugin, caplog):
+        self._fill_cache(temppath, dummy_plugin)
+        local_dir = temppath / 'syncs' / 'subject'
+        (local_dir / 'existing.txt').unlink()
+        local_dir.rmdir()
+
+        result = syncing.collect_garbage(config_yml)
+
+        assert result.entries == 2
+        assert self._loaded_entries(temppath) == {('conn', 'subject', 'remote_dir'): 2}
+        assert caplog.records[-1].message == (f'Local directory {local_dir} does not exist, '
+                                              f'not compacting its entries')
+
+
+class TestVerifyCache:
+
+    @pytest.mark.parametrize('content_hash', [None, 'sha256'])
+    def test_verify(self, temppath, dummy_plugin, patch_dummy_plugin, content_hash):
+        config_yml = temppath / 'config.yml'
+        config_yml.write_text(f"""
+        root-dir: {temppath}/syncs
+        {'' if content_hash is None else f'content-hash: {content_hash}'}
+        connections:
+          - name: conn
+            plugin: dummy
+            some-required-prop: test
+        subjects:
+          - name: subject
+            sources:
+              - connection: conn
+                remote-dir: remote_dir
+        """, encoding='utf-8')
+
+        local_dir = temppath / 'syncs' / 'subject'
+        local_dir.mkdir(parents=True)
+        cache = filecache.FileCache(filecache.get_path(), hash_algorithm=content_hash)
+        subject_cache = cache.subject(connection='conn', name='subject',
+                                      remote_dir=pathlib.PurePath('remote_dir'),
+                                      local_dir=local_dir, plugin_name=dummy_plugin.NAME)
+        dummy_plugin.connect()
+        for name in ['unchanged', 'modified', 'missing']:
+            path = local_dir / name
+            path.write_text(name)
+            dummy_plugin.local_digests[path] = name
+            subject_cache.modify(path, dummy_plugin, name,
+                                 content_hash=hashing.hash_file(path, content_hash or 'sha256'),
+                                 stat=path.stat())
+        cache.write()
+
+        (local_dir / 'modified').write_text('changed')
+        dummy_plugin.local_digests[local_dir / 'modified'] = 'changed'
+        (local_dir / 'missing').unlink()
+
+        count, results = syncing.verify_cache(config_yml, jobs=2)
+        assert count == 3
+        assert sorted(results) == [
+            (local_dir / 'missing', syncing.Drift.MISSING),
+            (local_dir / 'modified', syncing.Drift.MODIFIED),
+            (local_dir / 'unchanged', None),
+        ]
+
+
 class TestConfigError:
 
     def test_valid_configuration(self, temppath: pathlib.Path):
@@ -1,8 +1,18 @@
+import os
+import sys
+import json
+import signal
+import shutil
+import pathlib
+import subprocess
+
 import pytest
 
 from click.testing import CliRunner
 
 from kitovu import cli
+from kitovu.sync import filecache, planning, syncing
+from kitovu.sync.plugin import smb
 
 
 @pytest.fixture
@@ -32,6 +42,147 @@ def test_sync_invalid(runner, temppath):
     assert result.exit_code == 1
 
 
+def test_sync_dry_run(runner, temppath):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--dry-run'])
+    assert result.output == 'Total: 0 files, 0 B\n'
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--dry-run', '--format', 'json'])
+    assert json.loads(result.output) == {'version': 1, 'total-bytes': 0, 'files': []}
+
+
+def test_sync_progress(runner, temppath):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--progress', 'jsonl'])
+    assert result.exit_code == 0
+    event = json.loads(result.output)
+    assert event['event'] == 'finished'
+    assert event['files'] == 0
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Sends SIGTERM to the test process")
+def test_sync_cancel(runner, monkeypatch):
+    def start_all(_config, options):
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert options.cancel.is_set()
+        return planning.Plan(files=[])
+
+    monkeypatch.setattr(syncing, 'start_all', start_all)
+    old_handler = signal.getsignal(signal.SIGTERM)
+
+    result = runner.invoke(cli.sync, [])
+
+    assert 'Cancelling after the running downloads' in result.output
+    assert 'Error: The sync was cancelled' in result.output
+    assert result.exit_code == 1
+    assert signal.getsignal(signal.SIGTERM) is old_handler
+
+
+def test_sync_stats(runner, temppath):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+    stats_file = temppath / 'stats.json'
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--stats',
+                                      '--stats-file', str(stats_file)])
+
+    assert result.exit_code == 0
+    assert result.output.splitlines()[0].split() == [
+        'Operation', 'Calls', 'Errors', 'Total', 'ms', 'Mean', 'ms', 'p95', 'ms', 'Max', 'ms',
+        'Bytes']
+    data = json.loads(stats_file.read_text())
+    assert data['operations']['sync.download']['calls'] == 1
+
+
+def test_sync_metrics(runner, temppath):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+    metrics_file = temppath / 'kitovu.prom'
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--metrics-file', str(metrics_file)])
+    assert result.exit_code == 0
+    lines = metrics_file.read_text().splitlines()
+    assert 'kitovu_sync_success 1' in lines
+    assert lines[-1] == '# EOF'
+
+    config.write_text('invalid: yes')
+    result = runner.invoke(cli.sync, ['--config', str(config), '--metrics-file', str(metrics_file)])
+    assert result.exit_code == 1
+    lines = metrics_file.read_text().splitlines()
+    assert 'kitovu_sync_success 0' in lines
+    assert any(line.startswith('kitovu_sync_last_success_timestamp_seconds ') for line in lines)
+
+
+def test_sync_metrics_write_error(runner, temppath, caplog):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+    metrics_file = temppath / 'does-not-exist' / 'kitovu.prom'
+
+    result = runner.invoke(cli.sync, ['--config', str(config), '--metrics-file', str(metrics_file)])
+    assert result.exit_code == 1
+    assert f"Could not write {metrics_file}" in result.output
+
+    # The error the sync failed with isn't replaced.
+    config.write_text('invalid: yes')
+    result = runner.invoke(cli.sync, ['--config', str(config), '--metrics-file', str(metrics_file)])
+    assert result.exit_code == 1
+    assert "Could not write" not in result.output
+    assert f"Could not write {metrics_file}" in caplog.text
+
+
+def test_sync_metrics_dry_run(runner, temppath):
+    result = runner.invoke(cli.sync, ['--dry-run', '--metrics-file', str(temppath / 'kitovu.prom')])
+    assert "--dry-run can't be used together with --metrics-file" in result.output
+    assert result.exit_code == 2
+
+
+def test_sync_dry_run_with_plan_file(runner, temppath):
+    plan_file = temppath / 'plan.json'
+    plan_file.write_text('{}')
+    result = runner.invoke(cli.sync, ['--dry-run', '--plan-file', str(plan_file)])
+    assert "--dry-run can't be used together with --plan-file" in result.output
+    assert result.exit_code == 2
+
+
+def test_sync_invalid_plan_file(runner, temppath):
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+    plan_file = temppath / 'plan.json'
+    plan_file.write_text('{"version": 1}')
+    result = runner.invoke(cli.sync, ['--config', str(config), '--plan-file', str(plan_file)])
+    assert result.output.startswith('Error: Invalid plan')
+    assert result.exit_code == 1
+
+
 class TestValidate:
 
     def test_valid(self, runner, temppath):
@@ -157,3 +308,112 @@ class TestEdit:
         def _find_executable_patch(self, editor):
             self.checked_editors.append(editor)
             return f'/some/example/path/{editor}'
+
+
+def test_cache_gc(runner, temppath, monkeypatch):
+    monkeypatch.setattr('appdirs.user_data_dir', lambda _path: str(temppath))
+    config = temppath / 'kitovu.yml'
+    config.write_text(f"""
+    root-dir: {temppath}
+    connections: []
+    subjects: []
+    """, encoding='utf-8')
+
+    result = runner.invoke(cli.cache, ['gc', '--config', str(config)])
+    assert result.output == 'Removed 0 entries (0 subjects), reclaimed 0 bytes.\n'
+    assert result.exit_code == 0
+
+
+class TestCache:
+
+    @pytest.fixture(autouse=True)
+    def patch_data_dir(self, monkeypatch, temppath):
+        monkeypatch.setattr('appdirs.user_data_dir', lambda _path: str(temppath))
+
+    @pytest.fixture
+    def filled_cache(self, temppath):
+        cache = filecache.FileCache(filecache.get_path())
+        subject_cache = cache.subject(connection='conn', name='subject',
+                                      remote_dir=pathlib.PurePath('remote'),
+                                      local_dir=temppath, plugin_name='smb')
+        plugin = smb.SmbPlugin()
+        subject_cache.modify(temppath / 'file1.txt', plugin, '1-2')
+        subject_cache.modify(temppath / 'file2.txt', plugin, '3-4')
+        cache.write()
+        return cache
+
+    def test_stats(self, runner, filled_cache):
+        result = runner.invoke(cli.cache, ['stats'])
+        lines = result.output.splitlines()
+        assert lines[0].split() == ['Connection', 'Subject', 'Remote', 'directory', 'Plugin',
+                                    'Entries', 'Size']
+        assert lines[1].split()[:5] == ['conn', 'subject', 'remote', 'smb', '2']
+        assert lines[3] == 'smb: 2 entries'
+        assert lines[4].startswith('Total: 2 entries in 1 subjects')
+        assert result.exit_code == 0
+
+    @pytest.fixture
+    def config(self, temppath):
+        config = temppath / 'kitovu.yml'
+        config.write_text(f"""
+        root-dir: {temppath}
+        filecache-format: binary
+        connections: []
+        subjects: []
+        """, encoding='utf-8')
+        return config
+
+    def test_export_import(self, runner, filled_cache, temppath, config):
+        export_file = temppath / 'export.json'
+        result = runner.invoke(cli.cache, ['export', '--config', str(config), str(export_file)])
+        assert result.exit_code == 0
+
+        shutil.rmtree(str(filecache.get_path()))
+        result = runner.invoke(cli.cache, ['import', '--config', str(config), str(export_file)])
+        assert result.output == 'Imported 1 subjects.\n'
+        assert result.exit_code == 0
+
+        cache = filecache.FileCache(filecache.get_path())
+        cache.load()
+        assert [key for key, _subject_cache in cache.subjects()] == [
+            ('conn', 'subject', 'remote')]
+        # Written in the configured format
+        assert [pathlib.Path(info.filename).suffix for info in cache.shard_infos()] == ['.bin']
+
+    @pytest.mark.parametrize('command', ['export', 'import'])
+    def test_missing_config(self, runner, temppath, command):
+        config = temppath / 'does-not-exist.yml'
+        result = runner.invoke(cli.cache, [command, '--config', str(config), '-'])
+        assert result.output == f'Error: Could not find the file {config}\n'
+        assert result.exit_code == 1
+
+    def test_import_invalid(self, runner, temppath, config):
+        import_file = temppath / 'import.json'
+        import_file.write_text('{')
+        result = runner.invoke(cli.cache, ['import', '--config', str(config), str(import_file)])
+        assert result.output.startswith(f'Error: Failed to read {import_file}')
+        assert result.exit_code == 1
+
+    def test_verify(self, runner, temppath):
+        config = temppath / 'kitovu.yml'
+        config.write_text(f"""
+        root-dir: {temppath}
+        connections: []
+        subjects: []
+        """, encoding='utf-8')
+
+        result = runner.invoke(cli.cache, ['verify', '--config', str(config)])
+        assert result.output.endswith('Checked 0 files, 0 differ from the file cache.\n')
+        assert result.exit_code == 0
+
+
+def test_lazy_imports():
+    """Make sure importing the CLI doesn't load slow dependencies or plugins."""
+    code = ('import sys, kitovu.cli; '
+            'print("\\n".join(sys.modules))')
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    loaded = {name.split('.')[0] for name in output.splitlines()}
+    slow = {'requests', 'smb', 'stevedore', 'jsonschema', 'keyring', 'yaml', 'distutils', 'PyQt5'}
+    assert not loaded & slow
+    assert 'kitovu.sync.syncing' not in output.splitlines()
@@ -1,136 +1,447 @@
+import os
 import pytest
 import pathlib
 import json
+import concurrent.futures
 
-from kitovu.sync import filecache
+from kitovu import utils
+from kitovu.sync import filecache, localindex, hashing
 from kitovu.sync.plugin.smb import SmbPlugin
 
 
 @pytest.fixture
 def cache(temppath) -> filecache.FileCache:
-    return filecache.FileCache(temppath / "test_filecache.json")
+    return filecache.FileCache(temppath / "filecache")
 
 
-class TestFile:
+@pytest.fixture
+def subject_cache(temppath, cache) -> filecache.SubjectCache:
+    return cache.subject(connection="connection", name="subject",
+                         remote_dir=pathlib.PurePath("remote_dir"), local_dir=temppath,
+                         plugin_name="dummyplugin")
+
+
+class TestKeyCompression:
+
+    def test_compress(self):
+        keys = ["Dokumente/Anleitung.pdf", "Dokumente/Vorlage.docx", "Uebungen/Blatt1.pdf"]
+        assert list(filecache._compress_keys(keys)) == [
+            (0, "Dokumente/Anleitung.pdf"),
+            (10, "Vorlage.docx"),
+            (0, "Uebungen/Blatt1.pdf"),
+        ]
+
+    def test_roundtrip(self):
+        keys = sorted(["a/b/c", "a/b/d", "a/bc", "b", "ba", "ba/c/d/e"])
+        assert list(filecache._decompress_keys(filecache._compress_keys(keys))) == keys
 
-    def test_to_dict(self, temppath):
-        file = filecache.File("this_is_a_digest", "dummyplugin")
-        assert file.to_dict() == {"plugin": "dummyplugin", "digest": "this_is_a_digest"}
+
+def _read_json(path):
+    with path.open("r") as f:
+        return json.load(f)
+
+
+def _subject(cache, temppath, name="subject", local_dir=None):
+    return cache.subject(connection="connection", name=name,
+                         remote_dir=pathlib.PurePath("remote_dir"),
+                         local_dir=temppath if local_dir is None else local_dir,
+                         plugin_name="dummyplugin")
 
 
 class TestLoadWrite:
 
-    def test_write(self, temppath, cache, plugin):
-        cache.modify(temppath / "testfile1.txt", plugin, "digest1")
-        cache.modify(temppath / "testfile2.pdf", plugin, "digest2")
-        cache.modify(temppath / "testfile3.png", plugin, "digest3")
+    def test_write(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        subject_cache.modify(temppath / "testfile2.pdf", plugin, "digest2")
+        subject_cache.modify(temppath / "testfile3.png", plugin, "digest3")
+        cache.write()
+
+        manifest = _read_json(cache._manifest_filename)
+        shard_filename = manifest["shards"][0]["file"]
+        assert manifest == {
+            "version": 3,
+            "shards": [{
+                "connection": "connection",
+                "subject": "subject",
+                "remote-dir": "remote_dir",
+                "plugin": "dummyplugin",
+                "file": shard_filename,
+                "entries": 3,
+            }],
+        }
+        assert _read_json(cache._directory / shard_filename) == {
+            "version": 3,
+            "plugin": "dummyplugin",
+            "files": [
+                [0, "testfile1.txt", "digest1"],
+                [8, "2.pdf", "digest2"],
+                [8, "3.png", "digest3"],
+            ],
+        }
+
+    def test_write_skips_placeholders(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        subject_cache._data["testfile2.txt"] = filecache.File(cached_digest=None)
+        cache.write()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        assert _subject(new_cache, temppath)._data == {
+            "testfile1.txt": filecache.File(cached_digest="digest1"),
+        }
+
+    def test_load(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile4.txt", plugin, "digest4")
+        subject_cache.modify(temppath / "testfile5.pdf", plugin, "digest5")
+        subject_cache.modify(temppath / "testfile6.png", plugin, "digest6")
+        cache.write()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        loaded = _subject(new_cache, temppath)
+        assert loaded._data == {"testfile4.txt": filecache.File(cached_digest="digest4"),
+                                "testfile5.pdf": filecache.File(cached_digest="digest5"),
+                                "testfile6.png": filecache.File(cached_digest="digest6")}
+
+    def test_load_is_lazy(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile.txt", plugin, "digest")
+        cache.write()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        assert list(new_cache._shards) == [("connection", "subject", "remote_dir")]
+        assert not new_cache._subjects
+
+    def test_load_relocated(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "dir/testfile.txt", plugin, "digest")
         cache.write()
-        with cache._filename.open("r") as f:
-            json_data = json.load(f)
-        assert json_data == {str(temppath / "testfile1.txt"): {"digest": "digest1", "plugin": "dummyplugin"},
-                             str(temppath / "testfile2.pdf"): {"digest": "digest2", "plugin": "dummyplugin"},
-                             str(temppath / "testfile3.png"): {"digest": "digest3", "plugin": "dummyplugin"}}
 
-    def test_load(self, temppath, cache, plugin):
-        cache.modify(temppath / "testfile4.txt", plugin, "digest4")
-        cache.modify(temppath / "testfile5.pdf", plugin, "digest5")
-        cache.modify(temppath / "testfile6.png", plugin, "digest6")
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        loaded = _subject(new_cache, temppath, local_dir=temppath / "moved")
+        assert loaded.root == temppath / "moved"
+        assert loaded._data == {"dir/testfile.txt": filecache.File(cached_digest="digest")}
+
+    def test_write_keeps_other_shards(self, temppath, plugin):
+        """Two processes (e.g. for two connections) only write their own shards."""
+        directory = temppath / "filecache"
+        cache1 = filecache.FileCache(directory)
+        cache1.load()
+        cache2 = filecache.FileCache(directory)
+        cache2.load()
+
+        _subject(cache1, temppath, name="subject1").modify(temppath / "file1", plugin, "digest1")
+        _subject(cache2, temppath, name="subject2").modify(temppath / "file2", plugin, "digest2")
+        cache1.write()
+        cache2.write()
+
+        new_cache = filecache.FileCache(directory)
+        new_cache.load()
+        assert _subject(new_cache, temppath, name="subject1")._data == {
+            "file1": filecache.File(cached_digest="digest1"),
+        }
+        assert _subject(new_cache, temppath, name="subject2")._data == {
+            "file2": filecache.File(cached_digest="digest2"),
+        }
+
+    def test_concurrent_writes(self, temppath, plugin):
+        directory = temppath / "filecache"
+        caches = []
+        for i in range(8):
+            cache = filecache.FileCache(directory)
+            _subject(cache, temppath, name=f"subject{i}").modify(
+                temppath / "testfile.txt", plugin, "digest")
+            caches.append(cache)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(filecache.FileCache.write, caches))
+
+        new_cache = filecache.FileCache(directory)
+        new_cache.load()
+        assert [info.subject for info in new_cache.shard_infos()] == [f"subject{i}" for i in range(8)]
+        assert not [path for path in directory.iterdir() if path.suffix == ".tmp"]
+
+    def test_write_error_removes_temp_file(self, temppath, cache, subject_cache, plugin, monkeypatch):
+        subject_cache.modify(temppath / "testfile.txt", plugin, "digest")
+
+        def dump(*_args, **_kwargs):
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(filecache.json, "dump", dump)
+        with pytest.raises(OSError):
+            cache.write()
+        assert list(cache._directory.iterdir()) == []
+
+    def test_write_removes_empty_shards(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile.txt", plugin, "digest")
         cache.write()
+        shard_path = cache._directory / cache._shards[("connection", "subject", "remote_dir")].filename
+        assert shard_path.exists()
+
+        subject_cache._data.clear()
+        subject_cache.changed = True
+        cache.write()
+        assert not shard_path.exists()
+        assert _read_json(cache._manifest_filename)["shards"] == []
+
+    def test_load_version_1(self, temppath, cache):
+        legacy = {
+            str(temppath / "subject/testfile1.txt"): {"plugin": "dummyplugin", "digest": "digest1"},
+            str(temppath / "subject/dir/testfile2.txt"): {"plugin": "dummyplugin", "digest": "digest2"},
+            str(temppath / "other/testfile3.txt"): {"plugin": "dummyplugin", "digest": "digest3"},
+        }
+        with cache._old_filename.open("w") as f:
+            json.dump(legacy, f)
+
+        cache.load()
+        subject_cache = _subject(cache, temppath, local_dir=temppath / "subject")
+        assert subject_cache._data == {"testfile1.txt": filecache.File(cached_digest="digest1"),
+                                       "dir/testfile2.txt": filecache.File(cached_digest="digest2")}
+
+        cache.write()
+        assert not cache._old_filename.exists()
+        assert _read_json(cache._legacy_filename) == {
+            str(temppath / "other/testfile3.txt"): {"plugin": "dummyplugin", "digest": "digest3"},
+        }
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        other = _subject(new_cache, temppath, name="other", local_dir=temppath / "other")
+        assert other._data == {"testfile3.txt": filecache.File(cached_digest="digest3")}
+        new_cache.write()
+        assert not new_cache._legacy_filename.exists()
+
+    def test_migrate_twice(self, temppath, cache):
+        with cache._old_filename.open("w") as f:
+            json.dump({"version": 2, "subjects": []}, f)
+
+        other_cache = filecache.FileCache(cache._directory)
         cache.load()
-        assert cache._data == {temppath / "testfile4.txt": filecache.File(cached_digest="digest4",
-                                                                          plugin_name="dummyplugin"),
-                               temppath / "testfile5.pdf": filecache.File(cached_digest="digest5",
-                                                                          plugin_name="dummyplugin"),
-                               temppath / "testfile6.png": filecache.File(cached_digest="digest6",
-                                                                          plugin_name="dummyplugin")}
+        other_cache.load()
+        cache.write()
+        other_cache.write()
+        assert not cache._old_filename.exists()
+
+    def test_load_version_2(self, temppath, cache):
+        with cache._old_filename.open("w") as f:
+            json.dump({
+                "version": 2,
+                "subjects": [{
+                    "connection": "connection",
+                    "subject": "subject",
+                    "remote-dir": "remote_dir",
+                    "plugin": "dummyplugin",
+                    "files": [[0, "testfile1.txt", "digest1"], [8, "2.txt", "digest2"]],
+                }],
+            }, f)
+
+        cache.load()
+        cache.write()
+        assert not cache._old_filename.exists()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        assert _subject(new_cache, temppath)._data == {
+            "testfile1.txt": filecache.File(cached_digest="digest1"),
+            "testfile2.txt": filecache.File(cached_digest="digest2"),
+        }
+
+    def test_binary_format(self, temppath, plugin):
+        directory = temppath / "filecache"
+        cache = filecache.FileCache(directory, fmt="binary")
+        subject_cache = _subject(cache, temppath)
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+        cache.write()
+
+        assert [path.suffix for path in directory.glob("*.bin")] == [".bin"]
+
+        new_cache = filecache.FileCache(directory, fmt="binary")
+        new_cache.load()
+        loaded = _subject(new_cache, temppath)
+        # Lookups are served from the memory-mapped table
+        assert not loaded._data
+        assert loaded._lookup("testfile2.txt") == filecache.File(cached_digest="digest2")
+        assert loaded._lookup("testfile3.txt") is None
+        assert loaded._data == {"testfile2.txt": filecache.File(cached_digest="digest2")}
+
+        loaded.materialize()
+        assert loaded._data == {"testfile1.txt": filecache.File(cached_digest="digest1"),
+                                "testfile2.txt": filecache.File(cached_digest="digest2")}
+
+    @pytest.mark.parametrize("fmt", ["json", "binary"])
+    def test_write_skips_unchanged_shards(self, temppath, plugin, monkeypatch, fmt):
+        directory = temppath / "filecache"
+        cache = filecache.FileCache(directory, fmt=fmt)
+        (temppath / "testfile1.txt").touch()
+        _subject(cache, temppath).modify(temppath / "testfile1.txt", plugin, "digest1")
+        cache.write()
+
+        new_cache = filecache.FileCache(directory, fmt=fmt)
+        new_cache.load()
+        loaded = _subject(new_cache, temppath)
+        index = localindex.LocalIndex(temppath)
+        index.scan()
+        assert loaded.compact(index) == 0
+        if fmt == "binary":
+            assert not loaded._data
+
+        def write_shard(*_args):
+            pytest.fail("Unchanged shard written")
+
+        monkeypatch.setattr(new_cache, "_write_shard", write_shard)
+        new_cache.write()
+        assert [info.entries for info in new_cache.shard_infos()] == [1]
+
+    @pytest.mark.parametrize("old_format, new_format", [("json", "binary"), ("binary", "json")])
+    def test_format_migration(self, temppath, plugin, old_format, new_format):
+        directory = temppath / "filecache"
+        cache = filecache.FileCache(directory, fmt=old_format)
+        _subject(cache, temppath).modify(temppath / "testfile.txt", plugin, "digest")
+        cache.write()
+
+        new_cache = filecache.FileCache(directory, fmt=new_format)
+        new_cache.load()
+        _subject(new_cache, temppath)
+        new_cache.write()
+
+        shard_files = sorted(path.name for path in directory.iterdir() if path.name != "manifest.json")
+        assert len(shard_files) == 1
+        assert shard_files[0].endswith(".bin" if new_format == "binary" else ".json")
+
+        newest_cache = filecache.FileCache(directory)
+        newest_cache.load()
+        assert _subject(newest_cache, temppath)._lookup("testfile.txt") == filecache.File(
+            cached_digest="digest")
+
+    def test_invalid_binary_shard(self, temppath, plugin, caplog):
+        directory = temppath / "filecache"
+        cache = filecache.FileCache(directory, fmt="binary")
+        _subject(cache, temppath).modify(temppath / "testfile.txt", plugin, "digest")
+        cache.write()
+        for path in directory.glob("*.bin"):
+            path.write_bytes(b"garbage")
+
+        new_cache = filecache.FileCache(directory, fmt="binary")
+        new_cache.load()
+        assert len(_subject(new_cache, temppath)) == 0
+        assert caplog.records[-1].message.startswith("Ignoring invalid file cache shard")
+
+    def test_load_interns_plugin_names(self, temppath, cache, subject_cache, plugin):
+        other = _subject(cache, temppath, name="other")
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        other.modify(temppath / "testfile2.txt", plugin, "digest2")
+        cache.write()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        first = _subject(new_cache, temppath)
+        second = _subject(new_cache, temppath, name="other")
+        assert first.plugin_name is second.plugin_name
 
     def test_filecache_not_found(self, temppath, cache, plugin):
         cache.load()
-        assert not cache._data
+        assert not cache._shards
+        assert not cache._subjects
 
 
 class TestChange:
 
-    def test_modify(self, temppath, plugin, cache):
-        cache.modify(temppath / "testfile1.txt", plugin, "digest1")
-        testfile = filecache.File(cached_digest="digest1", plugin_name="dummyplugin")
-        assert cache._data[temppath / "testfile1.txt"] == testfile
+    def test_modify(self, temppath, plugin, subject_cache):
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        testfile = filecache.File(cached_digest="digest1")
+        assert subject_cache._data["testfile1.txt"] == testfile
 
-    def test_not_matching_pluginname(self, temppath, plugin, cache):
+    def test_not_matching_pluginname(self, temppath, plugin, subject_cache):
         local = temppath / "local_dir/test/example1.txt"
         local.parent.mkdir(parents=True)
         local.touch()
         remote = pathlib.PurePath("remote_dir/test/example1.txt")
 
-        cache.modify(local, plugin, plugin.remote_digests[remote])
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote])
 
         wrongplugin = SmbPlugin()
         with pytest.raises(AssertionError):
-            cache.discover_changes(local, remote, wrongplugin)
+            subject_cache.discover_changes(local, remote, wrongplugin)
 
 
 class TestFileState:
 
-    def test_file_is_new(self, temppath, plugin, cache):
+    def test_file_is_new(self, temppath, plugin, subject_cache):
+        local = temppath / "testfile1.txt"
+        remote = pathlib.PurePath(temppath) / "testfile1.txt"
+        assert subject_cache.discover_changes(local, remote, plugin) == filecache.FileState.NEW
+
+    def test_file_is_new_with_index(self, temppath, plugin, subject_cache):
         local = temppath / "testfile1.txt"
         remote = pathlib.PurePath(temppath) / "testfile1.txt"
-        assert cache.discover_changes(local, remote, plugin) == filecache.FileState.NEW
+        index = localindex.LocalIndex(temppath)
+        index.scan()
+        local.touch()  # not in the index
+        assert subject_cache.discover_changes(local, remote, plugin, index) == filecache.FileState.NEW
 
+    @pytest.mark.parametrize('use_index', [True, False])
     @pytest.mark.parametrize('local_changed, remote_changed, expected', [
         (True, True, filecache.FileState.BOTH_CHANGED),
         (True, False, filecache.FileState.LOCAL_CHANGED),
         (False, True, filecache.FileState.REMOTE_CHANGED),
         (False, False, filecache.FileState.NO_CHANGES),
     ])
-    def test_files_changed(self, temppath, plugin, cache, local_changed, remote_changed, expected):
+    def test_files_changed(self, temppath, plugin, subject_cache, local_changed, remote_changed, expected,
+                           use_index):
         plugin.connect()
         local = temppath / "local_dir/test/example4.txt"
         local.parent.mkdir(parents=True)
         local.touch()
         remote = pathlib.PurePath("remote_dir/test/example4.txt")
 
-        cache.modify(local, plugin, plugin.remote_digests[remote])
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote])
 
         if local_changed:
             plugin.local_digests[local] = "abc"
         if remote_changed:
             plugin.remote_digests[remote] = "def"
 
-        assert cache.discover_changes(local, remote, plugin) == expected
+        index = None
+        if use_index:
+            index = localindex.LocalIndex(temppath)
+            index.scan()
+
+        assert subject_cache.discover_changes(local, remote, plugin, index) == expected
 
-    def test_outdated_cache_and_same_digest(self, temppath, plugin, cache):
+    def test_outdated_cache_and_same_digest(self, temppath, plugin, subject_cache):
         plugin.connect()
         local = temppath / "local_dir/test/example4.txt"
         local.parent.mkdir(parents=True)
         local.touch()
         remote = pathlib.PurePath("remote_dir/test/example4.txt")
 
-        cache.modify(local, plugin, plugin.remote_digests[remote])
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote])
 
         plugin.local_digests[local] = "new-digest"
         plugin.remote_digests[remote] = "new-digest"
 
-        assert cache._data[local].cached_digest != "new-digest"
-        assert cache.discover_changes(local, remote, plugin) == filecache.FileState.NO_CHANGES
-        assert cache._data[local].cached_digest == "new-digest"
+        assert subject_cache._data['local_dir/test/example4.txt'].cached_digest != "new-digest"
+        assert subject_cache.discover_changes(local, remote, plugin) == filecache.FileState.NO_CHANGES
+        assert subject_cache._data['local_dir/test/example4.txt'].cached_digest == "new-digest"
 
-    def test_outdated_cache_and_different_digest(self, temppath, plugin, cache):
+    def test_outdated_cache_and_different_digest(self, temppath, plugin, subject_cache):
         plugin.connect()
         local = temppath / "local_dir/test/example4.txt"
         local.parent.mkdir(parents=True)
         local.touch()
         remote = pathlib.PurePath("remote_dir/test/example4.txt")
 
-        cache.modify(local, plugin, plugin.remote_digests[remote])
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote])
 
         plugin.local_digests[local] = "other-digest"
         plugin.remote_digests[remote] = "new-digest"
 
-        assert cache._data[local].cached_digest != "new-digest"
-        assert cache.discover_changes(local, remote, plugin) == filecache.FileState.BOTH_CHANGED
-        assert cache._data[local].cached_digest != "new-digest"
+        assert subject_cache._data['local_dir/test/example4.txt'].cached_digest != "new-digest"
+        assert subject_cache.discover_changes(local, remote, plugin) == filecache.FileState.BOTH_CHANGED
+        assert subject_cache._data['local_dir/test/example4.txt'].cached_digest != "new-digest"
 
-    def test_outdated_cache_new_file(self, temppath, plugin, cache):
+    def test_outdated_cache_new_file(self, temppath, plugin, subject_cache):
         plugin.connect()
         local = temppath / "local_dir/test/example4.txt"
         local.parent.mkdir(parents=True)
@@ -139,6 +450,258 @@ class TestFileState:
         remote = pathlib.PurePath("remote_dir/test/example4.txt")
         plugin.remote_digests[remote] = "new-digest"
 
-        assert local not in cache._data
-        assert cache.discover_changes(local, remote, plugin) == filecache.FileState.BOTH_CHANGED
-        assert cache._data[local].cached_digest is None
+        assert 'local_dir/test/example4.txt' not in subject_cache._data
+        assert subject_cache.discover_changes(local, remote, plugin) == filecache.FileState.BOTH_CHANGED
+        assert subject_cache._data['local_dir/test/example4.txt'].cached_digest is None
+
+
+class TestContentHash:
+
+    @pytest.fixture
+    def hashed_cache(self, temppath) -> filecache.FileCache:
+        return filecache.FileCache(temppath / "filecache", hash_algorithm="sha256")
+
+    @pytest.fixture
+    def synced(self, temppath, plugin, hashed_cache):
+        """A local file synchronized with content hashes."""
+        plugin.connect()
+        subject_cache = _subject(hashed_cache, temppath)
+        local = temppath / "local_dir/test/example4.txt"
+        local.parent.mkdir(parents=True)
+        local.write_text("content")
+        remote = pathlib.PurePath("remote_dir/test/example4.txt")
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote],
+                             content_hash=hashing.hash_file(local, "sha256"), stat=local.stat())
+        return subject_cache, local, remote
+
+    def _index(self, temppath):
+        index = localindex.LocalIndex(temppath)
+        index.scan()
+        return index
+
+    def test_touched_file_is_unchanged(self, temppath, plugin, synced):
+        subject_cache, local, remote = synced
+        plugin.local_digests[local] = "touched"  # e.g. the mtime changed
+        os.utime(str(local), ns=(0, 1337))
+        index = self._index(temppath)
+        assert subject_cache.discover_changes(local, remote, plugin, index) == \
+            filecache.FileState.NO_CHANGES
+
+    def test_same_digest_different_content(self, temppath, plugin, synced):
+        subject_cache, local, remote = synced
+        local.write_text("CONTENT")  # plugin digest stays the same
+        index = self._index(temppath)
+        assert subject_cache.discover_changes(local, remote, plugin, index) == \
+            filecache.FileState.LOCAL_CHANGED
+
+        plugin.remote_digests[remote] = "new"
+        assert subject_cache.discover_changes(local, remote, plugin, index) == \
+            filecache.FileState.BOTH_CHANGED
+
+    def test_update_hashes(self, temppath, plugin, synced, mocker):
+        subject_cache, local, _remote = synced
+        assert subject_cache.update_hashes(self._index(temppath)) == 0
+
+        local.write_text("CONTENT")
+        assert subject_cache.update_hashes(self._index(temppath)) == 1
+        hashes = subject_cache._data["local_dir/test/example4.txt"].hashes
+        assert hashes.current == hashing.hash_file(local, "sha256")
+        assert hashes.synced != hashes.current
+
+        # The hash is cached for the new stat signature.
+        mocker.patch.object(hashing, "hash_file", autospec=True)
+        assert subject_cache.update_hashes(self._index(temppath)) == 0
+        remote = pathlib.PurePath("remote_dir/test/example4.txt")
+        index = self._index(temppath)
+        assert subject_cache.discover_changes(local, remote, plugin, index) == \
+            filecache.FileState.LOCAL_CHANGED
+        assert not hashing.hash_file.called
+
+    def test_enabled_later(self, temppath, plugin, hashed_cache):
+        """Without a hash from synctime, the plugin's digest is used once."""
+        plugin.connect()
+        subject_cache = _subject(hashed_cache, temppath)
+        local = temppath / "local_dir/test/example4.txt"
+        local.parent.mkdir(parents=True)
+        local.write_text("content")
+        remote = pathlib.PurePath("remote_dir/test/example4.txt")
+        subject_cache.modify(local, plugin, plugin.remote_digests[remote])
+
+        assert subject_cache.discover_changes(local, remote, plugin) == \
+            filecache.FileState.NO_CHANGES
+        hashes = subject_cache._data["local_dir/test/example4.txt"].hashes
+        assert hashes.synced == hashes.current == hashing.hash_file(local, "sha256")
+
+    @pytest.mark.parametrize("fmt", filecache.FileCache.FORMATS)
+    def test_load_write(self, temppath, plugin, synced, hashed_cache, fmt):
+        subject_cache, local, _remote = synced
+        hashed_cache._format = fmt
+        hashed_cache.write()
+
+        new_cache = filecache.FileCache(temppath / "filecache", hash_algorithm="sha256")
+        new_cache.load()
+        loaded = _subject(new_cache, temppath)
+        key = "local_dir/test/example4.txt"
+        assert loaded._lookup(key) == subject_cache._data[key]
+        assert loaded._lookup(key).hashes.synced == hashing.hash_file(local, "sha256")
+
+
+class TestGarbageCollection:
+
+    def test_compact(self, temppath, subject_cache, plugin):
+        (temppath / "testfile1.txt").touch()
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+        index = localindex.LocalIndex(temppath)
+        index.scan()
+
+        assert subject_cache.compact(index) == 1
+        assert subject_cache._data == {"testfile1.txt": filecache.File(cached_digest="digest1")}
+        assert subject_cache.compact(index) == 0
+
+    def test_compact_binary(self, temppath, plugin):
+        directory = temppath / "filecache"
+        cache = filecache.FileCache(directory, fmt="binary")
+        (temppath / "testfile1.txt").touch()
+        subject_cache = _subject(cache, temppath)
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+        cache.write()
+
+        new_cache = filecache.FileCache(directory, fmt="binary")
+        new_cache.load()
+        loaded = _subject(new_cache, temppath)
+        index = localindex.LocalIndex(temppath)
+        index.scan()
+        assert loaded.compact(index) == 1
+        assert loaded._data == {"testfile1.txt": filecache.File(cached_digest="digest1")}
+        assert loaded.changed
+
+    def test_remove_unconfigured(self, temppath, cache, subject_cache, plugin):
+        other = _subject(cache, temppath, name="other")
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        other.modify(temppath / "testfile2.txt", plugin, "digest2")
+        other.modify(temppath / "testfile3.txt", plugin, "digest3")
+        cache.write()
+        assert len(list(cache._directory.iterdir())) == 3
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        size_before = new_cache.disk_usage()
+        configured = {("connection", "subject", "remote_dir")}
+        assert new_cache.remove_unconfigured(configured) == filecache.GcResult(
+            entries=2, shards=1)
+        new_cache.write()
+
+        assert len(list(cache._directory.iterdir())) == 2
+        assert new_cache.disk_usage() < size_before
+        newest_cache = filecache.FileCache(cache._directory)
+        newest_cache.load()
+        assert list(newest_cache._shards) == [("connection", "subject", "remote_dir")]
+
+    def test_remove_unconfigured_loaded(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        cache.write()
+        assert cache.remove_unconfigured(set()) == filecache.GcResult(entries=1, shards=1)
+        cache.write()
+        assert not cache._shards
+        assert [path.name for path in cache._directory.iterdir()] == ["manifest.json"]
+
+    def test_remove_legacy(self, temppath, cache):
+        cache._directory.mkdir()
+        legacy = {str(temppath / "other" / "testfile.txt"): {"digest": "1", "plugin": "smb"}}
+        cache._legacy_filename.write_text(json.dumps(legacy))
+        cache.load()
+
+        assert cache.remove_unconfigured(set()).entries == 0
+        assert cache.remove_unconfigured(set(), legacy=True).entries == 1
+        cache.write()
+        assert not cache._legacy_filename.exists()
+
+    def test_disk_usage_without_cache(self, cache):
+        assert cache.disk_usage() == 0
+
+
+class TestExportImport:
+
+    def test_roundtrip(self, temppath, cache, subject_cache, plugin):
+        other = _subject(cache, temppath, name="other")
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        other.modify(temppath / "testfile2.txt", plugin, "digest2")
+        cache.write()
+
+        new_cache = filecache.FileCache(cache._directory)
+        new_cache.load()
+        data = json.loads(json.dumps(new_cache.export_data()))
+        assert data == {
+            "version": 3,
+            "subjects": [
+                {"connection": "connection", "subject": "other", "remote-dir": "remote_dir",
+                 "plugin": "dummyplugin", "files": [[0, "testfile2.txt", "digest2"]]},
+                {"connection": "connection", "subject": "subject", "remote-dir": "remote_dir",
+                 "plugin": "dummyplugin", "files": [[0, "testfile1.txt", "digest1"]]},
+            ],
+        }
+
+        imported = filecache.FileCache(temppath / "imported")
+        assert imported.import_data(data) == 2
+        imported.write()
+        imported.load()
+        assert _subject(imported, temppath)._lookup("testfile1.txt") == filecache.File(
+            cached_digest="digest1")
+
+    def test_import_replaces(self, temppath, cache, subject_cache, plugin):
+        subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+        data = cache.export_data()
+        subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+
+        cache.import_data(data)
+        assert _subject(cache, temppath)._data == {
+            "testfile1.txt": filecache.File(cached_digest="digest1"),
+        }
+
+    @pytest.mark.parametrize("data, message", [
+        ([], "Unknown file cache export format"),
+        ({"version": 1}, "Unknown file cache export format"),
+        ({"version": 3}, "Invalid file cache export"),
+        ({"version": 3, "subjects": [{"plugin": "smb"}]}, "Invalid file cache export"),
+    ])
+    def test_import_invalid(self, cache, data, message):
+        with pytest.raises(utils.UsageError, match=message):
+            cache.import_data(data)
+
+
+def test_stats(temppath, cache, subject_cache, plugin):
+    other = _subject(cache, temppath, name="other")
+    other.plugin_name = "smb"
+    subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+    subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+    other.plugin_name = "dummyplugin"
+    other.modify(temppath / "testfile3.txt", plugin, "digest3")
+    other.plugin_name = "smb"
+    cache.write()
+
+    cache_stats = filecache.stats(cache._directory)
+    assert [(s.subject, s.plugin, s.entries) for s in cache_stats.subjects] == [
+        ("other", "smb", 1),
+        ("subject", "dummyplugin", 2),
+    ]
+    assert all(s.size > 0 for s in cache_stats.subjects)
+    assert cache_stats.size > sum(s.size for s in cache_stats.subjects)  # manifest
+    assert cache_stats.entries_per_plugin() == {"smb": 1, "dummyplugin": 2}
+    assert cache_stats.load_time > 0
+
+
+def test_manifest_stats(temppath, cache, subject_cache, plugin, monkeypatch):
+    subject_cache.modify(temppath / "testfile1.txt", plugin, "digest1")
+    subject_cache.modify(temppath / "testfile2.txt", plugin, "digest2")
+    cache.write()
+    expected = filecache.stats(cache._directory)
+
+    def load_shard(*_args):
+        pytest.fail("Shard loaded")
+
+    monkeypatch.setattr(filecache.FileCache, '_load_shard', load_shard)
+    cache_stats = filecache.manifest_stats(cache._directory)
+    assert cache_stats.subjects == expected.subjects
+    assert cache_stats.size == expected.size
@@ -27,3 +27,30 @@ def test_password_prompt(mocker):
     utils.get_password('dummyplugin', 'identifier', 'prompt')
     mock.assert_called_once_with('Enter password for dummyplugin (prompt): ')
     assert keyring.get_password('kitovu-dummyplugin', 'identifier') == 'hunter2'
+
+
+class TestSchemaValidator:
+
+    def _schema(self):
+        return {'type': 'object', 'properties': {'name': {'type': 'string'}}}
+
+    def test_compile_cached(self):
+        assert utils.compile_schema(self._schema()) is utils.compile_schema(self._schema())
+
+    def test_compile_different(self):
+        other = self._schema()
+        other['properties']['name']['type'] = 'integer'
+        assert utils.compile_schema(self._schema()) is not utils.compile_schema(other)
+
+    def test_collects_errors(self):
+        validator = utils.SchemaValidator(abort=False)
+        validator.validate({'name': 1}, self._schema())
+        validator.validate({'name': 2}, self._schema())
+        assert not validator.is_valid
+        assert len(validator.errors) == 2
+
+    def test_abort(self):
+        validator = utils.SchemaValidator()
+        validator.validate({'name': 'kitovu'}, self._schema())
+        with pytest.raises(utils.InvalidSettingsError, match="1 is not of type 'string'"):
+            validator.validate({'name': 1}, self._schema())